@@ -34,6 +34,38 @@ with zipfile.ZipFile(package_name, mode='a',
              arcname='README.md')
     zf.write(os.path.join(d, 'pgcli_sublime.py'),
              arcname='pgcli_sublime.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_bench.py'),
+             arcname='pgcli_sublime_bench.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_cache.py'),
+             arcname='pgcli_sublime_cache.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_completions.py'),
+             arcname='pgcli_sublime_completions.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_engine.py'),
+             arcname='pgcli_sublime_engine.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_explain.py'),
+             arcname='pgcli_sublime_explain.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_export.py'),
+             arcname='pgcli_sublime_export.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_format.py'),
+             arcname='pgcli_sublime_format.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_history.py'),
+             arcname='pgcli_sublime_history.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_load.py'),
+             arcname='pgcli_sublime_load.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_metadata.py'),
+             arcname='pgcli_sublime_metadata.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_pool.py'),
+             arcname='pgcli_sublime_pool.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_prepared.py'),
+             arcname='pgcli_sublime_prepared.py')
     zf.write(os.path.join(d, 'pgcli_sublime_repl.py'),
              arcname='pgcli_sublime_repl.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_results.py'),
+             arcname='pgcli_sublime_results.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_scheduler.py'),
+             arcname='pgcli_sublime_scheduler.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_statements.py'),
+             arcname='pgcli_sublime_statements.py')
+    zf.write(os.path.join(d, 'pgcli_sublime_timing.py'),
+             arcname='pgcli_sublime_timing.py')
 print(f'write to {package_name}')
@@ -5,13 +5,44 @@ import sys
 import os
 import site
 import traceback
+import io
 import queue
 import datetime
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
 from urllib.parse import urlparse
 from threading import Lock, Thread
 
+from .pgcli_sublime_cache import ResultCache, cache_key, is_read_only
+from .pgcli_sublime_bench import (
+    append_result, compare_plans, explain_plan, format_histogram, histogram,
+    read_results, summarize, timed_run
+)
+from .pgcli_sublime_completions import CompletionCache, word_before_cursor
+from .pgcli_sublime_engine import ExecutionEngine, QueueFull
+from .pgcli_sublime_explain import analyze, explain_analyze
+from .pgcli_sublime_export import EXPORT_FORMATS, export
+from .pgcli_sublime_format import Table, format_table
+from .pgcli_sublime_history import QueryHistory, error_summary, fingerprint, normalize
+from .pgcli_sublime_load import iter_lines, load, load_format
+from .pgcli_sublime_metadata import (
+    CatalogChanges, build_completer, catalog_changes, fetch_changes,
+    load_metadata, patch_completer, patch_metadata, read_cache, write_cache
+)
+from .pgcli_sublime_pool import ConnectionPool
+from .pgcli_sublime_prepared import PREPARABLE_SQL_RE, PreparedStatements, interpolate
+from .pgcli_sublime_results import ResultStore
+from .pgcli_sublime_scheduler import Scheduler
+from .pgcli_sublime_statements import (
+    StatementIndex, batch_block, batch_counts, batch_status, batch_statements,
+    iter_statements, single_statement
+)
+from .pgcli_sublime_timing import QueryTimer, TimingLog
+
 try:
     from SublimeREPL.repls import Repl
     SUBLIME_REPL_AVAIL = True
@@ -19,22 +50,99 @@ except ImportError:
     SUBLIME_REPL_AVAIL = False
 
 CLOSE_CONNECT_AFTER_IDLE_TIMEOUT = 30
-
-maintain_job = None
+KEEPALIVE_INTERVAL = 60
+POOL_CHECKOUT_TIMEOUT = 30
+
+# Statements which may be declared as a server-side cursor for streaming
+STREAMABLE_SQL_RE = re.compile(r'(select|values|table|with)\b', re.IGNORECASE)
+NOT_STREAMABLE_SQL_RE = re.compile(r'\b(insert|update|delete|into)\b', re.IGNORECASE)
+
+# Statements leaving session state behind, which must not leak into a pooled
+# connection used by other views
+SESSION_STATE_SQL_RE = re.compile(
+    r'(^|;)\s*(set\s+(?!local\b|transaction\b)|reset\b|listen\b|prepare\b'
+    r'|create\s+(temp|temporary)\b|declare\b.*\bwith\s+hold\b|\\c\b|\\connect\b)',
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Statements dropping the prepared statements of the session
+DEALLOCATE_SQL_RE = re.compile(r'\b(deallocate|discard)\b', re.IGNORECASE)
+# Ddl which may change what prepared statements of any session read, unlike
+# has_meta_cmd this leaves out commit and rollback
+DDL_SQL_RE = re.compile(r'(?:\s+|--[^\n]*|/\*.*?\*/)*(create|alter|drop)\b',
+                        re.IGNORECASE | re.DOTALL)
+
+# Wakes up at the next idle deadline to close or ping connections
+scheduler = Scheduler(name='connection_maintain')
+# Runs the statements sent from each view one after another
+engine = ExecutionEngine(name='pgcli_engine')
 completers = {}  # Dict mapping urls to pgcompleter objects
 completer_lock = Lock()
 
-executors = {}  # Dict mapping buffer ids to pgexecutor objects
+completer_metadata = {}  # Dict mapping urls to the metadata of their completer
+# Dict mapping urls to a counter bumped whenever their completer changes
+completer_generations = {}
+completion_caches = {}  # Dict mapping view ids to CompletionCache objects
+# Dict mapping view ids to their latest CompletionRequest
+completion_requests = {}
+completion_executor = None  # Worker computing completions off the UI thread
+
+# pgcli and its dependencies are imported by load_modules
+modules_loaded = False
+modules_lock = Lock()
+preload_started = False
+startup_timings = []  # List of (step, seconds) of loading the plugin
+
+COMPLETION_FLAGS = (
+    sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS
+)
+
+# Dict mapping urls with a running completer refresh to the CatalogChanges
+# requested in the meantime, or None
+completer_refreshes = {}
+
+# Dict mapping view ids to CatalogChanges made in a not yet committed
+# transaction
+pending_catalog_changes = {}
+
+pools = {}  # Dict mapping urls to ConnectionPool objects
+pool_lock = Lock()
+
+# Dict mapping view ids to the pgexecutor objects they hold: borrowed from the
+# pool while a statement runs, pinned while in a transaction
+executors = {}
 executor_lock = Lock()
 
+# Dict mapping view ids to the sets of executors of a running multi-url run
+multi_executors = {}
+
+streams = {}  # Dict mapping buffer ids to open ResultStream objects
+
+statement_indexes = {}  # Dict mapping buffer ids to StatementIndex objects
+
+result_viewers = {}  # Dict mapping view ids to the ResultViewer of their results
+panel_blocks = {}  # Dict mapping output panel ids to offsets of result blocks
+
 recent_urls = []
 
+result_cache = None  # ResultCache of read-only queries, once enabled
+result_cache_lock = Lock()
+
+# Dict mapping urls to the number of ddl statements run on them, prepared
+# statements of older generations may no longer match the schema
+ddl_generations = {}
+
+timing_logs = {}  # Dict mapping paths to TimingLog objects
+histories = {}  # Dict mapping paths to QueryHistory objects
+history_lock = Lock()
+
 
 logger = logging.getLogger('pgcli_sublime')
 
 
 def plugin_loaded():
     global settings
+    start = time.perf_counter()
     settings = sublime.load_settings('PgcliSublime.sublime_settings')
 
     init_logging()
@@ -42,7 +150,7 @@ def plugin_loaded():
 
     # Before we can import pgcli, we need to know its path. We can't know that
     # until we load settings, and we can't load settings until plugin_loaded is
-    # called, which is why we need to import to a global variable here
+    # called, which is why load_modules imports to global variables
 
     sys.path = settings.get('pgcli_dirs') + sys.path
     for sdir in settings.get('pgcli_site_dirs'):
@@ -50,51 +158,94 @@ def plugin_loaded():
 
     logger.debug('System path: %r', sys.path)
 
-    global PGCli, need_completion_refresh, need_search_path_refresh
-    global has_meta_cmd, has_change_path_cmd, has_change_db_cmd, OutputSettings
-    from pgcli.main import (
-        PGCli, has_meta_cmd, has_change_path_cmd, has_change_db_cmd, OutputSettings
-    )
-
-    global PGExecute
-    from pgcli.pgexecute import PGExecute
-
-    global PGCompleter
-    from pgcli.pgcompleter import PGCompleter
+    engine.limit = settings.get('pgcli_queue_limit')
+    engine.on_change = refresh_queue_status
 
-    global special
-    from pgspecial.main import PGSpecial
-    special = PGSpecial()
+    # The worker thread is only started by the first completion request
+    global completion_executor
+    completion_executor = ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix='complete_async')
 
-    global CompletionRefresher
-    from pgcli.completion_refresher import CompletionRefresher
+    startup_timings.append(('plugin_loaded', time.perf_counter() - start))
 
-    global Document
-    from prompt_toolkit.document import Document
+    # pgcli and its dependencies are only imported once a SQL view shows up
+    window = sublime.active_window()
+    view = window.active_view() if window else None
+    if view and is_sql(view):
+        preload_modules()
 
-    global fragment_list_to_text
-    from prompt_toolkit.formatted_text import fragment_list_to_text
 
-    global format_output
-    from pgcli.main import format_output
+@contextmanager
+def timed_import(name):
+    start = time.perf_counter()
+    yield
+    startup_timings.append((name, time.perf_counter() - start))
 
-    global psycopg2
-    import psycopg2
 
-    global ext
-    import psycopg2.extensions as ext
+def load_modules():
+    """Import pgcli and its dependencies, on the first call only
 
-    global sqlparse
-    import sqlparse
-
-    global maintain_job
-    maintain_job = Thread(
-        target=connection_maintain,
-        args=(),
-        name='connection_maintain'
-    )
-    maintain_job.setDaemon(True)
-    maintain_job.start()
+    Everything which runs queries or completions calls this first. The
+    dependencies of pgcli are imported before pgcli itself, so the time of
+    each import in startup_timings is its own.
+    """
+    global modules_loaded
+    if modules_loaded:
+        return
+    with modules_lock:
+        if modules_loaded:
+            return
+        start = time.perf_counter()
+
+        global psycopg2, ext
+        with timed_import('psycopg2'):
+            import psycopg2
+            import psycopg2.extensions as ext
+
+        global sqlparse
+        with timed_import('sqlparse'):
+            import sqlparse
+
+        global Document, fragment_list_to_text
+        with timed_import('prompt_toolkit'):
+            from prompt_toolkit.document import Document
+            from prompt_toolkit.formatted_text import fragment_list_to_text
+
+        global special
+        with timed_import('pgspecial'):
+            from pgspecial.main import PGSpecial
+            special = PGSpecial()
+
+        global PGExecute
+        with timed_import('pgcli.pgexecute'):
+            from pgcli.pgexecute import PGExecute
+
+        global PGCompleter
+        with timed_import('pgcli.pgcompleter'):
+            from pgcli.pgcompleter import PGCompleter
+
+        global PGCli, need_completion_refresh, need_search_path_refresh
+        global has_meta_cmd, has_change_path_cmd, has_change_db_cmd, OutputSettings
+        global format_output
+        with timed_import('pgcli.main'):
+            from pgcli.main import (
+                PGCli, has_meta_cmd, has_change_path_cmd, has_change_db_cmd,
+                OutputSettings, format_output
+            )
+
+        modules_loaded = True
+    logger.info('Imported pgcli in %.1f ms', (time.perf_counter() - start) * 1000)
+
+
+def preload_modules():
+    """Import pgcli in the background, ahead of the first query"""
+    global preload_started
+    if modules_loaded or preload_started:
+        return
+    preload_started = True
+    t = Thread(target=load_modules, name='load_modules')
+    t.setDaemon(True)
+    t.start()
 
 
 def plugin_unloaded():
@@ -107,22 +258,95 @@ def plugin_unloaded():
     global url_requests
     url_requests = queue.Queue()
 
+    # Nothing may keep running or hold connections once the module is gone
+    engine.stop()
+    scheduler.stop()
+    if completion_executor:
+        completion_executor.shutdown(wait=False)
+    for view_id in list(streams):
+        streams.pop(view_id).close()
+    with executor_lock:
+        held = list(executors.values())
+        executors.clear()
+    for executor in held:
+        discard_executor(executor)
+    with pool_lock:
+        for pool in pools.values():
+            pool.close()
+    with history_lock:
+        for history in histories.values():
+            history.close()
+        histories.clear()
+
+
+def idle_timeout(url):
+    """Seconds after which idle connections to url are closed, -1 for never"""
+    timeouts = settings.get('pgcli_idle_timeouts') or {}
+    return timeouts.get(url, settings.get('pgcli_idle_timeout', CLOSE_CONNECT_AFTER_IDLE_TIMEOUT))
+
+
+def schedule_executor_reap(view_id, executor):
+    timeout = idle_timeout(executor.url)
+    if timeout >= 0:
+        scheduler.schedule(('executor', view_id), executor.last_use + timeout,
+                           partial(reap_executor, view_id))
+
+
+def reap_executor(view_id):
+    """Close the executor pinned by a view once it was idle long enough
+
+    Executors in use or in a transaction are left alone, releasing them
+    schedules the next check.
+    """
+    with executor_lock:
+        executor = executors.get(view_id)
+        if (not executor or executor.busy or not executor.conn.closed
+                and executor.conn.get_transaction_status() != ext.TRANSACTION_STATUS_IDLE):
+            return
+        if executor.last_use + idle_timeout(executor.url) > time.time():
+            schedule_executor_reap(view_id, executor)
+            return
+        del executors[view_id]
+    logger.debug('Closing idle connection of view %d', view_id)
+    discard_executor(executor)
+
 
-def connection_maintain():
-    if CLOSE_CONNECT_AFTER_IDLE_TIMEOUT == -1:
+def schedule_pool_maintenance(url):
+    pool = pools.get(url)
+    if pool is None:
         return
-    while True:
-        time.sleep(5)
-        for view_id, e in list(executors.items()):
-            if e.conn.get_transaction_status() == ext.TRANSACTION_STATUS_IDLE:
-                if e.last_use + CLOSE_CONNECT_AFTER_IDLE_TIMEOUT < time.time():
-                    e.conn.close()
-                    del executors[view_id]
+    deadline = pool.next_deadline(idle_timeout(url),
+                                  settings.get('pgcli_keepalive_interval', KEEPALIVE_INTERVAL))
+    if deadline is not None:
+        scheduler.schedule(('pool', url), deadline, partial(maintain_pool, url))
+
+
+def maintain_pool(url):
+    pool = pools.get(url)
+    if pool is None:
+        return
+    timeout = idle_timeout(url)
+    if timeout >= 0:
+        pool.reap(timeout)
+    interval = settings.get('pgcli_keepalive_interval', KEEPALIVE_INTERVAL)
+    if interval:
+        pool.ping(interval)
+    schedule_pool_maintenance(url)
 
 
 class PgcliPlugin(sublime_plugin.EventListener):
     def on_close(self, view):
-        close_connection(view.id())
+        engine.cancel(view.id())
+        close_connection(view)
+        statement_indexes.pop(view.buffer_id(), None)
+        completion_caches.pop(view.id(), None)
+        completion_requests.pop(view.id(), None)
+        viewer = result_viewers.pop(view.id(), None)
+        if viewer:
+            viewer.store.close()
+        for viewer in list(result_viewers.values()):
+            if viewer.view.id() == view.id():
+                close_result_viewer(viewer)
 
     def on_post_save_async(self, view):
         refresh_status(view)
@@ -132,6 +356,8 @@ class PgcliPlugin(sublime_plugin.EventListener):
 
     def on_activated(self, view):
         refresh_status(view)
+        if is_sql(view):
+            preload_modules()
 
     def on_query_completions(self, view, prefix, locations):
         for pattern in settings.get('autocomplete_exclusions', []):
@@ -147,32 +373,47 @@ class PgcliPlugin(sublime_plugin.EventListener):
         if not url:
             return
 
-        with completer_lock:
-            completer = completers.get(url)
-
-        if not completer:
-            return
-
         # Get current query
         text, cursor_pos = get_current_query(view)
         logger.debug('Position: %d Text: %r', cursor_pos, text)
 
-        comps = completer.get_completions(
-            Document(text=text, cursor_position=cursor_pos), None)
+        # Completions only depend on the word before the cursor as long as
+        # the rest of the statement and the completer stay the same
+        word = word_before_cursor(text[:cursor_pos])
+        cache = completion_caches.setdefault(view.id(), CompletionCache())
 
-        if not comps:
-            logger.debug('No completions found')
-            return []
+        # Not waiting for completer_lock, a refresh may hold it for long
+        if url not in completers:
+            return
+        comps = cache.get(completion_context(url, text, cursor_pos, word), word)
 
-        comps = [('{}\t{}'.format(fragment_list_to_text(c.display),
-                                  fragment_list_to_text(c.display_meta)),
-                  c.text)
-                 for c in comps]
-        logger.debug('Found completions: %r', comps)
+        if comps is not None:
+            logger.debug('Narrowed cached completions')
+            return comps, COMPLETION_FLAGS
+
+        # Run the completer on the worker thread, Sublime shows the
+        # completions once they are delivered
+        request = CompletionRequest(view.id(), url, text, cursor_pos, word, cache)
+        completion_requests[view.id()] = request
+        completion_executor.submit(complete_async, request)
+        budget = settings.get('pgcli_completion_latency_budget', 0)
+        if budget:
+            sublime.set_timeout_async(lambda: deliver_partial(request), budget)
+        return request.completion_list
 
-        return comps, (
-                sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS
-        )
+
+class PgcliStatementIndexListener(sublime_plugin.TextChangeListener):
+    def on_text_changed(self, changes):
+        index = statement_indexes.get(self.buffer.id())
+        if index is not None:
+            for change in changes:
+                index.apply_change(change.a.pt, change.b.pt, len(change.str))
+
+    def on_reload(self):
+        statement_indexes.pop(self.buffer.id(), None)
+
+    def on_revert(self):
+        statement_indexes.pop(self.buffer.id(), None)
 
 
 class PgcliSwitchConnectionStringCommand(sublime_plugin.TextCommand):
@@ -204,11 +445,7 @@ class PgcliRunAllCommand(sublime_plugin.TextCommand):
         logger.debug('PgcliRunAllCommand')
         check_pgcli(self.view)
         sql = get_entire_view_text(self.view)
-        t = Thread(target=run_sqls_async,
-                   args=(self.view, [sql]),
-                   name='run_sqls_async')
-        t.setDaemon(True)
-        t.start()
+        submit_job(self.view, run_script_async, sql)
 
 
 class PgcliRunCurrentCommand(sublime_plugin.TextCommand):
@@ -228,12 +465,8 @@ class PgcliRunCurrentCommand(sublime_plugin.TextCommand):
             # Nothing highlighted - find the current query
             sql, _ = get_current_query(self.view)
 
-        # Run the sql in a separate thread
-        t = Thread(target=run_sqls_async,
-                   args=(self.view, [sql]),
-                   name='run_sqls_async')
-        t.setDaemon(True)
-        t.start()
+        # Run the sql after the statements already queued for the view
+        submit_job(self.view, run_sqls_async, [sql])
 
 
 class PgcliCancelExecuteCommand(sublime_plugin.TextCommand):
@@ -244,23 +477,20 @@ class PgcliCancelExecuteCommand(sublime_plugin.TextCommand):
         logger.debug('PgcliCancelExecuteCommand')
         panel = get_output_panel(self.view)
 
-        executor = executors.get(self.view.id(), None)
-        if executor:
-            if executor.conn.get_transaction_status() == ext.TRANSACTION_STATUS_ACTIVE:
-                try:
-                    executor.conn.cancel()
-                    out = 'send cancel signal to server\n\n'
-                except Exception as e:
-                    out = 'Error: ' + str(e)
-            elif executor.conn.get_transaction_status() == ext.TRANSACTION_STATUS_INTRANS:
-                out = 'no running commands for cancel\n'
-                out += 'but connection is "idle in transaction"!!!\n'
-                out += 'use commit/rollback for stop transaction\n\n'
-            else:
-                out = 'no running commands for cancel\n\n'
+        job, dropped = engine.cancel(self.view.id())
+        if job:
+            out = 'send cancel signal to server\n'
+            job.future.add_done_callback(partial(report_cancelled, panel, time.time()))
         else:
-            out = 'connections closed\n\n'
-        panel.run_command('append', {'characters': out})
+            executor = executors.get(self.view.id(), None)
+            out = 'no running commands for cancel\n'
+            if (executor and not executor.conn.closed
+                    and executor.conn.get_transaction_status() == ext.TRANSACTION_STATUS_INTRANS):
+                out += 'but connection is "idle in transaction"!!!\n'
+                out += 'use commit/rollback for stop transaction\n'
+        if dropped:
+            out += 'dropped {} queued commands\n'.format(dropped)
+        panel.run_command('append', {'characters': out + '\n'})
 
 
 class PgcliCloseConnectionCommand(sublime_plugin.TextCommand):
@@ -269,18 +499,69 @@ class PgcliCloseConnectionCommand(sublime_plugin.TextCommand):
 
     def run(self, edit):
         logger.debug('PgcliCloseConnectionCommand')
-        panel = get_output_panel(self.view)
+        # The connection is closed once the cancelled statements really stopped
+        engine.cancel(self.view.id())
+        submit_job(self.view, close_connection_async)
 
-        executor = executors.get(self.view.id(), None)
-        if executor:
-            if executor.conn.get_transaction_status() == ext.TRANSACTION_STATUS_ACTIVE:
-                executor.conn.cancel()
-                time.sleep(0.2)
-            close_connection(self.view)
-            out = 'connection closed\n\n'
-        else:
-            out = 'no opened connection\n\n'
-        panel.run_command('append', {'characters': out})
+
+class PgcliFetchMoreCommand(sublime_plugin.TextCommand):
+    def description(self):
+        return 'Fetch the next page of the streamed query result'
+
+    def run(self, edit):
+        logger.debug('PgcliFetchMoreCommand')
+        submit_job(self.view, fetch_more_async)
+
+
+class PgcliResultPageCommand(sublime_plugin.TextCommand):
+    def description(self):
+        return 'Show another page of the result view'
+
+    def is_enabled(self):
+        return find_result_viewer(self.view) is not None
+
+    def run(self, edit, pages=1):
+        logger.debug('PgcliResultPageCommand')
+        viewer = find_result_viewer(self.view)
+        if viewer:
+            viewer.show(viewer.offset + pages * viewer.page_size)
+
+
+class PgcliResultGotoRowCommand(sublime_plugin.TextCommand):
+    def description(self):
+        return 'Show the page of the result view starting at a row'
+
+    def is_enabled(self):
+        return find_result_viewer(self.view) is not None
+
+    def run(self, edit):
+        logger.debug('PgcliResultGotoRowCommand')
+        viewer = find_result_viewer(self.view)
+        if not viewer:
+            return
+
+        def on_done(row):
+            try:
+                viewer.show(int(row) - 1)
+            except ValueError:
+                sublime.status_message('Not a row number: {}'.format(row))
+
+        self.view.window().show_input_panel(
+            'Go to row (1-{}):'.format(viewer.store.rowcount), '', on_done, None, None)
+
+
+class PgcliRenderResultCommand(sublime_plugin.TextCommand):
+    def run(self, edit, characters):
+        self.view.set_read_only(False)
+        self.view.replace(edit, sublime.Region(0, self.view.size()), characters)
+        self.view.set_read_only(True)
+        self.view.sel().clear()
+        self.view.sel().add(sublime.Region(0))
+
+
+class PgcliEraseOutputCommand(sublime_plugin.TextCommand):
+    def run(self, edit, end):
+        self.view.erase(edit, sublime.Region(0, end))
 
 
 class PgcliRunCurrentOnCommand(sublime_plugin.TextCommand):
@@ -316,33 +597,16 @@ class PgcliRunCurrentOnCommand(sublime_plugin.TextCommand):
             # Nothing highlighted - find the current query
             sql, _ = get_current_query(self.view)
 
-        # Run the sql in a separate thread
-        t = Thread(target=run_sqls_async,
-                   args=(self.view, [sql]),
-                   name='run_sqls_async')
-        t.setDaemon(True)
-        t.start()
+        # Run the sql after the statements already queued for the view
+        submit_job(self.view, run_sqls_async, [sql])
 
 
 class PgcliRunCurrentOnMultiCommand(sublime_plugin.TextCommand):
     def description(self):
         return 'Run the current selection on defined connections'
 
-    def run(self, edit, urls):
-        logger.debug('PgcliRunCurrentOnCommand')
-        panel = get_output_panel(self.view)
-        original_url = get(self.view, 'pgcli_url')
-
-        executor = executors.get(self.view.id(), None)
-        if executor:
-            if executor.conn.get_transaction_status() == ext.TRANSACTION_STATUS_ACTIVE:
-                out = 'connection processing sql-command; you need cancel it before\n\n'
-                panel.run_command('append', {'characters': out})
-                return
-            if executor.conn.get_transaction_status() == ext.TRANSACTION_STATUS_INTRANS:
-                out = 'connection in transaction; you need commit/rollback before\n\n'
-                panel.run_command('append', {'characters': out})
-                return
+    def run(self, edit, urls, benchmark=False, runs=None):
+        logger.debug('PgcliRunCurrentOnMultiCommand')
 
         # Note that there can be multiple selections
         sel = self.view.sel()
@@ -353,12 +617,13 @@ class PgcliRunCurrentOnMultiCommand(sublime_plugin.TextCommand):
             # Nothing highlighted - find the current query
             sql, _ = get_current_query(self.view)
 
-        # Run the sql in a separate thread
-        t = Thread(target=run_sqls_on_multi_connections_async,
-                   args=(self.view, [sql], urls, original_url),
-                   name='run_sqls_on_multi_connections_async')
-        t.setDaemon(True)
-        t.start()
+        if benchmark:
+            submit_job(self.view, benchmark_on_multi_connections_async, sql, urls,
+                       runs or get(self.view, 'pgcli_benchmark_runs'))
+            return
+
+        # Run the sql after the statements already queued for the view
+        submit_job(self.view, run_sqls_on_multi_connections_async, [sql], urls)
 
 
 class PgcliRunMacrosCommand(sublime_plugin.TextCommand):
@@ -388,24 +653,27 @@ class PgcliRunMacrosCommand(sublime_plugin.TextCommand):
             sql, _ = get_current_query(self.view)
             selections = [strip_query(sql)]
 
-        sql = [macros.format(selection=selection)
-               for selection in selections]
-        if not sql:
+        if not selections:
             return
 
-        # Run the sql in a separate thread
-        t = Thread(target=run_sqls_async,
-                   args=(self.view, sql),
-                   name='run_sqls_async')
-        t.setDaemon(True)
-        t.start()
+        # Run the sql after the statements already queued for the view
+        if '%(selection)s' in macros:
+            # The selections are bound as parameters, so the statement is
+            # the same each time and runs as a prepared statement
+            submit_job(self.view, run_sqls_async, [macros] * len(selections), False,
+                       [{'selection': selection} for selection in selections])
+            return
+        # The statements of the selections are independent, so they are batched
+        sql = [macros.format(selection=selection)
+               for selection in selections]
+        submit_job(self.view, run_sqls_async, sql, True)
 
 
 class PgcliExplainCurrentCommand(sublime_plugin.TextCommand):
     def description(self):
         return 'Run the current selection or line as a query'
 
-    def run(self, edit):
+    def run(self, edit, analyze=False):
         logger.debug('PgcliRunCurrentCommand')
         check_pgcli(self.view)
 
@@ -418,14 +686,192 @@ class PgcliExplainCurrentCommand(sublime_plugin.TextCommand):
             # Nothing highlighted - find the current query
             sql, _ = get_current_query(self.view)
 
+        if analyze:
+            submit_job(self.view, explain_analyze_async, sql)
+            return
+
         sql = 'explain ' + sql
 
-        # Run the sql in a separate thread
-        t = Thread(target=run_sqls_async,
-                   args=(self.view, [sql]),
-                   name='run_sqls_async')
-        t.setDaemon(True)
-        t.start()
+        # Run the sql after the statements already queued for the view
+        submit_job(self.view, run_sqls_async, [sql])
+
+
+class PgcliExportCurrentCommand(sublime_plugin.TextCommand):
+    def description(self):
+        return 'Export the result of the current selection or query to a file'
+
+    def run(self, edit, fmt=None, path=None):
+        logger.debug('PgcliExportCurrentCommand')
+        formats = sorted(EXPORT_FORMATS)
+        if fmt not in EXPORT_FORMATS:
+            def on_format(index):
+                if index >= 0:
+                    self.view.run_command('pgcli_export_current',
+                                          {'fmt': formats[index], 'path': path})
+            self.view.window().show_quick_panel(formats, on_format)
+            return
+
+        if not path:
+            # Next to the sql file by default
+            base = self.view.file_name() or os.path.join(os.path.expanduser('~'), 'export')
+            default = os.path.splitext(base)[0] + EXPORT_FORMATS[fmt]
+
+            def on_path(path):
+                if path:
+                    self.view.run_command('pgcli_export_current', {'fmt': fmt, 'path': path})
+            self.view.window().show_input_panel('Export to:', default, on_path, None, None)
+            return
+
+        check_pgcli(self.view)
+
+        # Note that there can be multiple selections
+        sel = self.view.sel()
+        contents = [self.view.substr(reg) for reg in sel]
+        sql = '\n'.join(contents)
+
+        if not sql and len(sel) == 1:
+            # Nothing highlighted - find the current query
+            sql, _ = get_current_query(self.view)
+
+        # Run the export after the statements already queued for the view
+        submit_job(self.view, export_async, sql, fmt, os.path.expanduser(path))
+
+
+class PgcliLoadIntoTableCommand(sublime_plugin.TextCommand):
+    def description(self):
+        return 'Load the view or a csv/tsv file into a table'
+
+    def run(self, edit, table=None, path=None, source='view'):
+        logger.debug('PgcliLoadIntoTableCommand')
+        if source == 'file' and not path:
+            def on_path(path):
+                if path:
+                    self.view.run_command('pgcli_load_into_table',
+                                          {'table': table, 'path': path, 'source': source})
+            default = os.path.dirname(self.view.file_name() or '') or os.path.expanduser('~')
+            self.view.window().show_input_panel(
+                'Load file:', default + os.sep, on_path, None, None)
+            return
+
+        file_name = path if source == 'file' else self.view.file_name()
+        if not table:
+            def on_table(table):
+                if table:
+                    self.view.run_command('pgcli_load_into_table',
+                                          {'table': table, 'path': path, 'source': source})
+            default = os.path.splitext(os.path.basename(file_name or ''))[0]
+            self.view.window().show_input_panel(
+                'Load into table:', default, on_table, None, None)
+            return
+
+        # The target table is on the connection of the view the command runs in
+        check_pgcli(self.view)
+        if source == 'file':
+            lines = None
+            path = os.path.expanduser(path)
+        else:
+            lines = iter_lines(get_entire_view_text(self.view))
+
+        # Run the load after the statements already queued for the view
+        submit_job(self.view, load_async, table, lines, path, load_format(file_name))
+
+
+class PgcliQueryStatsCommand(sublime_plugin.TextCommand):
+    def description(self):
+        return 'Show latency percentiles of the current query from the history'
+
+    def run(self, edit):
+        logger.debug('PgcliQueryStatsCommand')
+        panel = get_output_panel(self.view)
+        sublime.active_window().run_command('pgcli_show_output_panel')
+        history = query_history()
+        if not history:
+            panel.run_command('append', {'characters': 'query history is off\n\n'})
+            return
+
+        sql, _ = get_current_query(self.view)
+        caption = url_caption(get(self.view, 'pgcli_url'))
+        count, percentiles = history.percentiles(caption, sql, (50, 95, 99))
+        if count:
+            out = '-- {} runs on {}: {}\n\n'.format(count, caption, ', '.join(
+                'p{} {:.3f} ms'.format(p, ms) for p, ms in sorted(percentiles.items())))
+        else:
+            out = '-- no runs of the current query on {}\n\n'.format(caption)
+        panel.run_command('append', {'characters': out})
+
+
+class PgcliSlowestQueriesCommand(sublime_plugin.TextCommand):
+    def description(self):
+        return 'Show the slowest queries from the history'
+
+    def run(self, edit, days=7, limit=20):
+        logger.debug('PgcliSlowestQueriesCommand')
+        panel = get_output_panel(self.view)
+        start_result_block(panel)
+        sublime.active_window().run_command('pgcli_show_output_panel')
+        history = query_history()
+        if not history:
+            panel.run_command('append', {'characters': 'query history is off\n\n'})
+            return
+
+        rows = history.slowest(time.time() - days * 24 * 3600, limit)
+        out = '-- {} slowest queries of the last {} days\n'.format(len(rows), days)
+        for ts, url, duration_ms, row_count, error, statement in rows:
+            out += '{:>12.3f} ms  {:%Y-%m-%d %H:%M}  {}  {}{}\n'.format(
+                duration_ms, datetime.datetime.fromtimestamp(ts), url,
+                'error: ' if error else '', ' '.join(statement.split())[:200])
+        panel.run_command('append', {'characters': out + '\n'})
+
+
+class PgcliStartupReportCommand(sublime_plugin.TextCommand):
+    def description(self):
+        return 'Show how long loading the plugin and importing pgcli took'
+
+    def run(self, edit):
+        logger.debug('PgcliStartupReportCommand')
+        panel = get_output_panel(self.view)
+        start_result_block(panel)
+        sublime.active_window().run_command('pgcli_show_output_panel')
+        out = '-- startup: {:.1f} ms in total{}\n'.format(
+            sum(seconds for _, seconds in startup_timings) * 1000,
+            '' if modules_loaded else ', pgcli not imported yet')
+        for step, seconds in startup_timings:
+            out += '{:>12.1f} ms  {}\n'.format(seconds * 1000, step)
+        panel.run_command('append', {'characters': out + '\n'})
+
+
+class PgcliBenchmarkFormatterCommand(sublime_plugin.TextCommand):
+    def description(self):
+        return 'Compare the speed of the table formatters on generated rows'
+
+    def run(self, edit, rows=50000, columns=8):
+        logger.debug('PgcliBenchmarkFormatterCommand')
+        submit_job(self.view, benchmark_formatter_async, rows, columns)
+
+
+class PgcliBenchmarkCurrentCommand(sublime_plugin.TextCommand):
+    def description(self):
+        return 'Benchmark the current selection or query'
+
+    def run(self, edit, iterations=None, warmup=None, concurrency=None, params=None):
+        logger.debug('PgcliBenchmarkCurrentCommand')
+        check_pgcli(self.view)
+
+        # Note that there can be multiple selections
+        sel = self.view.sel()
+        contents = [self.view.substr(reg) for reg in sel]
+        sql = '\n'.join(contents)
+
+        if not sql and len(sel) == 1:
+            # Nothing highlighted - find the current query
+            sql, _ = get_current_query(self.view)
+
+        # Run the benchmark after the statements already queued for the view
+        submit_job(self.view, benchmark_async, sql,
+                   iterations or get(self.view, 'pgcli_benchmark_iterations'),
+                   warmup if warmup is not None else get(self.view, 'pgcli_benchmark_warmup'),
+                   concurrency or get(self.view, 'pgcli_benchmark_concurrency'),
+                   params)
 
 
 class PgcliDescribeTable(sublime_plugin.TextCommand):
@@ -467,13 +913,7 @@ class PgcliDescribeTable(sublime_plugin.TextCommand):
         sel = (fix_region(r) for r in self.view.sel())
         tbls = ((self.view.substr(reg), is_func(reg)) for reg in sel)
         sqls = (('\\df+ ' if f else '\\d+ ') + n for n, f in tbls)
-        t = Thread(
-            target=run_sqls_async,
-            args=(self.view, sqls),
-            name='run_sqls_async'
-        )
-        t.setDaemon(True)
-        t.start()
+        submit_job(self.view, run_sqls_async, sqls)
 
 
 class PgcliShowOutputPanelCommand(sublime_plugin.TextCommand):
@@ -557,21 +997,14 @@ def get_current_query(view):
     text = get_entire_view_text(view)
     cursor_pos = view.sel()[0].begin()
 
-    # Parse sql
-    stack = sqlparse.engine.FilterStack()
-    stack.split_statements = True
-    cum_len = 0
-    current_query = ""
-    for query in stack.run(text):
-        current_query = str(query)
-        cum_len += len(current_query)
-        if cursor_pos <= cum_len:
-            break
-
-    # calculate cursor position in query
-    query_cursor_pos = len(current_query) - (cum_len - cursor_pos)
+    # Statement boundaries are indexed once per buffer and then kept up to
+    # date by PgcliStatementIndexListener
+    index = statement_indexes.get(view.buffer_id())
+    if index is None:
+        index = statement_indexes[view.buffer_id()] = StatementIndex()
+    begin, end = index.statement_at(text, cursor_pos)
 
-    return current_query, query_cursor_pos
+    return text[begin:end], cursor_pos - begin
 
 
 def init_logging():
@@ -603,57 +1036,226 @@ def is_sql(view):
 
 
 def check_pgcli(view):
-    """Check if a pgcli connection for the view exists, or request one"""
+    """Check if a pgcli connection for the view's url can be made"""
 
     if not is_sql(view):
         refresh_status(view, '')
         return
 
+    url = get(view, 'pgcli_url')
+    if not url:
+        refresh_status(view)
+        logger.debug('Empty pgcli url %r', url)
+        return
+
+    load_modules()
+
+    # Make sure we have a completer for the corresponding url. It is loaded
+    # from the metadata cache first, so it doesn't wait for the connection.
+    with completer_lock:
+        need_new_completer = url not in completers
+        if need_new_completer:
+            completers[url] = PGCompleter()  # Empty placeholder
+    if need_new_completer:
+        refresh_completer(url, use_cache=True)
+
+    pool = get_pool(url)
+    if pool.size:
+        return
+
     error = None
+    refresh_status(view, 'Connecting: ' + url)
+    logger.debug('Connecting to %r', url)
+    try:
+        executor = pool.checkout(POOL_CHECKOUT_TIMEOUT)
+        pool.checkin(executor)
+        refresh_status(view)
+    except Exception as e:
+        error = e
+        logger.error('Error connecting to pgcli')
+        logger.error('traceback: %s', traceback.format_exc())
+        status = 'ERROR CONNECTING TO {}'.format(url)
+        refresh_status(view, status)
+    return error
+
+
+def get_pool(url):
+    with pool_lock:
+        pool = pools.get(url)
+        if pool is None:
+            pool = pools[url] = ConnectionPool(
+                lambda: new_executor(url),
+                min_size=settings.get('pgcli_pool_min_size', 1),
+                max_size=settings.get('pgcli_pool_max_size', 10),
+                on_checkin=partial(schedule_pool_maintenance, url))
+        return pool
+
+
+def acquire_executor(view):
+    """Returns the executor to run a statement for the view
+
+    A view which holds a pinned connection keeps using it, otherwise a
+    connection is borrowed from the pool of the view's url until
+    release_executor is called. Executors in use are never closed for being
+    idle.
+    """
     with executor_lock:
-        view_id = view.id()
-        if view_id not in executors:
-            url = get(view, 'pgcli_url')
+        executor = executors.get(view.id())
+        if executor:
+            executor.busy += 1
+            return executor
 
-            if not url:
-                refresh_status(view)
-                logger.debug('Empty pgcli url %r', url)
-            else:
-                # Make a new executor connection
-                refresh_status(view, 'Connecting: ' + url)
-                logger.debug('Connecting to %r', url)
+    executor = get_pool(get(view, 'pgcli_url')).checkout(POOL_CHECKOUT_TIMEOUT)
+    with executor_lock:
+        held = executors.setdefault(view.id(), executor)
+        held.busy += 1
+    if held is not executor:
+        pools[executor.url].checkin(executor)
+    return held
 
-                try:
-                    executor = new_executor(url)
-                    executors[view_id] = executor
-                    refresh_status(view)
-                except Exception as e:
-                    error = e
-                    logger.error('Error connecting to pgcli')
-                    logger.error('traceback: %s', traceback.format_exc())
-                    executor = None
-                    status = 'ERROR CONNECTING TO {}'.format(url)
-                    refresh_status(view, status)
-
-                # Make sure we have a completer for the corresponding url
-                with completer_lock:
-                    need_new_completer = executor and url not in completers
-                    if need_new_completer:
-                        completers[url] = PGCompleter()  # Empty placeholder
-
-                if need_new_completer:
-                    refresher = CompletionRefresher()
-                    refresher.refresh(executor, special=special, callbacks=(
-                        lambda c: swap_completer(c, url)))
-    return error
 
+def checkout_executor(view, panel):
+    """acquire_executor, showing in the panel why it failed
 
-def close_connection(view):
-    view_id = view.id()
-    if view_id in executors:
-        executor = executors.pop(view_id)
+    Returns None when the view's url can't be connected to.
+    """
+    try:
+        return acquire_executor(view)
+    except Exception as e:
+        out = '%s: %s\n\n' % (e.__class__.__name__, e)
+        panel.run_command('append', {'characters': out})
+        refresh_status(view, 'ERROR CONNECTING TO {}'.format(get(view, 'pgcli_url')))
+        return None
+
+
+@contextmanager
+def holding_executor(view, executor, panel):
+    """Releases the acquired executor however the block is left
+
+    Errors the block doesn't handle by itself are shown in the panel rather
+    than only in the log of the job which ran it.
+    """
+    try:
+        yield executor
+    except Exception as e:
+        logger.exception('Error using executor of %s', executor.url)
+        out = '%s: %s\n\n' % (e.__class__.__name__, e)
+        panel.run_command('append', {'characters': out})
+    finally:
+        release_executor(view, executor)
+
+
+def release_executor(view, executor):
+    """Give a borrowed executor back to its pool
+
+    The view keeps the connection pinned while it is in a transaction, holds
+    an open result stream, or has changed session state. Nested acquires are
+    released by the outermost release.
+    """
+    with executor_lock:
+        executor.busy -= 1
+        if executor.busy:
+            return  # Still held by an outer caller
+    executor.last_use = time.time()
+    if not executor.conn.closed:
+        status = executor.conn.get_transaction_status()
+        if (status != ext.TRANSACTION_STATUS_IDLE
+                or executor.pinned
+                or view.id() in streams):
+            if status == ext.TRANSACTION_STATUS_IDLE:
+                schedule_executor_reap(view.id(), executor)
+            # Views holding a connection don't use up the pool for the others
+            pools[executor.url].pin(executor)
+            return
+
+    with executor_lock:
+        if executors.get(view.id()) is not executor:
+            return  # Closed in the meantime
+        del executors[view.id()]
+    pools[executor.url].checkin(executor)
+
+
+def discard_executor(executor):
+    pool = pools.get(executor.url)
+    if pool:
+        pool.discard(executor)
+    else:
         executor.conn.close()
+
+
+def close_connection(view):
+    close_stream(view)
+    # Catalog changes of an open transaction are rolled back
+    pending_catalog_changes.pop(view.id(), None)
+    with executor_lock:
+        executor = executors.pop(view.id(), None)
+    if executor:
+        discard_executor(executor)
+        refresh_status(view)
+
+
+def close_connection_async(view):
+    panel = get_output_panel(view)
+    if view.id() in executors:
+        close_connection(view)
+        out = 'connection closed\n\n'
+    else:
+        out = 'no opened connection\n\n'
+
+    # Idle pooled connections are reopened on demand by any view
+    pool = pools.get(get(view, 'pgcli_url'))
+    if pool and pool.close_idle():
+        out = 'connection closed\n\n'
         refresh_status(view)
+    panel.run_command('append', {'characters': out})
+
+
+def submit_job(view, target, *args):
+    """Queue target(view, *args) after the commands already queued for the view
+
+    Commands of a view never run at the same time, so they can't interleave
+    on its connection. pgcli_queue_policy decides what happens to queued
+    commands of the same kind, at most pgcli_queue_limit commands are
+    accepted. They are cancelled after pgcli_statement_timeout.
+    """
+    load_modules()
+    timeout = get(view, 'pgcli_statement_timeout')
+    try:
+        return engine.submit(view.id(), target, view, *args,
+                             policy=get(view, 'pgcli_queue_policy'),
+                             name=target.__name__,
+                             cancel=partial(cancel_queries, view),
+                             timeout=timeout or None,
+                             on_timeout=partial(report_timeout, view, timeout))
+    except QueueFull as e:
+        out = 'queue full: {}, cancel or wait for them\n\n'.format(e)
+        get_output_panel(view).run_command('append', {'characters': out})
+
+
+def cancel_queries(view):
+    """Cancel the queries running on the view's connections"""
+    executor = executors.get(view.id())
+    running = list(multi_executors.get(view.id(), ()))
+    if executor:
+        running.append(executor)
+    for executor in running:
+        try:
+            if executor.conn.get_transaction_status() == ext.TRANSACTION_STATUS_ACTIVE:
+                executor.conn.cancel()
+        except Exception as e:
+            logger.debug('Error cancelling %r: %r', executor.url, e)
+
+
+def report_timeout(view, timeout):
+    out = 'cancelling after statement timeout of {} s\n\n'.format(timeout)
+    get_output_panel(view).run_command('append', {'characters': out})
+
+
+def report_cancelled(panel, start, future):
+    out = 'cancelled, connection ready after {:.6} ms\n\n'.format(
+        (time.time() - start) * 1000)
+    panel.run_command('append', {'characters': out})
+
 
 def refresh_status(view, status=None):
     if status is None:
@@ -663,14 +1265,237 @@ def refresh_status(view, status=None):
         else:
             user, _, host, _, dbname = parse_url(url)
             status = f'{user}@{host}/{dbname}'
-            if view.id() not in executors:
+            pool = pools.get(url)
+            if view.id() not in executors and not (pool and pool.size):
                 status += ' (closed)'
     view.set_status('pgcli', status)
+    refresh_queue_status(view.id())
 
 
-def swap_completer(new_completer, url):
+def refresh_queue_status(view_id):
+    """Show the number of commands running and queued for the view"""
+    view = sublime.View(view_id)
+    if not view.is_valid():
+        return
+    depth = engine.depth(view_id)
+    if depth > 1:
+        view.set_status('pgcli_queue', 'running, {} queued'.format(depth - 1))
+    elif depth:
+        view.set_status('pgcli_queue', 'running')
+    else:
+        view.erase_status('pgcli_queue')
+
+
+def swap_completer(new_completer, url, metadata=None):
     with completer_lock:
         completers[url] = new_completer
+        completer_metadata[url] = metadata
+        completer_generations[url] = completer_generations.get(url, 0) + 1
+
+
+def refresh_completer(url, use_cache=False, changes=None):
+    """Rebuild the completer for url in the background
+
+    With use_cache, the completer is first built from the on-disk metadata
+    cache and then revalidated against the database. With changes (a
+    CatalogChanges), only the changed objects are read again and patched
+    into the live completer. Refreshes requested while one is running for the
+    same url are merged into one more run.
+    """
+    if changes is None:
+        changes = CatalogChanges()
+        changes.full = True
+
+    with completer_lock:
+        if url in completer_refreshes:
+            if completer_refreshes[url] is None:
+                completer_refreshes[url] = changes
+            else:
+                completer_refreshes[url].update(changes)
+            return
+        completer_refreshes[url] = None
+
+    t = Thread(target=refresh_completer_async,
+               args=(url, use_cache, changes),
+               name='refresh_completer_async')
+    t.setDaemon(True)
+    t.start()
+
+
+def refresh_completer_async(url, use_cache, changes):
+    cache_dir = metadata_cache_dir()
+    loaded = False
+    if use_cache and cache_dir:
+        metadata = read_cache(cache_dir, url)
+        if metadata:
+            swap_completer(build_completer(metadata, special), url, metadata)
+            loaded = True
+
+    pool = get_pool(url)
+    while True:
+        try:
+            executor = pool.checkout(POOL_CHECKOUT_TIMEOUT)
+            try:
+                metadata = completer_metadata.get(url)
+                if (changes.full or not metadata
+                        or not refresh_catalog_changes(executor, url, metadata, changes)):
+                    metadata = load_metadata(executor)
+                    swap_completer(build_completer(metadata, special), url, metadata)
+            finally:
+                pool.checkin(executor)
+            loaded = True
+            if cache_dir:
+                write_cache(cache_dir, url, metadata)
+        except Exception:
+            logger.error('Error refreshing completions for %r', url)
+            logger.error('traceback: %s', traceback.format_exc())
+            if not loaded:
+                # Drop the placeholder, so the next check_pgcli tries again
+                with completer_lock:
+                    completers.pop(url, None)
+
+        with completer_lock:
+            changes = completer_refreshes[url]
+            if changes is None:
+                del completer_refreshes[url]
+                return
+            completer_refreshes[url] = None
+
+
+def refresh_catalog_changes(executor, url, metadata, changes):
+    """Patch changed objects into the completer, returns False on failure"""
+    logger.debug('Refreshing completions for %r', sorted(changes.relations))
+    try:
+        patch = fetch_changes(executor, metadata, changes)
+        with completer_lock:
+            patch_metadata(metadata, patch)
+            patch_completer(completers[url], patch)
+            completer_generations[url] = completer_generations.get(url, 0) + 1
+    except Exception:
+        logger.warning('Incremental completion refresh failed, doing a full one')
+        logger.debug('traceback: %s', traceback.format_exc())
+        return False
+    return True
+
+
+def update_catalog(view, executor, sql):
+    """Refresh the completer for the objects sql changed
+
+    Changes made inside a transaction are only visible to other connections
+    once committed, so they are collected until the transaction ends.
+    """
+    changes = catalog_changes(sql)
+    pending = pending_catalog_changes.pop(view.id(), None)
+    if pending:
+        pending.update(changes)
+        changes = pending
+    if not changes:
+        return
+
+    if (not executor.conn.closed
+            and executor.conn.get_transaction_status() in (
+                ext.TRANSACTION_STATUS_INTRANS, ext.TRANSACTION_STATUS_INERROR)):
+        pending_catalog_changes[view.id()] = changes
+        return
+
+    logger.debug('Need completions refresh')
+    refresh_completer(get(view, 'pgcli_url'), changes=changes)
+
+
+def completion_context(url, text, cursor_pos, word):
+    """Everything the completions depend on besides the word"""
+    return (url, completer_generations.get(url),
+            text[:cursor_pos - len(word)], text[cursor_pos:])
+
+
+class CompletionRequest:
+    def __init__(self, view_id, url, text, cursor_pos, word, cache):
+        self.view_id = view_id
+        self.url = url
+        self.text = text
+        self.cursor_pos = cursor_pos
+        self.word = word
+        self.cache = cache
+        self.created = time.time()
+        self.completion_list = sublime.CompletionList()
+        self.delivered = False
+        self.lock = Lock()
+
+    def deliver(self, comps):
+        """Hand comps to Sublime, unless something was delivered already"""
+        with self.lock:
+            if self.delivered:
+                return False
+            self.delivered = True
+        self.completion_list.set_completions(comps, COMPLETION_FLAGS)
+        return True
+
+    @property
+    def superseded(self):
+        return completion_requests.get(self.view_id) is not self
+
+
+def complete_async(request):
+    # Wait for the typing to pause, newer keystrokes cancel this request
+    delay = request.created + settings.get('pgcli_completion_debounce', 0) / 1000 - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    if request.superseded:
+        request.deliver([])
+        return
+
+    # The completer runs without completer_lock, which on_query_completions
+    # and deliver_partial would otherwise wait for. A refresh swaps in a new
+    # completer or patches this one and bumps the generation in the context,
+    # so results of a completer changed meanwhile are never looked up again.
+    document = Document(text=request.text, cursor_position=request.cursor_pos)
+    for attempt in range(2):
+        with completer_lock:
+            completer = completers.get(request.url)
+            context = completion_context(
+                request.url, request.text, request.cursor_pos, request.word)
+        if not completer:
+            request.deliver([])
+            return
+        try:
+            found = completer.get_completions(document, None)
+            break
+        except RuntimeError:
+            # Patched while it was iterating over its metadata
+            if attempt:
+                logger.exception('Error completing %r', request.word)
+                request.deliver([])
+                return
+
+    # Formatted once, narrowing reuses the tuples
+    items = [(c.text,
+              ('{}\t{}'.format(fragment_list_to_text(c.display),
+                               fragment_list_to_text(c.display_meta)),
+               c.text))
+             for c in found]
+    comps = request.cache.put(context, request.word, items)
+
+    logger.debug('Found %d completions in %.3fs',
+                 len(comps), time.time() - request.created)
+    if request.superseded:
+        request.deliver([])
+    elif not request.deliver(comps):
+        logger.debug('Completions missed the latency budget, cached for the next keystroke')
+
+
+def deliver_partial(request):
+    """Deliver the completions cached so far once the latency budget is spent"""
+    if request.delivered:
+        return
+    comps = request.cache.candidates(request.word)
+    if request.deliver(comps):
+        logger.debug('Latency budget spent, delivered %d cached completions', len(comps))
+
+
+def metadata_cache_dir():
+    if not settings.get('pgcli_metadata_cache'):
+        return None
+    return os.path.join(sublime.cache_path(), 'PgcliSublime', 'metadata')
 
 
 def get(view, key):
@@ -692,6 +1517,34 @@ def get_output_panel(view):
     return view.window().create_output_panel(output_panel_name(view))
 
 
+def start_result_block(panel):
+    """Mark where the next result starts, evicting the oldest results
+
+    Long panels slow down every later append, so only the last
+    pgcli_panel_max_results results, up to pgcli_panel_max_chars characters,
+    are kept.
+    """
+    size = panel.size()
+    blocks = [pos for pos in panel_blocks.get(panel.id(), [0]) if pos <= size]
+    if not blocks or blocks[-1] != size:
+        blocks.append(size)
+
+    max_results = settings.get('pgcli_panel_max_results', 0)
+    max_chars = settings.get('pgcli_panel_max_chars', 0)
+    evict = 0
+    # The block just started is never evicted
+    while evict < len(blocks) - 1 and (
+            (max_results and len(blocks) - evict > max_results)
+            or (max_chars and size - blocks[evict] > max_chars)):
+        evict += 1
+    end = blocks[evict]
+    if end:
+        logger.debug('Evicting %d results from the output panel', evict)
+        panel.run_command('pgcli_erase_output', {'end': end})
+        blocks = [pos - end for pos in blocks[evict:]]
+    panel_blocks[panel.id()] = blocks
+
+
 def format_results(results, table_format):
     out = []
 
@@ -702,6 +1555,13 @@ def format_results(results, table_format):
     return '\n\n'.join(out)
 
 
+def url_caption(url):
+    user, _, host, port, dbname = parse_url(url)
+    if port:
+        host = '{}:{}'.format(host, port)
+    return '{}@{}/{}'.format(user, host, dbname)
+
+
 def parse_url(url):
     uri = urlparse(url)
     database = uri.path[1:]  # ignore the leading fwd slash
@@ -711,90 +1571,1235 @@ def parse_url(url):
 def new_executor(url):
     user, password, host, port, dbname = parse_url(url)
     dsn = None  # todo: what is this for again
-    executor = PGExecute(dbname, user, password, host, port, dsn, connect_timeout=10)
+    # TCP keepalives detect connections dropped by firewalls in between
+    keepalive = settings.get('pgcli_keepalive_interval', KEEPALIVE_INTERVAL)
+    executor = PGExecute(dbname, user, password, host, port, dsn, connect_timeout=10,
+                         keepalives=1 if keepalive else 0, keepalives_idle=keepalive)
     executor.last_use = time.time()
+    executor.last_ping = 0
+    executor.busy = 0  # Number of statements running on it
+    executor.url = url
+    executor.pinned = False  # Set once the session has state of its own
+    executor.prepared = PreparedStatements(settings.get('pgcli_prepared_cache_size', 100),
+                                           settings.get('pgcli_prepare_threshold', 2))
     return executor
 
 
-def run_sqls_async(view, sqls):
+def run_sqls_async(view, sqls, batch=False, params=None):
+    """Run sqls one after another
+
+    With batch, consecutive statements which return no rows are sent to the
+    server pgcli_batch_size at a time, see run_batch. params is a list with
+    the parameters of each statement, which are never batched.
+    """
     panel = get_output_panel(view)
-    for sql in sqls:
-        run_sql_async(view, sql, panel)
+    start_result_block(panel)
+    # Hold one connection for all the statements instead of a checkout each
+    executor = checkout_executor(view, panel)
+    if executor is None:
+        return
+    with holding_executor(view, executor, panel):
+        if params is not None:
+            for sql, sql_params in zip(sqls, params):
+                if engine.is_cancelled(view.id()):
+                    break
+                run_sql_async(view, sql, panel, sql_params)
+            return
 
+        size = get(view, 'pgcli_batch_size') if batch else 1
+        for group in batch_statements(sqls, size) if size > 1 else ([sql] for sql in sqls):
+            if engine.is_cancelled(view.id()):
+                break
+            if len(group) > 1:
+                run_batch(view, executor, group, panel)
+            else:
+                run_sql_async(view, group[0], panel)
 
-def run_sqls_on_multi_connections_async(view, sqls, urls, original_url):
-    panel = get_output_panel(view)
-    for url in urls:
-        close_connection(view)
-        view.settings().set('pgcli_url', url)
-        check_pgcli(view)
-        for sql in sqls:
-            run_sql_async(view, sql, panel)
-    close_connection(view)
-    view.settings().set('pgcli_url', original_url)
-    check_pgcli(view)
 
+def run_batch(view, executor, sqls, panel):
+    """Send sqls to the server at once, in a single round trip
 
-def run_sql_async(view, sql, panel):
-    # Make sure the output panel is visible
+    The statements run in a DO block, see batch_block, which reports the row
+    count of each. They succeed or fail together: in the block's implicit
+    transaction outside of a transaction, behind a savepoint inside one. A
+    failed batch is run again one statement at a time, to show which one
+    fails.
+    """
     sublime.active_window().run_command('pgcli_show_output_panel')
-    if view.id() not in executors:
-        out = 'connection closed, trying reconnect ... '
-        panel.run_command('append', {'characters': out, 'pos': 0})
-        error = check_pgcli(view)
-        if error:
-            out = '%s: %s' % (error.__class__.__name__, error)
-            panel.run_command('append', {'characters': out, 'pos': 0})
-            return
-    executor = executors[view.id()]
+    close_stream(view)
+    status = executor.conn.get_transaction_status()
+    block = batch_block(sqls)
+    if (status not in (ext.TRANSACTION_STATUS_IDLE, ext.TRANSACTION_STATUS_INTRANS)
+            or block is None):
+        for sql in sqls:
+            run_sql_async(view, sql, panel)
+        return
+
+    logger.debug('Command: PgcliExecuteBatch: %d statements', len(sqls))
+    sql = ';\n'.join(sql.strip().rstrip(';') for sql in sqls)
+    savepoint = status == ext.TRANSACTION_STATUS_INTRANS
     executor.last_use = time.time()
-    logger.debug('Command: PgcliExecute: %r', sql)
-    save_mode = get(view, 'pgcli_save_on_run_query_mode')
+    if SESSION_STATE_SQL_RE.search(sql):
+        executor.pinned = True
     start = time.time()
-    results = executor.run(sql, pgspecial=special)
-    settings = OutputSettings('psql', "", "", "NULL", False, None)
     try:
-        for (title, cur, headers, status, _, _, _) in results:
-            status = None if status == 'SELECT 1' else status
-            out = 'done in {:.6} ms\n'.format((time.time() - start) * 1000)
-            panel.run_command('append', {'characters': out, 'pos': 0})
-            if headers and len(headers) == 1:
-                out = '\n' + '\n'.join(str(r[0]) for r in cur) + '\n\n'
-            else:
-                fmt = format_output(title, cur, headers, status, settings)
-                out = '\n'.join(fmt) + '\n\n'
-            panel.run_command('append', {'characters': out})
-            start = time.time()
+        with executor.conn.cursor() as cur:
+            if savepoint:
+                cur.execute('SAVEPOINT pgcli_batch')
+            try:
+                cur.execute(block)
+            except psycopg2.DatabaseError:
+                if savepoint:
+                    cur.execute('ROLLBACK TO SAVEPOINT pgcli_batch')
+                raise
+            if savepoint:
+                cur.execute('RELEASE SAVEPOINT pgcli_batch')
     except psycopg2.DatabaseError as e:
-        success = False
-        out = 'DatabaseError: ' + str(e) + '\n\n' + str(datetime.datetime.now())
+        out = '-- batch of {} statements rolled back: {}: {}\n'.format(
+            len(sqls), e.__class__.__name__, str(e).strip())
+        out += '-- running them one by one\n\n'
         panel.run_command('append', {'characters': out})
+        for sql in sqls:
+            run_sql_async(view, sql, panel)
+        return
     except psycopg2.InterfaceError as e:
-        success = False
         out = 'InterfaceError: ' + str(e) + '\n\n' + str(datetime.datetime.now())
         panel.run_command('append', {'characters': out})
-        del executors[view.id()]
+        close_connection(view)
+        return
+
+    elapsed = time.time() - start
+    counts = batch_counts(executor.conn.notices) or [None] * len(sqls)
+    out = ''
+    while executor.conn.notices:
+        out = executor.conn.notices.pop() + out
+    out += '-- batch of {} statements done in {:.6} ms\n'.format(len(sqls), elapsed * 1000)
+    for statement, rows in zip(sqls, counts):
+        status = 'ok' if rows is None else batch_status(statement, rows)
+        out += '{:<14}  {}\n'.format(status, ' '.join(statement.split())[:200])
+        add_history(get(view, 'pgcli_url'), statement,
+                    elapsed * 1000 / len(sqls), None, None)
+    panel.run_command('append', {'characters': out + '\n'})
+
+    invalidate_results(get(view, 'pgcli_url'))
+    for statement in sqls:
+        invalidate_prepared(executor, statement)
+    update_catalog(view, executor, sql)
+
+
+def run_script_async(view, text):
+    """Run the statements of a script one by one, as soon as they are found
+
+    The script isn't split by sqlparse, which takes minutes on huge scripts.
+    Only result sets, notices and errors are shown, progress in the status
+    bar. With pgcli_stop_on_error the script stops at the first error.
+    """
+    panel = get_output_panel(view)
+    start_result_block(panel)
+    sublime.active_window().run_command('pgcli_show_output_panel')
+    close_stream(view)
+    executor = checkout_executor(view, panel)
+    if executor is None:
+        return
+    with holding_executor(view, executor, panel):
+        logger.debug('Command: PgcliRunScript: %d characters', len(text))
+        stop_on_error = get(view, 'pgcli_stop_on_error')
+        save_mode = get(view, 'pgcli_save_on_run_query_mode')
+        size = len(text) / 1024 / 1024
+
+        start = time.time()
+        shown = 0
+        count = errors = 0
+        changes = CatalogChanges()
+        changed_path = False
+        try:
+            for begin, end, data in iter_statements(text):
+                if engine.is_cancelled(view.id()):
+                    break
+                count += 1
+                if time.time() - shown > 0.2:
+                    shown = time.time()
+                    view.set_status('pgcli_script', 'Running statement {}, {:.1f} of {:.1f} MB'.format(
+                        count, begin / 1024 / 1024, size))
+                sql = text[begin:end]
+                executor.last_use = time.time()
+                if SESSION_STATE_SQL_RE.search(sql):
+                    executor.pinned = True
+                try:
+                    run_script_statement(executor, sql, text, data, panel)
+                except psycopg2.DatabaseError as e:
+                    errors += 1
+                    out = 'DatabaseError at statement {} (line {}): {}\n\n'.format(
+                        count, text.count('\n', 0, begin) + 1, e)
+                    panel.run_command('append', {'characters': out})
+                    if stop_on_error:
+                        break
+                except psycopg2.InterfaceError as e:
+                    errors += 1
+                    out = 'InterfaceError: ' + str(e) + '\n\n'
+                    panel.run_command('append', {'characters': out})
+                    close_connection(view)
+                    break
+                invalidate_results(get(view, 'pgcli_url'), sql)
+                invalidate_prepared(executor, sql)
+                changes.update(catalog_changes(sql))
+                changed_path = changed_path or has_change_path_cmd(sql)
+        finally:
+            view.erase_status('pgcli_script')
+
+        out = '-- script: {} statements, {} errors in {:.6} ms{}\n\n'.format(
+            count, errors, (time.time() - start) * 1000,
+            ', cancelled' if engine.is_cancelled(view.id())
+            else ', stopped at the first error' if errors and stop_on_error else '')
+        panel.run_command('append', {'characters': out})
+
+        if (view.file_name()
+                and ((save_mode == 'always')
+                     or (save_mode == 'success' and not errors))):
+            view.run_command('save')
+
+        # Refresh the completer once for the whole script
+        pending = pending_catalog_changes.setdefault(view.id(), CatalogChanges())
+        pending.update(changes)
+        update_catalog(view, executor, '')
+
+        if changed_path and not executor.conn.closed:
+            search_path = executor.search_path()
+            with completer_lock:
+                completers[get(view, 'pgcli_url')].set_search_path(search_path)
+
+
+def run_script_statement(executor, sql, text, data, panel):
+    """Run one statement found by iter_statements"""
+    start = time.time()
+    if data:
+        with executor.conn.cursor() as cur:
+            cur.copy_expert(sql, io.StringIO(text[data[0]:data[1]]))
+            out = cur.statusmessage
+        panel.run_command('append', {'characters': out + '\n'})
+    elif sql.startswith('\\'):
+        run_results(executor.run(sql, pgspecial=special), panel, start)
     else:
-        success = True
+        title, cur, headers, status = executor.execute_normal_sql(sql)
+        if headers:
+            run_results([(title, cur, headers, status, sql, True, False)], panel, start)
+        elif title:
+            panel.run_command('append', {'characters': title})
 
-    if (view.file_name()
-            and ((save_mode == 'always')
-                 or (save_mode == 'success' and success))):
-        view.run_command('save')
 
-    # Refresh the table names and column names if necessary.
-    if has_meta_cmd(sql):
-        logger.debug('Need completions refresh')
-        url = get(view, 'pgcli_url')
-        refresher = CompletionRefresher()
-        refresher.refresh(executor, special=special, callbacks=(
-                          lambda c: swap_completer(c, url)))
+def run_sqls_on_multi_connections_async(view, sqls, urls):
+    """Run sqls on every url at once, leaving the view's connection alone
 
-    # Refresh search_path to set default schema.
-    if has_change_path_cmd(sql):
-        logger.debug('Refreshing search path')
-        url = get(view, 'pgcli_url')
+    Results are appended grouped per url in completion order, followed by a
+    summary of timings and errors.
+    """
+    panel = get_output_panel(view)
+    start_result_block(panel)
+    sublime.active_window().run_command('pgcli_show_output_panel')
+    max_workers = max(1, min(len(urls), get(view, 'pgcli_multi_max_concurrency')))
+    running = multi_executors.setdefault(view.id(), set())
 
-        with completer_lock:
-            completers[url].set_search_path(executor.search_path())
-            logger.debug('Search path: %r', completers[url].search_path)
+    start = time.time()
+    summary = []
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            thread_name_prefix='run_sqls_on_url') as pool:
+        futures = [pool.submit(run_sqls_on_url, url, sqls, running)
+                   for url in urls]
+        for future in as_completed(futures):
+            url, out, elapsed, error = future.result()
+            add_history(url, '\n'.join(sqls), elapsed * 1000, None, error)
+            caption = url_caption(url)
+            panel.run_command('append', {'characters': '-- {}\n{}'.format(caption, out)})
+            summary.append((elapsed, caption, error))
+    multi_executors.pop(view.id(), None)
+
+    failed = sum(1 for _, _, error in summary if error)
+    out = '-- {} connections, {} succeeded, {} failed in {:.6} ms\n'.format(
+        len(summary), len(summary) - failed, failed, (time.time() - start) * 1000)
+    for elapsed, caption, error in summary:
+        status = 'ok' if not error else 'error: {}: {}'.format(
+            error.__class__.__name__, str(error).strip())
+        out += '{:>12.3f} ms  {}  {}\n'.format(elapsed * 1000, caption, status)
+    panel.run_command('append', {'characters': out + '\n'})
+
+
+def run_sqls_on_url(url, sqls, running):
+    """Run sqls on a pooled connection to url, collecting the output
+
+    Returns (url, output, elapsed seconds, error or None).
+    """
+    out = PanelBuffer()
+    start = time.time()
+    error = None
+    executor = None
+    try:
+        executor = get_pool(url).checkout(POOL_CHECKOUT_TIMEOUT)
+        running.add(executor)
+        for sql in sqls:
+            run_results(executor.run(sql, pgspecial=special), out, time.time())
+            invalidate_results(url, sql)
+    except Exception as e:
+        error = e
+        out.run_command('append', {'characters': '%s: %s\n\n' % (e.__class__.__name__, e)})
+    finally:
+        if executor:
+            running.discard(executor)
+            checkin_clean(url, executor, sqls)
+    return url, out.getvalue(), time.time() - start, error
+
+
+def checkin_clean(url, executor, sqls):
+    """Give an executor back to the pool, unless sqls left state behind"""
+    # Don't give connections with transaction or session state of their own
+    # back to the pool
+    if (not executor.conn.closed
+            and executor.conn.get_transaction_status() == ext.TRANSACTION_STATUS_IDLE
+            and not any(SESSION_STATE_SQL_RE.search(sql) for sql in sqls)):
+        pools[url].checkin(executor)
+    else:
+        pools[url].discard(executor)
+
+
+def benchmark_on_multi_connections_async(view, sql, urls, runs):
+    """Run sql runs times on every url and compare latencies and plans
+
+    Every run is rolled back, so statements changing data can be measured
+    too. The first url is the baseline the other plans are compared with.
+    """
+    panel = get_output_panel(view)
+    start_result_block(panel)
+    sublime.active_window().run_command('pgcli_show_output_panel')
+    # Every run is rolled back, a commit in the selection would escape that
+    try:
+        sql = single_statement(sql)
+    except ValueError as e:
+        panel.run_command('append', {'characters': 'Not benchmarked: %s\n\n' % e})
+        return
+    max_workers = max(1, min(len(urls), get(view, 'pgcli_multi_max_concurrency')))
+    running = multi_executors.setdefault(view.id(), set())
+
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            thread_name_prefix='benchmark_on_url') as pool:
+        results = list(pool.map(
+            lambda url: benchmark_on_url(url, sql, runs, running,
+                                         partial(engine.is_cancelled, view.id())), urls))
+    multi_executors.pop(view.id(), None)
+
+    out = '-- {} runs on {} connections, ms\n'.format(runs, len(urls))
+    if engine.is_cancelled(view.id()):
+        out += '-- cancelled, the stats are of the runs done until then\n'
+
+    out += '{:>12} {:>12} {:>12} {:>12}  {}\n'.format('min', 'median', 'p95', 'max', 'url')
+    plans = []
+    for url, durations, plan, error in results:
+        caption = url_caption(url)
+        for duration in durations:
+            add_history(url, sql, duration * 1000, None, None)
+        if error:
+            out += '{:>51}  {}  error: {}: {}\n'.format(
+                '', caption, error.__class__.__name__, str(error).strip())
+            continue
+        if not durations:
+            out += '{:>51}  {}  no runs\n'.format('', caption)
+            continue
+        stats = summarize([d * 1000 for d in durations])
+        out += '{:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}  {}\n'.format(
+            stats['min'], stats['median'], stats['p95'], stats['max'], caption)
+        plans.append((caption, plan))
+
+    differences = compare_plans(plans)
+    if differences:
+        out += '-- plan differences to {}\n'.format(plans[0][0])
+        out += ''.join('   {}\n'.format(line) for line in differences)
+    elif len(plans) > 1:
+        out += '-- same plan on all connections\n'
+    panel.run_command('append', {'characters': out + '\n'})
+
+
+def benchmark_async(view, sql, iterations, warmup, concurrency, params):
+    """Run sql warmup + iterations times on concurrency pooled connections
+
+    params is a list of parameter sets, used in turn. Every run is rolled
+    back. The results are appended to <file>.bench.jsonl next to the view's
+    file, and compared with the previous run of the same query there.
+    """
+    panel = get_output_panel(view)
+    start_result_block(panel)
+    sublime.active_window().run_command('pgcli_show_output_panel')
+    try:
+        sql = single_statement(sql)
+    except ValueError as e:
+        panel.run_command('append', {'characters': 'Not benchmarked: %s\n\n' % e})
+        return
+    url = get(view, 'pgcli_url')
+    param_sets = params or [None]
+    total = warmup + iterations
+    # Workers beyond the pool size would only wait for a connection
+    concurrency = max(1, min(concurrency, get_pool(url).max_size))
+    running = multi_executors.setdefault(view.id(), set())
+
+    durations = []
+    errors = []
+    counter = iter(range(total))
+    lock = Lock()
+    measured = []  # Start of the first measured run
+
+    def worker():
+        executor = None
+        try:
+            executor = get_pool(url).checkout(POOL_CHECKOUT_TIMEOUT)
+            running.add(executor)
+            while not errors:
+                # A cancel between two runs only shows up in the flag
+                if engine.is_cancelled(view.id()):
+                    return
+                with lock:
+                    i = next(counter, None)
+                    if i == warmup:
+                        measured.append(time.perf_counter())
+                if i is None:
+                    return
+                duration = timed_run(executor.conn, sql, param_sets[i % len(param_sets)])
+                if i >= warmup:
+                    durations.append(duration * 1000)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if executor:
+                running.discard(executor)
+                checkin_clean(url, executor, [sql])
+
+    view.set_status('pgcli_benchmark', 'Benchmarking: {} runs'.format(total))
+    with ThreadPoolExecutor(max_workers=concurrency,
+                            thread_name_prefix='benchmark_async') as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - measured[0] if measured else 0
+    multi_executors.pop(view.id(), None)
+    view.erase_status('pgcli_benchmark')
+
+    caption = url_caption(url)
+    out = '-- benchmark on {}: {} runs after {} warmup, concurrency {}, {} parameter sets\n'.format(
+        caption, len(durations), warmup, concurrency, len(param_sets))
+    if errors:
+        e = errors[0]
+        out += '-- stopped by %s: %s\n' % (e.__class__.__name__, str(e).strip())
+    elif engine.is_cancelled(view.id()):
+        out += '-- cancelled, the stats are of the runs done until then\n'
+    if not durations:
+        panel.run_command('append', {'characters': out + '\n'})
+        return
+
+    stats = summarize(durations)
+    throughput = len(durations) / elapsed if elapsed else 0
+    out += '-- min {:.3f}, median {:.3f}, p95 {:.3f}, max {:.3f} ms, {:.1f} runs/s\n'.format(
+        stats['min'], stats['median'], stats['p95'], stats['max'], throughput)
+
+    statement = normalize(sql)
+    result = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'url': caption,
+        'fingerprint': fingerprint(statement),
+        'statement': statement,
+        'warmup': warmup,
+        'concurrency': concurrency,
+        'parameter_sets': len(param_sets),
+        'stats_ms': stats,
+        'throughput': throughput,
+        'histogram_ms': histogram(durations),
+        'error': str(errors[0]) if errors else None,
+    }
+    if view.file_name():
+        path = view.file_name() + '.bench.jsonl'
+        previous = [r for r in read_results(path)
+                    if r.get('fingerprint') == result['fingerprint'] and r.get('url') == caption]
+        if previous:
+            before = previous[-1]['stats_ms']
+            out += '-- previous run {}: median {:.3f} ms ({:+.1f}%), p95 {:.3f} ms ({:+.1f}%)\n'.format(
+                previous[-1]['time'],
+                before['median'], 100.0 * (stats['median'] - before['median']) / before['median'],
+                before['p95'], 100.0 * (stats['p95'] - before['p95']) / before['p95'])
+        try:
+            append_result(path, result)
+        except OSError as e:
+            out += '-- results not saved: {}\n'.format(e)
+    out += '\n'.join(format_histogram(result['histogram_ms'])) + '\n\n'
+    panel.run_command('append', {'characters': out})
+
+
+def benchmark_on_url(url, sql, runs, running, cancelled):
+    """Returns (url, durations in seconds, plan, error or None)
+
+    cancelled is checked before every run, stopping the runs once it
+    returns True.
+    """
+    durations = []
+    plan = None
+    executor = None
+    try:
+        executor = get_pool(url).checkout(POOL_CHECKOUT_TIMEOUT)
+        running.add(executor)
+        plan = explain_plan(executor.conn, sql)
+        for _ in range(runs):
+            if cancelled():
+                break
+            durations.append(timed_run(executor.conn, sql))
+    except Exception as e:
+        return url, durations, plan, e
+    finally:
+        if executor:
+            running.discard(executor)
+            checkin_clean(url, executor, [sql])
+    return url, durations, plan, None
+
+
+class PanelBuffer:
+    """Stands in for the output panel, collecting the appended text
+
+    With panel, the text is appended to that panel as well.
+    """
+
+    def __init__(self, panel=None):
+        self.parts = []
+        self.panel = panel
+
+    def run_command(self, cmd, args):
+        self.parts.append(args['characters'])
+        if self.panel is not None:
+            self.panel.run_command(cmd, args)
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+def run_sql_async(view, sql, panel, params=None):
+    # Make sure the output panel is visible
+    sublime.active_window().run_command('pgcli_show_output_panel')
+    # A new query always discards the rest of a previously streamed result
+    close_stream(view)
+    cache, key = cached_result_key(view, sql, params)
+    if key:
+        hit = cache.get(get(view, 'pgcli_url'), key)
+        if hit:
+            age, out = hit
+            out = '-- cached, {:.0f} seconds old\n{}'.format(age, out)
+            panel.run_command('append', {'characters': out})
+            return
+        panel = PanelBuffer(panel)
+    timer = QueryTimer()
+    with timer.phase('checkout'):
+        executor = checkout_executor(view, panel)
+    if executor is None:
+        return
+    with holding_executor(view, executor, panel):
+        executor.last_use = time.time()
+        if SESSION_STATE_SQL_RE.search(sql):
+            executor.pinned = True
+        logger.debug('Command: PgcliExecute: %r', sql)
+        save_mode = get(view, 'pgcli_save_on_run_query_mode')
+        start = time.time()
+        # Parameters are bound by the prepared statement cache, not the stream
+        stream_sql = get_streamable_sql(view, executor, sql) if params is None else None
+        if stream_sql:
+            statement = plain_statement(sql)
+            if statement and executor.prepared.due(statement):
+                # Selects run again and again skip parsing and planning instead
+                logger.debug('Running prepared instead of streaming')
+                stream_sql = None
+        result_viewer = None
+        if get(view, 'pgcli_result_view'):
+            result_viewer = partial(open_result_viewer, view)
+        try:
+            if stream_sql:
+                logger.debug('Streaming result with a server-side cursor')
+                with timer.phase('execute'):
+                    stream = ResultStream(executor, stream_sql,
+                                          get(view, 'pgcli_stream_batch_size'),
+                                          get(view, 'pgcli_stream_row_limit'),
+                                          result_viewer)
+                stream.fetch_page(panel, start, timer)
+                if not stream.closed:
+                    streams[view.id()] = stream
+            else:
+                run_results(run_statement(executor, sql, params), panel, start,
+                            result_viewer, timer)
+        except psycopg2.DatabaseError as e:
+            success = False
+            error = e
+            out = 'DatabaseError: ' + str(e) + '\n\n' + str(datetime.datetime.now())
+            panel.run_command('append', {'characters': out})
+        except psycopg2.InterfaceError as e:
+            success = False
+            error = e
+            out = 'InterfaceError: ' + str(e) + '\n\n' + str(datetime.datetime.now())
+            panel.run_command('append', {'characters': out})
+            close_connection(view)
+        else:
+            success = True
+            error = None
+            if (key and view.id() not in streams and not executor.pinned
+                    and executor.conn.get_transaction_status() == ext.TRANSACTION_STATUS_IDLE):
+                # Only complete results, which other sessions see as well
+                cache.put(get(view, 'pgcli_url'), key, panel.getvalue())
+
+        if not key:
+            invalidate_results(get(view, 'pgcli_url'), sql)
+        report_timings(view, panel, timer, sql, success)
+        add_history(get(view, 'pgcli_url'), sql,
+                    sum(timer.phases.values()) * 1000, timer.rows, error)
+
+        if (view.file_name()
+                and ((save_mode == 'always')
+                     or (save_mode == 'success' and success))):
+            view.run_command('save')
+
+        # Refresh the table names and column names if necessary.
+        invalidate_prepared(executor, sql)
+        update_catalog(view, executor, sql)
+
+        # Refresh search_path to set default schema.
+        if has_change_path_cmd(sql):
+            logger.debug('Refreshing search path')
+            url = get(view, 'pgcli_url')
+
+            if not executor.conn.closed:
+                search_path = executor.search_path()
+                with completer_lock:
+                    completers[url].set_search_path(search_path)
+                    logger.debug('Search path: %r', completers[url].search_path)
+
+
+def plain_statement(sql, statements=None):
+    """The statement of sql without its ';', if sql is a single sql statement
+
+    Returns None for several statements, meta commands and \\G. statements
+    are the first ones iter_statements yields for sql, if known already.
+    """
+    if statements is None:
+        statements = list(islice(iter_statements(sql), 2))
+    if len(statements) != 1 or statements[0][2]:
+        return None
+    begin, end, _ = statements[0]
+    statement = sql[begin:end].rstrip(';')
+    # Meta commands and \G are left to pgcli
+    return None if '\\' in statement else statement
+
+
+def run_statement(executor, sql, params=None):
+    """Run sql like PGExecute.run, yielding the same result tuples
+
+    A single statement runs through the connection's prepared statement
+    cache, which binds params to its %(name)s placeholders. Anything else
+    goes to pgcli, which doesn't take parameters: a meta command gets the
+    text of params put in, along with other statements params are refused.
+    """
+    statements = list(iter_statements(sql) if params is not None
+                      else islice(iter_statements(sql), 2))
+    if params is not None and any(sql.startswith('\\', begin) for begin, _, _ in statements):
+        if len(statements) > 1:
+            raise ValueError("Parameters can't be bound to meta commands "
+                             "among other statements")
+        yield from executor.run(interpolate(sql, params), pgspecial=special)
+        return
+    statement = plain_statement(sql, statements)
+    if params is None and not (statement and executor.prepared.threshold
+                               and PREPARABLE_SQL_RE.match(statement)):
+        yield from executor.run(sql, pgspecial=special)
+        return
+
+    if statement:
+        sql = statement
+    cur = executor.conn.cursor()
+    generation = ddl_generations.get(executor.url, 0)
+    if executor.prepared.generation != generation:
+        # Another connection to the url ran ddl since these were prepared
+        idle = executor.conn.get_transaction_status() == ext.TRANSACTION_STATUS_IDLE
+        executor.prepared.invalidate(cur if idle else None)
+        executor.prepared.generation = generation
+    executor.prepared.execute(cur, sql, params, prepare=statement is not None)
+    title = ''
+    while executor.conn.notices:
+        title = executor.conn.notices.pop() + title
+    headers = [d[0] for d in cur.description] if cur.description else None
+    yield title, cur if headers else None, headers, cur.statusmessage, sql, True, False
+
+
+def cached_result_key(view, sql, params=None):
+    """Returns (ResultCache, key) when the output of sql may be cached
+
+    Only read-only queries are cached, and only with pgcli_result_cache on.
+    The output goes to the panel, the result view and parameters are left
+    out. A transaction of the view may see changes other sessions don't,
+    and session state (e.g. search_path or role) may change what the query
+    reads, so nothing is cached inside one or on a pinned connection.
+    Otherwise returns (None, None).
+    """
+    global result_cache
+    if (not get(view, 'pgcli_result_cache') or params is not None
+            or get(view, 'pgcli_result_view')):
+        return None, None
+    executor = executors.get(view.id())
+    if executor and (executor.pinned or not executor.conn.closed
+                     and executor.conn.get_transaction_status() != ext.TRANSACTION_STATUS_IDLE):
+        return None, None
+    key = cache_key(sql)
+    if not is_read_only(key):
+        return None, None
+    with result_cache_lock:
+        if result_cache is None:
+            result_cache = ResultCache(
+                get(view, 'pgcli_result_cache_ttl'),
+                get(view, 'pgcli_result_cache_max_memory') * 1024 * 1024)
+    return result_cache, key
+
+
+def invalidate_results(url, sql=None):
+    """Drop the cached results of url unless sql is read-only"""
+    if result_cache is not None and (sql is None or not is_read_only(cache_key(sql))):
+        result_cache.invalidate(url)
+
+
+def invalidate_prepared(executor, sql):
+    """Forget the prepared statements of executor when sql may have changed
+    the objects they use, or dropped them
+
+    Ddl starts a new generation for the url, so the other connections to it
+    forget theirs before they run a prepared statement again.
+    """
+    ddl = DDL_SQL_RE.match(sql)
+    if ddl:
+        ddl_generations[executor.url] = ddl_generations.get(executor.url, 0) + 1
+    if executor.conn.closed:
+        return
+    generation = ddl_generations.get(executor.url, 0)
+    if DEALLOCATE_SQL_RE.search(sql):
+        executor.prepared.invalidate()
+        executor.prepared.generation = generation
+    elif ddl or has_change_path_cmd(sql):
+        idle = executor.conn.get_transaction_status() == ext.TRANSACTION_STATUS_IDLE
+        with executor.conn.cursor() as cur:
+            executor.prepared.invalidate(cur if idle else None)
+        executor.prepared.generation = generation
+
+
+def report_timings(view, panel, timer, sql, success):
+    """Show the phase timings of a query and add them to the timing log"""
+    if get(view, 'pgcli_show_timings'):
+        panel.run_command('append', {'characters': '-- {}\n\n'.format(timer.summary())})
+
+    path = timing_log_path()
+    if path:
+        log = timing_logs.get(path)
+        if log is None:
+            max_size = settings.get('pgcli_timing_log_max_size', 10) * 1024 * 1024
+            log = timing_logs.setdefault(path, TimingLog(path, max_size))
+        # Like the history, without literals, which may hold personal data
+        statement = normalize(sql)
+        log.write(timer.record(url=url_caption(get(view, 'pgcli_url')),
+                               sql=statement, fingerprint=fingerprint(statement),
+                               success=success))
+
+
+def query_history():
+    """The QueryHistory queries are recorded in, or None"""
+    path = settings.get('pgcli_history')
+    if not path:
+        return None
+    if path is True:
+        path = os.path.join(sublime.cache_path(), 'PgcliSublime', 'history.sqlite3')
+    path = os.path.expanduser(path)
+    with history_lock:
+        history = histories.get(path)
+        if history is None:
+            history = histories[path] = QueryHistory(path)
+        return history
+
+
+def add_history(url, sql, duration_ms, rows, error):
+    """Record a query in the history, error is the exception it raised"""
+    try:
+        history = query_history()
+        if history:
+            # Without the password, and without the detail of the error
+            history.add(url_caption(url), sql, duration_ms, rows, error_summary(error))
+    except Exception as e:
+        logger.warning('Error recording query history: %r', e)
+
+
+def timing_log_path():
+    """The JSON lines file query timings are logged to, or None"""
+    path = settings.get('pgcli_timing_log')
+    if not path:
+        return None
+    if path is True:
+        return os.path.join(sublime.cache_path(), 'PgcliSublime', 'timings.jsonl')
+    return os.path.expanduser(path)
+
+
+def explain_analyze_async(view, sql):
+    panel = get_output_panel(view)
+    start_result_block(panel)
+    sublime.active_window().run_command('pgcli_show_output_panel')
+    sql = sqlparse.format(sql, strip_comments=True).strip().rstrip(';').strip()
+    executor = checkout_executor(view, panel)
+    if executor is None:
+        return
+    with holding_executor(view, executor, panel):
+        executor.last_use = time.time()
+        logger.debug('Command: PgcliExplainAnalyze: %r', sql)
+
+        # The statement really runs, but its changes are rolled back
+        try:
+            out = analyze(explain_analyze(executor.conn, sql)) + '\n'
+        except ValueError as e:
+            out = 'Not explained: %s\n\n' % e
+        except psycopg2.Error as e:
+            out = '%s: %s\n\n%s\n\n' % (e.__class__.__name__, e, datetime.datetime.now())
+            if isinstance(e, psycopg2.InterfaceError):
+                close_connection(view)
+        panel.run_command('append', {'characters': out})
+
+
+def export_async(view, sql, fmt, path):
+    panel = get_output_panel(view)
+    start_result_block(panel)
+    sublime.active_window().run_command('pgcli_show_output_panel')
+    sql = sqlparse.format(sql, strip_comments=True).strip().rstrip(';').strip()
+    executor = checkout_executor(view, panel)
+    if executor is None:
+        return
+    with holding_executor(view, executor, panel):
+        executor.last_use = time.time()
+        logger.debug('Command: PgcliExport %s to %r: %r', fmt, path, sql)
+
+        def progress(lines, size):
+            view.set_status('pgcli_export', 'Exporting: {} rows, {:.1f} MB'.format(
+                lines, size / 1024 / 1024))
+
+        # The export runs on the view's executor, so pgcli_cancel_execute
+        # cancels it like any other query
+        start = time.time()
+        try:
+            rows = export(executor.conn, sql, fmt, path, progress)
+        except (psycopg2.Error, OSError, RuntimeError) as e:
+            out = 'Export failed: %s: %s\n\n%s' % (
+                e.__class__.__name__, e, datetime.datetime.now())
+            panel.run_command('append', {'characters': out})
+            if isinstance(e, psycopg2.InterfaceError):
+                close_connection(view)
+        else:
+            out = 'exported {} rows to {} in {:.6} ms\n\n'.format(
+                rows, path, (time.time() - start) * 1000)
+            panel.run_command('append', {'characters': out})
+        finally:
+            view.erase_status('pgcli_export')
+
+
+def load_async(view, table, lines, path, fmt):
+    panel = get_output_panel(view)
+    start_result_block(panel)
+    sublime.active_window().run_command('pgcli_show_output_panel')
+    executor = checkout_executor(view, panel)
+    if executor is None:
+        return
+    with holding_executor(view, executor, panel):
+        executor.last_use = time.time()
+        logger.debug('Command: PgcliLoad %s from %r into %r', fmt, path or 'view', table)
+
+        def progress(rows, size, elapsed):
+            executor.last_use = time.time()
+            view.set_status('pgcli_load', 'Loading: {} rows, {:.0f} rows/s, {:.1f} MB/s'.format(
+                rows, rows / elapsed if elapsed else 0, size / 1024 / 1024 / elapsed if elapsed else 0))
+
+        # Each batch is committed on its own unless the view is in a transaction
+        try:
+            if path:
+                with open(path, encoding='utf-8') as f:
+                    rows, size, elapsed = load(
+                        executor.conn, table, f, fmt, get(view, 'pgcli_load_batch_size'),
+                        get(view, 'pgcli_load_header'), progress)
+            else:
+                rows, size, elapsed = load(
+                    executor.conn, table, lines, fmt, get(view, 'pgcli_load_batch_size'),
+                    get(view, 'pgcli_load_header'), progress)
+        except (psycopg2.Error, OSError, UnicodeDecodeError) as e:
+            out = 'Load failed: %s: %s\n\n%s' % (
+                e.__class__.__name__, e, datetime.datetime.now())
+            panel.run_command('append', {'characters': out})
+            if isinstance(e, psycopg2.InterfaceError):
+                close_connection(view)
+        else:
+            out = 'loaded {} rows ({:.1f} MB) into {} in {:.3f} s, {:.0f} rows/s\n\n'.format(
+                rows, size / 1024 / 1024, table, elapsed, rows / elapsed if elapsed else 0)
+            panel.run_command('append', {'characters': out})
+        finally:
+            view.erase_status('pgcli_load')
+            # Batches loaded before a failure are committed as well
+            invalidate_results(get(view, 'pgcli_url'))
+
+
+def run_results(results, panel, start, result_viewer=None, timer=None):
+    """Append results to the panel
+
+    With result_viewer, a callable taking (headers, title) and returning a
+    ResultViewer, result sets go to the result view instead. Time spent is
+    added up in timer.
+    """
+    if timer is None:
+        timer = QueryTimer()
+    results = iter(results)
+    while True:
+        # pgcli runs the next statement when asked for its result
+        with timer.phase('execute'):
+            result = next(results, None)
+        if result is None:
+            break
+        title, cur, headers, status, _, _, _ = result
+        status = None if status == 'SELECT 1' else status
+        out = 'done in {:.6} ms\n'.format((time.time() - start) * 1000)
+        panel.run_command('append', {'characters': out, 'pos': 0})
+        if result_viewer and headers and cur:
+            viewer = result_viewer(headers, title)
+            rows = iter(cur)
+            while True:
+                with timer.phase('fetch'):
+                    chunk = list(islice(rows, viewer.store.chunk_size))
+                if not chunk:
+                    break
+                with timer.phase('render'):
+                    viewer.append(chunk)
+            with timer.phase('render'):
+                viewer.finish()
+            timer.add_output(viewer.store.rowcount, '')
+            out = '({} rows in the result view)\n\n'.format(viewer.store.rowcount)
+        else:
+            rows = cur
+            if headers and hasattr(cur, 'fetchall'):
+                # An empty list would leave out the headers
+                with timer.phase('fetch'):
+                    rows = cur.fetchall() or cur
+            if headers and len(headers) == 1:
+                with timer.phase('format'):
+                    out = '\n' + '\n'.join(str(r[0]) for r in rows) + '\n\n'
+            else:
+                # Large tables show up chunk by chunk
+                chunks = format_rows(title, rows, headers, status)
+                while True:
+                    with timer.phase('format'):
+                        chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    timer.add_output(0, chunk)
+                    with timer.phase('render'):
+                        panel.run_command('append', {'characters': chunk})
+                out = '\n'
+            timer.add_output(len(rows) if isinstance(rows, list) else 0, out)
+        with timer.phase('render'):
+            panel.run_command('append', {'characters': out})
+        start = time.time()
+
+
+def format_rows(title, rows, headers, status, formatter=None):
+    """Yields a result as a psql style table, in chunks ending with a newline
+
+    pgcli_table_formatter "fast" uses format_table, "pgcli" pgcli's format_output.
+    """
+    if (formatter or settings.get('pgcli_table_formatter', 'fast')) == 'pgcli':
+        output_settings = OutputSettings('psql', "", "", "NULL", False, None)
+        yield '\n'.join(format_output(title, rows, headers, status, output_settings)) + '\n'
+        return
+    yield from format_table(title, rows, headers, status, missing='NULL',
+                            max_cell_width=settings.get('pgcli_max_cell_width'))
+
+
+def benchmark_formatter_async(view, rows, columns):
+    """Time both formatters on generated rows, with some wide json cells"""
+    panel = get_output_panel(view)
+    start_result_block(panel)
+    sublime.active_window().run_command('pgcli_show_output_panel')
+    headers = ['column_{}'.format(i) for i in range(columns)]
+    values = [12345, 'some text', None, 3.14159, datetime.datetime(2021, 1, 1, 12, 0),
+              '{"key": "%s", "items": [1, 2, 3]}' % ('x' * 2000), True, [1, 2, None]]
+    data = [tuple(values[(r + c) % len(values)] if c else r for c in range(columns))
+            for r in range(rows)]
+
+    out = '-- formatting {} rows of {} columns\n'.format(rows, columns)
+    elapsed = {}
+    for formatter in ('pgcli', 'fast'):
+        start = time.perf_counter()
+        size = sum(len(chunk) for chunk in format_rows(None, data, headers, None, formatter))
+        elapsed[formatter] = time.perf_counter() - start
+        out += '{:>12.1f} ms  {:>10.0f} rows/s  {:.1f} MB  {}\n'.format(
+            elapsed[formatter] * 1000, rows / elapsed[formatter] if elapsed[formatter] else 0,
+            size / 1024 / 1024, formatter)
+    if elapsed['fast']:
+        out += '-- fast is {:.1f}x the speed of pgcli\n'.format(elapsed['pgcli'] / elapsed['fast'])
+    panel.run_command('append', {'characters': out + '\n'})
+
+
+def get_streamable_sql(view, executor, sql):
+    """Return the statement to stream through a server-side cursor, or None
+
+    Only a single plain select can be declared as a cursor. Statements run
+    inside a user transaction are not streamed, since the stream has to
+    manage the transaction of the cursor by itself.
+    """
+    if not get(view, 'pgcli_stream_results'):
+        return None
+    status = executor.conn.get_transaction_status()
+    if status != ext.TRANSACTION_STATUS_IDLE:
+        return None
+
+    sql = sqlparse.format(sql, strip_comments=True).strip().rstrip(';').strip()
+    if (not STREAMABLE_SQL_RE.match(sql)
+            or NOT_STREAMABLE_SQL_RE.search(sql)
+            or sql.endswith('\\G')
+            or len(sqlparse.split(sql)) != 1):
+        return None
+    return sql
+
+
+class ResultStream:
+    """Server-side cursor feeding a select into the output panel in batches
+
+    Rows are fetched ``batch_size`` at a time and appended to the panel as
+    soon as they arrive. After ``page_size`` rows the cursor is left open in
+    its own transaction until the next page is requested or the stream is
+    closed. All pages make up one table, with the column widths of the first
+    batch.
+    """
+
+    def __init__(self, executor, sql, batch_size, page_size, result_viewer=None):
+        self.executor = executor
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.result_viewer = result_viewer
+        self.viewer = None  # ResultViewer the rows go to instead of the panel
+        self.headers = None
+        self.table = None  # Table of the rows shown in the panel
+        self.rowcount = 0
+        self.cur = None
+
+        # Named cursors can't live outside of a transaction
+        executor.conn.autocommit = False
+        try:
+            self.cur = executor.conn.cursor(name='pgcli_stream')
+            self.cur.itersize = batch_size
+            self.cur.execute(sql)
+        except BaseException:
+            self.close()
+            raise
+
+    @property
+    def closed(self):
+        return self.cur is None
+
+    def fetch_page(self, panel, start=None, timer=None):
+        """Append the next page of rows to the panel
+
+        Returns True if more rows are available afterwards.
+        """
+        try:
+            return self._fetch_page(panel, start, timer or QueryTimer())
+        except BaseException:
+            self.close()
+            raise
+
+    def _fetch_page(self, panel, start, timer):
+        fetched = 0
+        exhausted = False
+        while fetched < self.page_size:
+            size = min(self.batch_size, self.page_size - fetched)
+            with timer.phase('fetch'):
+                rows = self.cur.fetchmany(size)
+            self.executor.last_use = time.time()
+
+            if self.headers is None:
+                self.headers = [d[0] for d in self.cur.description]
+                if self.result_viewer:
+                    self.viewer = self.result_viewer(self.headers, None)
+            if start is not None:
+                out = 'done in {:.6} ms\n\n'.format((time.time() - start) * 1000)
+                panel.run_command('append', {'characters': out})
+                start = None
+
+            if rows and self.viewer:
+                with timer.phase('render'):
+                    self.viewer.append(rows)
+                timer.add_output(len(rows), '')
+                fetched += len(rows)
+            elif rows:
+                with timer.phase('format'):
+                    if len(self.headers) == 1:
+                        out = '\n'.join(str(r[0]) for r in rows) + '\n'
+                    elif self.table is None:
+                        self.table = Table(self.headers, 'NULL', settings.get('pgcli_max_cell_width'))
+                        out = self.table.header() + self.table.lines(self.table.measure(rows))
+                    elif not fetched:
+                        # The table goes on from the previous page
+                        out = self.table.border() + self.table.lines(self.table.fit(rows))
+                    else:
+                        out = self.table.lines(self.table.fit(rows))
+                timer.add_output(len(rows), out)
+                with timer.phase('render'):
+                    panel.run_command('append', {'characters': out})
+                fetched += len(rows)
+
+            if len(rows) < size:
+                exhausted = True
+                break
+
+        self.rowcount += fetched
+        out = ''
+        if self.table is not None and fetched:
+            out = self.table.border()
+        elif not self.rowcount and not self.viewer and len(self.headers) > 1:
+            # Show the headers of an empty result, like pgcli does
+            self.table = Table(self.headers)
+            out = self.table.header() + self.table.border()
+        if exhausted:
+            self.close()
+            if self.viewer:
+                self.viewer.finish()
+            out += '({} rows)\n\n'.format(self.rowcount)
+        else:
+            out += ('({} rows fetched, more rows available; '
+                    'run "Pgcli - Fetch more rows")\n\n').format(self.rowcount)
+        panel.run_command('append', {'characters': out})
+        return not exhausted
+
+    def close(self):
+        conn = self.executor.conn
+        if self.cur is not None:
+            try:
+                self.cur.close()
+            except psycopg2.Error:
+                pass
+            self.cur = None
+        if conn.closed:
+            return
+        try:
+            status = conn.get_transaction_status()
+            if status == ext.TRANSACTION_STATUS_INERROR:
+                conn.rollback()
+            elif status != ext.TRANSACTION_STATUS_ACTIVE:
+                conn.commit()
+            conn.autocommit = True
+        except psycopg2.Error as e:
+            logger.error('Error closing result stream: %r', e)
+
+
+def close_stream(view):
+    stream = streams.pop(view.id(), None)
+    if stream:
+        stream.close()
+
+
+class ResultViewer:
+    """Renders a window of the rows of a ResultStore into a scratch view
+
+    Only page_size rows are formatted at a time, however large the result.
+    """
+
+    def __init__(self, window, store, name, page_size):
+        self.store = store
+        self.page_size = page_size
+        self.offset = 0
+        self.title = None
+        self.view = window.new_file()
+        self.view.set_scratch(True)
+        self.view.set_name(name)
+        self.view.set_read_only(True)
+        self.view.settings().set('word_wrap', False)
+        self.view.settings().set('pgcli_is_result_view', True)
+
+    def append(self, rows):
+        shown = self.store.rowcount < self.offset + self.page_size
+        self.store.append(rows)
+        if shown:
+            self.render()
+
+    def finish(self):
+        self.store.complete = True
+        self.render()
+
+    def show(self, offset):
+        """Show the page starting at row offset, or the last full page"""
+        self.offset = max(0, min(offset, self.store.rowcount - self.page_size))
+        self.render()
+
+    def render(self):
+        rows = self.store.rows(self.offset, self.offset + self.page_size)
+        out = 'rows {}-{} of {}{}\n\n'.format(
+            self.offset + 1 if rows else 0, self.offset + len(rows),
+            self.store.rowcount, '' if self.store.complete else '+')
+        if self.title:
+            out = self.title + '\n' + out
+        if rows:
+            out += ''.join(format_rows(None, rows, self.store.headers, None))
+        self.view.run_command('pgcli_render_result', {'characters': out + '\n'})
+
+
+def open_result_viewer(view, headers, title=None):
+    """Returns the viewer for a new result of view, reusing its result view"""
+    store = ResultStore(
+        headers, max_memory=get(view, 'pgcli_result_view_max_memory') * 1024 * 1024)
+    viewer = result_viewers.get(view.id())
+    if viewer and viewer.view.is_valid():
+        viewer.store.close()
+        viewer.store = store
+        viewer.offset = 0
+    else:
+        name = 'Result: ' + os.path.basename(view.file_name() or view.name() or 'untitled')
+        viewer = ResultViewer(view.window() or sublime.active_window(), store, name,
+                              get(view, 'pgcli_result_view_page_size'))
+        result_viewers[view.id()] = viewer
+    viewer.title = title
+    viewer.render()
+    return viewer
+
+
+def find_result_viewer(view):
+    """The viewer of the results of view, or of the result view itself"""
+    viewer = result_viewers.get(view.id())
+    if viewer and viewer.view.is_valid():
+        return viewer
+    for viewer in result_viewers.values():
+        if viewer.view.id() == view.id():
+            return viewer
+    return None
+
+
+def close_result_viewer(viewer):
+    viewer.store.close()
+    for view_id, other in list(result_viewers.items()):
+        if other is viewer:
+            del result_viewers[view_id]
+
+
+def fetch_more_async(view):
+    panel = get_output_panel(view)
+    sublime.active_window().run_command('pgcli_show_output_panel')
+    stream = streams.get(view.id())
+    if not stream or stream.closed:
+        panel.run_command('append', {'characters': 'no more rows to fetch\n\n'})
+        return
+    # The view holds the stream's executor, acquiring it marks it busy
+    executor = checkout_executor(view, panel)
+    if executor is None:
+        return
+    with holding_executor(view, executor, panel):
+        if executor is not stream.executor:
+            # The stream's connection was closed in the meantime
+            close_stream(view)
+            panel.run_command('append', {'characters': 'no more rows to fetch\n\n'})
+            return
+        try:
+            stream.fetch_page(panel)
+        except psycopg2.Error as e:
+            out = '%s: %s\n\n%s' % (e.__class__.__name__, e, datetime.datetime.now())
+            panel.run_command('append', {'characters': out})
+        finally:
+            # Released to the pool once the stream is done
+            if stream.closed:
+                streams.pop(view.id(), None)
@@ -0,0 +1,150 @@
+import bisect
+import json
+import math
+import time
+
+from .pgcli_sublime_explain import walk
+from .pgcli_sublime_statements import single_statement
+
+JOIN_NODES = ('Nested Loop', 'Hash Join', 'Merge Join')
+
+
+def percentile(values, p):
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[max(-(-p * len(values) // 100) - 1, 0)]
+
+
+def summarize(durations):
+    """min/median/p95/max of durations, in the unit given"""
+    values = sorted(durations)
+    return {
+        'runs': len(values),
+        'min': values[0] if values else None,
+        'median': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'max': values[-1] if values else None,
+    }
+
+
+def timed_run(conn, sql, params=None):
+    """Run sql once, fetching all rows, and roll back whatever it changed
+
+    Returns the elapsed seconds. sql has to be a single statement, see
+    single_statement, a commit following it would escape the rollback.
+    """
+    sql = single_statement(sql)
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        start = time.perf_counter()
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            if cur.description:
+                cur.fetchall()
+        return time.perf_counter() - start
+    finally:
+        conn.rollback()
+        conn.autocommit = autocommit
+
+
+def explain_plan(conn, sql):
+    """The plan of sql from EXPLAIN (FORMAT JSON), without running it"""
+    with conn.cursor() as cur:
+        cur.execute('EXPLAIN (FORMAT JSON) ' + single_statement(sql))
+        plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def plan_shape(plan):
+    """How a plan reads each relation and which join strategies it uses
+
+    Returns ({relation alias: access method}, sorted join node types).
+    """
+    scans = {}
+    joins = []
+    for _, node in walk(plan):
+        if node.get('Relation Name'):
+            method = node['Node Type']
+            if node.get('Index Name'):
+                method += ' using ' + node['Index Name']
+            scans[node.get('Alias') or node['Relation Name']] = method
+        if node['Node Type'] in JOIN_NODES:
+            joins.append(node['Node Type'])
+    return scans, sorted(joins)
+
+
+def compare_plans(plans):
+    """Differences of the plans to the first one
+
+    plans is a list of (caption, plan). Returns lines describing relations
+    read differently (e.g. index vs seq scan) and different join strategies.
+    """
+    if len(plans) < 2:
+        return []
+    (base_caption, base_plan), others = plans[0], plans[1:]
+    base_scans, base_joins = plan_shape(base_plan)
+    out = []
+    for caption, plan in others:
+        scans, joins = plan_shape(plan)
+        for alias in sorted(set(base_scans) | set(scans)):
+            if base_scans.get(alias) != scans.get(alias):
+                out.append('{}: {} ({}) vs {} ({})'.format(
+                    alias, base_scans.get(alias, '-'), base_caption,
+                    scans.get(alias, '-'), caption))
+        if joins != base_joins:
+            out.append('joins: {} ({}) vs {} ({})'.format(
+                ', '.join(base_joins) or '-', base_caption,
+                ', '.join(joins) or '-', caption))
+    return out
+
+
+def histogram(values, buckets=12):
+    """Counts of values in power of two buckets
+
+    Returns a list of (upper bound, count), from the bucket holding the
+    smallest value up to the one holding the largest.
+    """
+    if not values:
+        return []
+    bound = 2.0 ** math.floor(math.log2(max(min(values), 1e-6)))
+    counts = []
+    remaining = sorted(values)
+    while remaining and len(counts) < buckets - 1:
+        bound *= 2
+        below = bisect.bisect_right(remaining, bound)
+        counts.append((bound, below))
+        remaining = remaining[below:]
+    if remaining:
+        counts.append((remaining[-1], len(remaining)))
+    return counts
+
+
+def format_histogram(counts, unit='ms', width=40):
+    largest = max((count for _, count in counts), default=0) or 1
+    return ['{:>12.3f} {} {:<{}} {}'.format(bound, unit, '#' * round(width * count / largest),
+                                            width, count)
+            for bound, count in counts]
+
+
+def read_results(path):
+    """The benchmark results recorded in a JSON lines file, oldest first"""
+    results = []
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    results.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return results
+
+
+def append_result(path, result):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result, default=str) + '\n')
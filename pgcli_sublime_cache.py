@@ -0,0 +1,91 @@
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from .pgcli_sublime_statements import iter_statements
+
+# Comments and whitespace outside of quotes don't make a different query
+KEY_TOKEN_RE = re.compile(r"""
+      '[^']*(?:''[^']*)*'
+    | "[^"]*(?:""[^"]*)*"
+    | \$(?P<tag>(?:[^\W\d]\w*)?)\$.*?\$(?P=tag)\$
+    | (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<space>\s+)
+""", re.VERBOSE | re.DOTALL)
+
+READ_ONLY_SQL_RE = re.compile(r'(select|values|table|with|show)\b', re.IGNORECASE)
+WRITE_SQL_RE = re.compile(
+    r'\b(insert|update|delete|merge|into|nextval|setval|lock|pg_advisory\w*)\b'
+    r'|\bfor\s+(no\s+key\s+)?(update|share|key\s+share)\b',
+    re.IGNORECASE
+)
+
+
+def cache_key(sql):
+    """sql without comments, with whitespace collapsed and no trailing ';'"""
+    def replace(m):
+        if m.group('comment') or m.group('space'):
+            return ' '
+        return m.group()
+    return KEY_TOKEN_RE.sub(replace, sql).strip().rstrip(';').strip()
+
+
+def is_read_only(key):
+    """Whether the statement of a cache_key can't change any data
+
+    Functions with side effects in a select are not detected, except for
+    sequences and advisory locks.
+    """
+    if not READ_ONLY_SQL_RE.match(key) or WRITE_SQL_RE.search(key):
+        return False
+    return sum(1 for _ in iter_statements(key)) == 1
+
+
+class ResultCache:
+    """Output of read-only queries, keyed by (url, cache_key)
+
+    Entries expire ttl seconds after they were stored. Beyond max_size
+    characters of output in total, the least recently used are evicted.
+    """
+
+    def __init__(self, ttl=300, max_size=32 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # Dict mapping (url, key) to (stored, output)
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, url, key):
+        """Returns (age in seconds, output), or None"""
+        with self.lock:
+            entry = self.entries.get((url, key))
+            if entry is None:
+                return None
+            age = time.time() - entry[0]
+            if age > self.ttl:
+                self._remove((url, key))
+                return None
+            self.entries.move_to_end((url, key))
+            return age, entry[1]
+
+    def put(self, url, key, output):
+        if len(output) > self.max_size:
+            return
+        with self.lock:
+            if (url, key) in self.entries:
+                self._remove((url, key))
+            self.entries[(url, key)] = (time.time(), output)
+            self.size += len(output)
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, url):
+        """Drop the results of url, after data or schema changed there"""
+        with self.lock:
+            for entry in [e for e in self.entries if e[0] == url]:
+                self._remove(entry)
+
+    def _remove(self, entry):
+        _, output = self.entries.pop(entry)
+        self.size -= len(output)
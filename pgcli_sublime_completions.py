@@ -0,0 +1,79 @@
+import re
+from threading import Lock
+
+# Words the completer matches by name, which may be narrowed as they grow
+NARROWABLE_WORD_RE = re.compile(r'"?[\w$]*$')
+WORD_BEFORE_CURSOR_RE = re.compile(r'\S*$')
+
+
+def word_before_cursor(text):
+    """The word pgcli completes, i.e. the non-whitespace before the cursor"""
+    return WORD_BEFORE_CURSOR_RE.search(text).group()
+
+
+def match_key(text):
+    return text.lower().replace('"', '')
+
+
+def fuzzy_match(needle, key):
+    """Whether the characters of needle appear in key in order"""
+    pos = 0
+    for char in needle:
+        pos = key.find(char, pos) + 1
+        if not pos:
+            return False
+    return True
+
+
+class CompletionCache:
+    """Completions of the last lookup in a view, narrowed as the word grows
+
+    pgcli matches the word before the cursor either by prefix or fuzzily, so
+    typing more identifier characters can only drop candidates. As long as the
+    rest of the statement and the completer are unchanged, the previous
+    candidates are filtered instead of running the completer again. Sublime
+    ranks the completions itself, so the previous order is kept.
+
+    The cache is used from the UI thread and the completion worker, its lock
+    is only held while the cached items are read or replaced.
+    """
+
+    def __init__(self):
+        self.context = None  # Whatever the completions depend on besides word
+        self.word = None
+        self.items = []  # (match key, Sublime completion tuple)
+        self.lock = Lock()
+
+    def get(self, context, word):
+        """Returns the cached completions for word, or None"""
+        with self.lock:
+            if context != self.context or not word.startswith(self.word):
+                return None
+            if word != self.word:
+                if not NARROWABLE_WORD_RE.match(word):
+                    return None
+                needle = match_key(word)
+                self.items = [item for item in self.items if fuzzy_match(needle, item[0])]
+                self.word = word
+            return [completion for _, completion in self.items]
+
+    def put(self, context, word, items):
+        """Cache items, a list of (completion text, Sublime completion tuple)"""
+        items = [(match_key(text), completion) for text, completion in items]
+        with self.lock:
+            self.context = context
+            self.word = word
+            self.items = items
+        return [completion for _, completion in items]
+
+    def candidates(self, word):
+        """The cached completions still matching word, whatever the context
+
+        A stale but instant answer for when the completer is too slow.
+        """
+        with self.lock:
+            cached, items = self.word, self.items
+        if cached is None or not NARROWABLE_WORD_RE.match(word):
+            return []
+        needle = match_key(word)
+        return [completion for key, completion in items if fuzzy_match(needle, key)]
@@ -0,0 +1,224 @@
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event, Thread
+
+logger = logging.getLogger('pgcli_sublime.engine')
+
+# What submit does with jobs of the same function already queued for a key:
+# queue after them, drop the new job if an identical one is queued, or drop
+# the queued ones
+POLICIES = ('queue', 'coalesce', 'replace')
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    """A blocking call queued for a key, usually a view id
+
+    ``cancel`` is called, off the event loop, to interrupt the call while it
+    runs, e.g. by cancelling the query on its connection. ``timeout`` is the
+    number of seconds after which it is cancelled by itself.
+    """
+
+    def __init__(self, func, args, name=None, cancel=None, timeout=None, on_timeout=None):
+        self.func = func
+        self.args = args
+        self.name = name or getattr(func, '__name__', 'job')
+        self.cancel = cancel
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.future = Future()
+        self.cancelled = Event()  # Set once a cancel was requested
+        self.started = None
+
+    def __repr__(self):
+        return '<Job {}>'.format(self.name)
+
+
+class ExecutionEngine:
+    """Runs jobs one at a time per key, driven by a single event loop thread
+
+    Jobs with the same key never overlap, so statements sent from one view
+    can't interleave on its connection. The blocking calls run on a fixed
+    pool of worker threads, while the loop keeps the per-key queues, applies
+    the timeouts and waits for cancelled jobs to actually finish.
+    """
+
+    def __init__(self, max_workers=8, name='pgcli_engine'):
+        self.name = name
+        self.limit = None  # Maximum number of jobs per key, running or queued
+        self.workers = ThreadPoolExecutor(max_workers=max_workers,
+                                          thread_name_prefix=name)
+        self.loop = None
+        self.thread = None
+        self.queues = {}  # Dict mapping keys to lists of pending jobs
+        self.running = {}  # Dict mapping keys to their running job
+        self.on_change = None  # Called with a key when its queue changes
+
+    def start(self):
+        if self.thread is not None:
+            return
+        # Importing asyncio takes a while, don't pay for it before it's used
+        global asyncio
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name=self.name)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Cancel all jobs and stop the loop thread
+
+        Jobs still running on a worker are asked to stop but not waited for.
+        """
+        if self.thread is not None:
+            self._call(self._cancel_all)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+            # Cancelling the consumers cancels the futures of running jobs
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self.loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+        self.workers.shutdown(wait=False)
+
+    def _call(self, func, *args):
+        """Run func on the loop thread and wait for its result"""
+        self.start()
+        result = Future()
+
+        def call():
+            try:
+                result.set_result(func(*args))
+            except BaseException as e:
+                result.set_exception(e)
+        self.loop.call_soon_threadsafe(call)
+        return result.result()
+
+    def submit(self, key, func, *args, policy='queue', **kwargs):
+        """Queue func(*args) for key, returns the Job
+
+        The job runs once the jobs queued before it for the same key are done.
+        With policy 'coalesce' the job already queued with the same function
+        and arguments is returned instead, with 'replace' the queued jobs of
+        the same function are dropped. Raises QueueFull when key has limit
+        jobs already. kwargs are passed to Job.
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy: {!r}'.format(policy))
+        job = Job(func, args, **kwargs)
+        return self._call(self._enqueue, key, job, policy)
+
+    def _enqueue(self, key, job, policy):
+        queue = self.queues.get(key, [])
+        if policy == 'coalesce':
+            for queued in queue:
+                if queued.func == job.func and queued.args == job.args:
+                    return queued
+        elif policy == 'replace':
+            for queued in [q for q in queue if q.func == job.func]:
+                queued.future.cancel()
+                queue.remove(queued)
+        if self.limit and self.depth(key) >= self.limit:
+            self._changed(key)
+            raise QueueFull('{} commands outstanding'.format(self.depth(key)))
+
+        if key not in self.queues:
+            self.queues[key] = queue
+            self.loop.create_task(self._consume(key, queue))
+        queue.append(job)
+        self._changed(key)
+        return job
+
+    async def _consume(self, key, queue):
+        while queue:
+            job = queue.pop(0)
+            self.running[key] = job
+            self._changed(key)
+            try:
+                await self._run(job)
+            finally:
+                del self.running[key]
+        del self.queues[key]
+        self._changed(key)
+
+    async def _run(self, job):
+        job.started = time.time()
+        done = self.loop.run_in_executor(self.workers, job.func, *job.args)
+        try:
+            if job.timeout:
+                try:
+                    await asyncio.wait_for(asyncio.shield(done), job.timeout)
+                except asyncio.TimeoutError:
+                    logger.debug('%r timed out after %s s', job, job.timeout)
+                    self._cancel_job(job)
+                    if job.on_timeout:
+                        job.on_timeout()
+            result = await done
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except BaseException as e:
+            logger.debug('%r failed: %r', job, e)
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+
+    def _cancel_job(self, job):
+        job.cancelled.set()
+        if job.cancel:
+            # Cancelling may need a round trip to the server
+            self.loop.run_in_executor(None, job.cancel)
+
+    def cancel(self, key):
+        """Drop the jobs queued for key and cancel the running one
+
+        Returns (running job or None, number of dropped jobs). The running
+        job's future is done once the job really stopped. Nothing can be
+        queued while the loop isn't running, so that isn't started for it.
+        """
+        if self.thread is None:
+            return None, 0
+        return self._call(self._cancel, key)
+
+    def _cancel(self, key):
+        queue = self.queues.get(key, [])
+        dropped = len(queue)
+        for job in queue:
+            job.future.cancel()
+        del queue[:]
+        job = self.running.get(key)
+        if job:
+            self._cancel_job(job)
+        if dropped:
+            self._changed(key)
+        return job, dropped
+
+    def _cancel_all(self):
+        for key in set(self.queues) | set(self.running):
+            self._cancel(key)
+
+    def is_cancelled(self, key):
+        """Whether the job running for key was asked to stop"""
+        job = self.running.get(key)
+        return job is not None and job.cancelled.is_set()
+
+    def depth(self, key):
+        """Number of jobs running or queued for key"""
+        if self.thread is None:
+            return 0
+        return len(self.queues.get(key, ())) + (key in self.running)
+
+    def _changed(self, key):
+        if self.on_change:
+            try:
+                self.on_change(key)
+            except Exception:
+                logger.exception('Error in on_change')
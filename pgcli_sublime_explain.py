@@ -0,0 +1,130 @@
+import json
+
+from .pgcli_sublime_statements import single_statement
+
+# Thresholds for what the analysis reports
+TOP_NODES = 5
+MISESTIMATE_FACTOR = 10
+LARGE_SEQ_SCAN_ROWS = 10000
+
+
+def explain_analyze(conn, sql):
+    """Run EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) of sql and roll it back
+
+    EXPLAIN ANALYZE really runs the statement, so whatever it changes is
+    rolled back: in a transaction of its own when none is open, otherwise
+    to a savepoint, so that the open transaction goes on. sql has to be a
+    single statement, a commit following it would escape the rollback.
+    """
+    explain = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + single_statement(sql)
+    # psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    if conn.get_transaction_status() == 0:
+        begin, rollback = ['BEGIN'], ['ROLLBACK']
+    else:
+        begin = ['SAVEPOINT pgcli_explain']
+        rollback = ['ROLLBACK TO SAVEPOINT pgcli_explain', 'RELEASE SAVEPOINT pgcli_explain']
+    with conn.cursor() as cur:
+        for statement in begin:
+            cur.execute(statement)
+        try:
+            cur.execute(explain)
+            plan = cur.fetchone()[0]
+        finally:
+            for statement in rollback:
+                cur.execute(statement)
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+def describe(node):
+    """A one line name of a plan node, like EXPLAIN's text format"""
+    name = node['Node Type']
+    if node.get('Index Name'):
+        name += ' using ' + node['Index Name']
+    if node.get('Relation Name'):
+        relation = node['Relation Name']
+        if node.get('Schema'):
+            relation = node['Schema'] + '.' + relation
+        name += ' on ' + relation
+        if node.get('Alias') and node['Alias'] != node['Relation Name']:
+            name += ' ' + node['Alias']
+    return name
+
+
+def walk(node, depth=0):
+    """Yields (depth, node) for the plan tree, annotated with inclusive and
+    exclusive time in ms"""
+    children = node.get('Plans', [])
+    node['Inclusive Time'] = node.get('Actual Total Time', 0) * node.get('Actual Loops', 1)
+    yield depth, node
+    for child in children:
+        yield from walk(child, depth + 1)
+    # Children are annotated by now
+    node['Exclusive Time'] = max(
+        node['Inclusive Time'] - sum(c['Inclusive Time'] for c in children), 0)
+
+
+def hit_ratio(hit, read):
+    return 100.0 * hit / (hit + read) if hit + read else 100.0
+
+
+def analyze(result):
+    """A text report of an EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) result"""
+    root = result['Plan']
+    nodes = [node for _, node in walk(root)]
+    total = result.get('Execution Time') or root['Inclusive Time'] or 1
+
+    hit, read = root.get('Shared Hit Blocks', 0), root.get('Shared Read Blocks', 0)
+    out = ['-- execution {:.3f} ms, planning {:.3f} ms, shared buffers {} hit, '
+           '{} read ({:.1f}% hit)'.format(
+               result.get('Execution Time', 0), result.get('Planning Time', 0),
+               hit, read, hit_ratio(hit, read))]
+
+    out.append('-- slowest nodes by exclusive time')
+    for node in sorted(nodes, key=lambda n: n['Exclusive Time'], reverse=True)[:TOP_NODES]:
+        out.append('{:>12.3f} ms {:>5.1f}%  {}  (rows {} x{} loops)'.format(
+            node['Exclusive Time'], 100.0 * node['Exclusive Time'] / total,
+            describe(node), node.get('Actual Rows', 0), node.get('Actual Loops', 1)))
+
+    misestimates = []
+    for node in nodes:
+        if not node.get('Actual Loops'):
+            continue  # Never executed
+        estimated, actual = node.get('Plan Rows', 0), node.get('Actual Rows', 0)
+        factor = max(estimated, actual) / max(min(estimated, actual), 1)
+        if factor >= MISESTIMATE_FACTOR:
+            misestimates.append((factor, estimated, actual, node))
+    if misestimates:
+        out.append('-- row misestimates ({}x or more)'.format(MISESTIMATE_FACTOR))
+        for factor, estimated, actual, node in sorted(
+                misestimates, key=lambda m: m[0], reverse=True):
+            out.append('{:>12.0f}x {}  {}, estimated {}, actual {}'.format(
+                factor, 'under' if actual > estimated else 'over ',
+                describe(node), estimated, actual))
+
+    reads = [node for node in nodes
+             if node.get('Relation Name') and node.get('Shared Read Blocks')]
+    if reads:
+        out.append('-- buffers read from outside shared buffers')
+        for node in sorted(reads, key=lambda n: n['Shared Read Blocks'], reverse=True):
+            hit, read = node.get('Shared Hit Blocks', 0), node['Shared Read Blocks']
+            out.append('{:>12} read {:>5.1f}% hit  {}'.format(
+                read, hit_ratio(hit, read), describe(node)))
+
+    scans = []
+    for node in nodes:
+        if node['Node Type'] not in ('Seq Scan', 'Parallel Seq Scan'):
+            continue
+        loops = node.get('Actual Loops', 1)
+        scanned = (node.get('Actual Rows', 0) + node.get('Rows Removed by Filter', 0)) * loops
+        if scanned >= LARGE_SEQ_SCAN_ROWS:
+            scans.append((scanned, node))
+    if scans:
+        out.append('-- sequential scans on large tables')
+        for scanned, node in sorted(scans, key=lambda s: s[0], reverse=True):
+            removed = node.get('Rows Removed by Filter', 0) * node.get('Actual Loops', 1)
+            out.append('{:>12} rows scanned, {} removed by filter  {}'.format(
+                scanned, removed, describe(node)))
+
+    return '\n'.join(out) + '\n'
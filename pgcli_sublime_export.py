@@ -0,0 +1,97 @@
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger('pgcli_sublime.export')
+
+# Formats the current query can be exported to, with their file extensions
+EXPORT_FORMATS = {
+    'csv': '.csv',
+    'jsonl': '.jsonl',
+    'parquet': '.parquet',
+}
+
+COPY_ROWS_RE = re.compile(r'COPY (\d+)')
+
+
+def copy_sql(sql, fmt):
+    """The COPY statement writing the result of sql in fmt to stdout
+
+    JSON Lines are copied in csv format with quote and delimiter characters
+    which never occur in JSON text, so the lines come out unescaped. Parquet
+    files are converted from csv.
+    """
+    if fmt == 'jsonl':
+        return ("COPY (SELECT row_to_json(q) FROM ({}) q) TO STDOUT "
+                "WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')").format(sql)
+    return 'COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)'.format(sql)
+
+
+class ProgressWriter:
+    """File wrapper counting the bytes and lines copied through it
+
+    progress is called with (lines, bytes) at most every interval seconds.
+    """
+
+    def __init__(self, file, progress=None, interval=0.5):
+        self.file = file
+        self.progress = progress
+        self.interval = interval
+        self.lines = 0
+        self.bytes = 0
+        self.reported = time.time()
+
+    def write(self, data):
+        self.file.write(data)
+        self.lines += data.count(b'\n')
+        self.bytes += len(data)
+        if self.progress and time.time() - self.reported >= self.interval:
+            self.reported = time.time()
+            self.progress(self.lines, self.bytes)
+
+
+def export(conn, sql, fmt, path, progress=None):
+    """Stream the result of sql into the file at path
+
+    Rows go straight from COPY to the file, so memory use doesn't depend on
+    the size of the result. Returns the number of rows exported. The file is
+    removed if the export fails or is cancelled.
+    """
+    target = path
+    if fmt == 'parquet':
+        # Fail before running the query if pyarrow is missing
+        pyarrow = import_pyarrow()
+        target = path + '.csv.tmp'
+    try:
+        with open(target, 'wb') as f, conn.cursor() as cur:
+            cur.copy_expert(copy_sql(sql, fmt), ProgressWriter(f, progress))
+            match = COPY_ROWS_RE.match(cur.statusmessage or '')
+        if fmt == 'parquet':
+            csv_to_parquet(pyarrow, target, path)
+    except BaseException:
+        for name in {target, path}:
+            if os.path.exists(name):
+                os.remove(name)
+        raise
+    finally:
+        if target != path and os.path.exists(target):
+            os.remove(target)
+    return int(match.group(1)) if match else None
+
+
+def import_pyarrow():
+    try:
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError('exporting to parquet needs pyarrow on pgcli_dirs')
+    return pyarrow
+
+
+def csv_to_parquet(pyarrow, csv_path, path):
+    """Convert a csv file to parquet one block at a time"""
+    reader = pyarrow.csv.open_csv(csv_path)
+    with pyarrow.parquet.ParquetWriter(path, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
@@ -0,0 +1,141 @@
+import binascii
+
+ELLIPSIS = '...'
+
+
+def cell_text(value, missing='NULL'):
+    """The text of a value as shown in a table cell, like cli_helpers'"""
+    if value is None:
+        return missing
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (bytes, memoryview)):
+        value = bytes(value)
+        try:
+            text = value.decode('utf8')
+        except UnicodeDecodeError:
+            text = None
+        if text is None or not text.isprintable():
+            return '0x' + binascii.hexlify(value).decode('ascii')
+        return text
+    return str(value)
+
+
+def truncate(text, width):
+    """text cut to width characters, with an ellipsis at the end
+
+    Multi-line text is left alone, like cli_helpers does.
+    """
+    if len(text) <= width or '\n' in text:
+        return text
+    return text[:max(width - len(ELLIPSIS), 0)] + ELLIPSIS
+
+
+class Table:
+    """A psql style table, written out a chunk of rows at a time
+
+    The column widths are measured on the rows passed to measure(), in the
+    same pass which turns their cells into text. Rows written with fit()
+    afterwards, e.g. the later pages of a streamed result, keep those widths:
+    their wider cells are cut off at the column width, so that they still
+    line up with the header.
+    """
+
+    def __init__(self, headers, missing='NULL', max_cell_width=None):
+        self.missing = missing
+        self.max_cell_width = max_cell_width
+        self.headers = self.cells(headers, '')
+        self.widths = [self.line_width(h) for h in self.headers]
+
+    def cells(self, row, missing):
+        cells = [cell_text(v, missing) for v in row]
+        width = self.max_cell_width
+        if width:
+            cells = [c if len(c) <= width else truncate(c, width) for c in cells]
+        return cells
+
+    @staticmethod
+    def line_width(text):
+        return max(map(len, text.split('\n'))) if '\n' in text else len(text)
+
+    def measure(self, rows):
+        """The rows as lists of cell texts, widening the columns to fit them"""
+        table = []
+        widths = self.widths
+        for row in rows:
+            cells = self.cells(row, self.missing)
+            if '\n' in '\0'.join(cells):
+                widths = list(map(max, widths, map(self.line_width, cells)))
+            else:
+                widths = list(map(max, widths, map(len, cells)))
+            table.append(cells)
+        self.widths = widths
+        return table
+
+    def fit(self, rows):
+        """The rows as lists of cell texts, cut to the measured widths"""
+        table = []
+        widths = self.widths
+        for row in rows:
+            cells = self.cells(row, self.missing)
+            if any(map(int.__gt__, map(len, cells), widths)):
+                cells = [self.fit_cell(c, w) for c, w in zip(cells, widths)]
+            table.append(cells)
+        return table
+
+    @staticmethod
+    def fit_cell(text, width):
+        if '\n' in text:
+            return '\n'.join(Table.fit_cell(line, width) for line in text.split('\n'))
+        if len(text) <= width:
+            return text
+        return text[:max(width - len(ELLIPSIS), 0)] + ELLIPSIS[:width]
+
+    def border(self):
+        return '+' + '+'.join('-' * (w + 2) for w in self.widths) + '+\n'
+
+    def header(self):
+        border = self.border()
+        return border + self.lines([self.headers]) + '|' + border[1:-2] + '|\n'
+
+    def lines(self, table):
+        """The text of rows of cell texts, as returned by measure or fit"""
+        line = '| ' + ' | '.join('{:<%d}' % w for w in self.widths) + ' |'
+        lines = []
+        for cells in table:
+            if '\n' in '\0'.join(cells):
+                lines.extend(split_row(line, cells))
+            else:
+                lines.append(line.format(*cells))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+def split_row(line, cells):
+    """The lines of a row whose cells span several lines"""
+    cells = [c.split('\n') for c in cells]
+    height = max(map(len, cells))
+    return [line.format(*(c[i] if i < len(c) else '' for c in cells))
+            for i in range(height)]
+
+
+def format_table(title, rows, headers, status, missing='NULL', max_cell_width=None,
+                 chunk_rows=1000):
+    """Yields a result as a psql style table, like pgcli's format_output
+
+    Every cell is turned into text once, while the column widths are
+    measured, and the lines are then written straight from those texts.
+    Cells wider than max_cell_width are cut off with an ellipsis. The text
+    is yielded in chunks of chunk_rows rows, each ending with a newline, so
+    large tables can be shown while they are still being formatted.
+    """
+    if title:
+        yield title + '\n'
+    if headers and rows is not None:
+        table = Table(headers, missing, max_cell_width)
+        cells = table.measure(rows)
+        yield table.header()
+        for start in range(0, len(cells), chunk_rows):
+            yield table.lines(cells[start:start + chunk_rows])
+        yield table.border()
+    if status:
+        yield status + '\n'
@@ -0,0 +1,140 @@
+import hashlib
+import logging
+import os
+import re
+import time
+from threading import Lock
+
+logger = logging.getLogger('pgcli_sublime.history')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS statements (
+    fingerprint TEXT PRIMARY KEY,
+    statement TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    url TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    duration_ms REAL NOT NULL,
+    rows INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS history_latency ON history (url, fingerprint, duration_ms);
+CREATE INDEX IF NOT EXISTS history_ts ON history (ts);
+"""
+
+# Tokens normalize() rewrites; literals and comments don't make a different query
+NORMALIZE_RE = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<literal>'(?:[^']|'')*'|\$(?P<tag>\w*)\$.*?\$(?P=tag)\$
+                  |\b\d+(?:\.\d+)?(?:e[-+]?\d+)?\b)
+    | (?P<space>\s+)
+    | (?P<quoted>"(?:[^"]|"")*")
+    | (?P<word>[a-z_]\w*)
+""", re.VERBOSE | re.DOTALL | re.IGNORECASE)
+IN_LIST_RE = re.compile(r'\(\?(?:\s*,\s*\?)+\)')
+
+
+def normalize(sql):
+    """sql with comments dropped, literals replaced by ? and whitespace collapsed"""
+    def replace(match):
+        if match.group('comment') or match.group('space'):
+            return ' '
+        if match.group('literal'):
+            return '?'
+        if match.group('word'):
+            return match.group().lower()
+        # Quoted identifiers keep their case
+        return match.group()
+    sql = NORMALIZE_RE.sub(replace, sql)
+    sql = IN_LIST_RE.sub('(?)', sql)
+    return re.sub(r' +', ' ', sql).strip().rstrip(';').strip()
+
+
+def error_summary(error):
+    """The SQLSTATE and primary message of an error, or None
+
+    The detail of Postgres errors often quotes row values, e.g. "Key
+    (email)=(...) already exists", which the history doesn't keep.
+    """
+    if error is None:
+        return None
+    message = getattr(getattr(error, 'diag', None), 'message_primary', None)
+    if message is None:
+        lines = str(error).strip().splitlines()
+        message = lines[0] if lines else error.__class__.__name__
+    code = getattr(error, 'pgcode', None)
+    return '{}: {}'.format(code, message) if code else message
+
+
+def fingerprint(statement):
+    return hashlib.sha1(statement.encode('utf-8')).hexdigest()[:16]
+
+
+class QueryHistory:
+    """Append-only history of the queries run, in an SQLite database
+
+    Only the normalized statement is kept, once per fingerprint. The index on
+    (url, fingerprint, duration_ms) answers percentiles of a query without
+    sorting, the one on ts the slowest queries of a period.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self.lock = Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def add(self, url, sql, duration_ms, rows=None, error=None, ts=None):
+        statement = normalize(sql)
+        fp = fingerprint(statement)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO statements (fingerprint, statement) VALUES (?, ?)',
+                (fp, statement))
+            self.conn.execute(
+                'INSERT INTO history (ts, url, fingerprint, duration_ms, rows, error) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (time.time() if ts is None else ts, url, fp, duration_ms, rows, error))
+        return fp
+
+    def percentiles(self, url, sql, percentiles=(50, 95)):
+        """Returns (count, {percentile: duration_ms}) of the query on url"""
+        fp = fingerprint(normalize(sql))
+        with self.lock:
+            count, = self.conn.execute(
+                'SELECT count(*) FROM history WHERE url = ? AND fingerprint = ?',
+                (url, fp)).fetchone()
+            result = {}
+            for p in percentiles if count else ():
+                # Nearest rank, read straight from the index
+                offset = max(-(-p * count // 100) - 1, 0)
+                result[p], = self.conn.execute(
+                    'SELECT duration_ms FROM history WHERE url = ? AND fingerprint = ? '
+                    'ORDER BY duration_ms LIMIT 1 OFFSET ?',
+                    (url, fp, offset)).fetchone()
+        return count, result
+
+    def slowest(self, since, limit=20, url=None):
+        """Returns (ts, url, duration_ms, rows, error, statement) of the slowest
+        queries run after since, optionally only on url"""
+        sql = ('SELECT h.ts, h.url, h.duration_ms, h.rows, h.error, s.statement '
+               'FROM history h JOIN statements s USING (fingerprint) WHERE h.ts >= ?')
+        params = [since]
+        if url:
+            sql += ' AND h.url = ?'
+            params.append(url)
+        sql += ' ORDER BY h.duration_ms DESC LIMIT ?'
+        params.append(limit)
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
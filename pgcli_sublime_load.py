@@ -0,0 +1,120 @@
+import logging
+import os
+import time
+
+logger = logging.getLogger('pgcli_sublime.load')
+
+# Formats data can be loaded from, by file extension
+LOAD_FORMATS = {
+    '.csv': 'csv',
+    '.tsv': 'tsv',
+    '.tab': 'tsv',
+    '.txt': 'tsv',
+}
+
+
+def load_format(file_name):
+    """The format of a file by its extension, csv if unknown"""
+    ext = os.path.splitext(file_name or '')[1].lower()
+    return LOAD_FORMATS.get(ext, 'csv')
+
+
+def copy_from_sql(table, fmt):
+    if fmt == 'csv':
+        return 'COPY {} FROM STDIN WITH (FORMAT csv)'.format(table)
+    # Tab separated text is COPY's own text format
+    return 'COPY {} FROM STDIN'.format(table)
+
+
+def iter_lines(text):
+    """Yields the lines of text, keeping line ends, without copying it whole"""
+    pos = 0
+    while pos < len(text):
+        end = text.find('\n', pos)
+        end = len(text) if end < 0 else end + 1
+        yield text[pos:end]
+        pos = end
+
+
+class BatchReader:
+    """File-like object feeding at most batch_size rows to copy_expert
+
+    Quoted csv fields may span lines; a row only ends on a line which leaves
+    no quote open. Quotes inside fields are doubled, so counting them is
+    enough to tell.
+    """
+
+    def __init__(self, lines, batch_size, quoted):
+        self.lines = lines
+        self.batch_size = batch_size
+        self.quoted = quoted
+        self.rows = 0
+        self.bytes = 0
+        self.in_quotes = False
+        self.exhausted = False
+        self.next_line = next(self.lines, None)
+        if self.next_line is None:
+            self.exhausted = True
+
+    def __bool__(self):
+        return self.next_line is not None
+
+    def read(self, size=-1):
+        parts = []
+        length = 0
+        while self.next_line is not None and (size < 0 or length < size):
+            line = self.next_line
+            if self.quoted and line.count('"') % 2:
+                self.in_quotes = not self.in_quotes
+            if self.in_quotes:
+                parts.append(line)
+                length += len(line)
+            elif line.strip('\r\n'):
+                if not line.endswith('\n'):
+                    line += '\n'
+                parts.append(line)
+                length += len(line)
+                self.rows += 1
+            # else an empty line, e.g. at the end of the buffer
+
+            if not self.in_quotes and self.rows >= self.batch_size:
+                # Leave the next row to the next batch
+                self.next_line = None
+                break
+            self.next_line = next(self.lines, None)
+            if self.next_line is None:
+                self.exhausted = True
+        data = ''.join(parts)
+        self.bytes += len(data)
+        return data
+
+
+def load(conn, table, lines, fmt, batch_size, header=True, progress=None):
+    """Stream lines into table with one COPY per batch_size rows
+
+    In autocommit mode every batch is committed on its own, inside a
+    transaction they all become part of it. progress is called with (rows,
+    bytes, seconds) after every batch. Returns the same for the whole load.
+    """
+    lines = iter(lines)
+    quoted = fmt == 'csv'
+    if header:
+        # Skip the header row, which may span lines too
+        BatchReader(lines, 1, quoted).read()
+
+    sql = copy_from_sql(table, fmt)
+    rows = size = 0
+    start = time.time()
+    while True:
+        batch = BatchReader(lines, batch_size, quoted)
+        if not batch:
+            break
+        with conn.cursor() as cur:
+            cur.copy_expert(sql, batch)
+        rows += batch.rows
+        size += batch.bytes
+        if progress:
+            progress(rows, size, time.time() - start)
+        if batch.exhausted:
+            break
+    return rows, size, time.time() - start
@@ -0,0 +1,437 @@
+import hashlib
+import logging
+import os
+import pickle
+import re
+import time
+
+logger = logging.getLogger('pgcli_sublime.metadata')
+
+# Bump when the layout of the cached metadata changes
+CACHE_VERSION = 1
+
+
+def load_metadata(executor):
+    """Fetch everything the completer needs from the database
+
+    Returns a dict of plain lists, in the form the PGCompleter.extend_*
+    methods expect.
+    """
+    return {
+        'search_path': executor.search_path(),
+        'schemata': executor.schemata(),
+        'tables': list(executor.tables()),
+        'table_columns': list(executor.table_columns()),
+        'foreignkeys': list(executor.foreignkeys()),
+        'views': list(executor.views()),
+        'view_columns': list(executor.view_columns()),
+        'datatypes': list(executor.datatypes()),
+        'databases': executor.databases(),
+        'functions': list(executor.functions()),
+    }
+
+
+def build_completer(metadata, special=None):
+    """Returns a PGCompleter populated from metadata"""
+    from pgcli.pgcompleter import PGCompleter
+
+    completer = PGCompleter(smart_completion=True, pgspecial=special)
+    completer.set_search_path(metadata['search_path'])
+    completer.extend_schemata(metadata['schemata'])
+    completer.extend_relations(metadata['tables'], kind='tables')
+    completer.extend_columns(metadata['table_columns'], kind='tables')
+    completer.extend_foreignkeys(metadata['foreignkeys'])
+    completer.extend_relations(metadata['views'], kind='views')
+    completer.extend_columns(metadata['view_columns'], kind='views')
+    completer.extend_datatypes(metadata['datatypes'])
+    completer.extend_database_names(metadata['databases'])
+    completer.extend_functions(metadata['functions'])
+    return completer
+
+
+def cache_file(cache_dir, url):
+    # Hash the url, so passwords don't end up in file names
+    name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, name + '.pickle')
+
+
+def read_cache(cache_dir, url):
+    """Returns the cached metadata for url, or None"""
+    import pgcli
+
+    path = cache_file(cache_dir, url)
+    try:
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # Corrupt file, or pickled by a pgcli version which is gone
+        logger.warning('Ignoring metadata cache %r: %r', path, e)
+        return None
+
+    if (cached.get('version') != CACHE_VERSION
+            or cached.get('pgcli_version') != pgcli.__version__):
+        return None
+    logger.debug('Loaded metadata cache for %r saved at %s', url,
+                 time.ctime(cached['saved']))
+    return cached['metadata']
+
+
+def write_cache(cache_dir, url, metadata):
+    import pgcli
+
+    path = cache_file(cache_dir, url)
+    cached = {
+        'version': CACHE_VERSION,
+        'pgcli_version': pgcli.__version__,
+        'saved': time.time(),
+        'metadata': metadata,
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+    # Readers never see a half written file
+    os.replace(tmp_path, path)
+
+
+IDENT = r'(?:"(?:[^"]|"")+"|[^\s.,;()"]+)'
+NAME = r'({0}(?:\s*\.\s*{0})?)'.format(IDENT)
+RELATION_KIND = r'(?:table|view|materialized\s+view|foreign\s+table)'
+
+CREATE_RELATION_RE = re.compile(
+    r'create\s+(?:or\s+replace\s+)?(?:(?:global|local)\s+)?'
+    r'(?:(?:temp|temporary|unlogged)\s+)?(?:recursive\s+)?'
+    + RELATION_KIND + r'\s+(?:if\s+not\s+exists\s+)?' + NAME,
+    re.IGNORECASE)
+ALTER_RELATION_RE = re.compile(
+    r'alter\s+' + RELATION_KIND + r'\s+(?:if\s+exists\s+)?(?:only\s+)?' + NAME
+    + r'(?:.*?\brename\s+to\s+' + NAME + r'|.*?\bset\s+schema\s+' + NAME + r')?',
+    re.IGNORECASE | re.DOTALL)
+DROP_RELATION_RE = re.compile(
+    r'drop\s+' + RELATION_KIND + r'\s+(?:if\s+exists\s+)?'
+    + r'({0}(?:\s*,\s*{0})*)'.format(NAME.replace('(', '(?:', 1)),
+    re.IGNORECASE)
+SCHEMA_RE = re.compile(
+    r'(?:create|alter|drop)\s+schema\s+(?:if\s+(?:not\s+)?exists\s+)?' + NAME,
+    re.IGNORECASE)
+CATEGORY_RES = (
+    (re.compile(r'(?:create(?:\s+or\s+replace)?|alter|drop)\s+'
+                r'(?:function|procedure|aggregate)\b', re.IGNORECASE), 'functions'),
+    (re.compile(r'(?:create|alter|drop)\s+(?:type|domain)\b', re.IGNORECASE), 'datatypes'),
+    (re.compile(r'(?:create|alter|drop)\s+database\b', re.IGNORECASE), 'databases'),
+)
+# DDL which doesn't change anything the completer knows about
+IGNORED_DDL_RE = re.compile(
+    r'(?:(?:create|alter|drop)\s+(?:unique\s+)?(?:index|sequence|trigger|rule|policy'
+    r'|role|user|group|statistics|publication|subscription|event\s+trigger'
+    r'|tablespace|server|user\s+mapping|cast|operator|collation|conversion'
+    r'|text\s+search|language|default\s+privileges)\b'
+    r'|create\s+(?:unique\s+)?index\b|comment\s+on\b)',
+    re.IGNORECASE)
+DDL_RE = re.compile(r'(?:^|;)\s*(?:create|alter|drop|comment|import)\b',
+                    re.IGNORECASE | re.MULTILINE)
+
+
+def split_name(name):
+    """Returns (schema or None, name) of a possibly qualified sql name"""
+    parts = re.findall(IDENT, name)
+
+    def normalize(ident):
+        if ident.startswith('"'):
+            return ident[1:-1].replace('""', '"')
+        return ident.lower()
+
+    parts = [normalize(p) for p in parts]
+    return (None, parts[0]) if len(parts) == 1 else (parts[0], parts[1])
+
+
+class CatalogChanges:
+    """Objects changed by ddl statements, as far as the completer cares
+
+    ``relations`` holds (raw name, schema, name) tuples of tables and views,
+    ``schemata`` the names of changed schemas and ``categories`` the kinds of
+    objects ('functions', 'datatypes', 'databases') which have to be fetched
+    again as a whole. ``full`` is set when the changes couldn't be worked out.
+    """
+
+    def __init__(self):
+        self.relations = set()
+        self.schemata = set()
+        self.categories = set()
+        self.full = False
+
+    def __bool__(self):
+        return bool(self.full or self.relations or self.schemata or self.categories)
+
+    def update(self, other):
+        self.relations |= other.relations
+        self.schemata |= other.schemata
+        self.categories |= other.categories
+        self.full = self.full or other.full
+
+    def add_relation(self, raw):
+        schema, name = split_name(raw)
+        self.relations.add((raw, schema, name))
+
+
+def catalog_changes(sql):
+    """Works out which objects the ddl statements in sql change"""
+    import sqlparse
+
+    changes = CatalogChanges()
+    if not DDL_RE.search(sql):
+        return changes
+
+    for statement in sqlparse.split(sql):
+        statement = sqlparse.format(statement, strip_comments=True).strip()
+        if not DDL_RE.match(statement):
+            continue
+
+        m = CREATE_RELATION_RE.match(statement)
+        if m:
+            changes.add_relation(m.group(1))
+            continue
+
+        m = ALTER_RELATION_RE.match(statement)
+        if m:
+            old, renamed, moved = m.groups()
+            changes.add_relation(old)
+            old_parts = re.findall(IDENT, old)
+            if renamed and len(old_parts) > 1:
+                # The table stays in its schema
+                changes.add_relation('{}.{}'.format(old_parts[0], renamed))
+            elif renamed:
+                changes.add_relation(renamed)
+            elif moved:
+                changes.add_relation('{}.{}'.format(moved, old_parts[-1]))
+            continue
+
+        m = DROP_RELATION_RE.match(statement)
+        if m:
+            for raw in re.findall(NAME, m.group(1)):
+                changes.add_relation(raw)
+            continue
+
+        m = SCHEMA_RE.match(statement)
+        if m:
+            changes.schemata.add(split_name(m.group(1))[1])
+            continue
+
+        for regex, category in CATEGORY_RES:
+            if regex.match(statement):
+                changes.categories.add(category)
+                break
+        else:
+            if not IGNORED_DDL_RE.match(statement):
+                logger.debug('Unknown catalog change: %r', statement[:100])
+                changes.full = True
+    return changes
+
+
+RELATIONS_QUERY = """
+    SELECT c.oid, n.nspname schema_name, c.relname, c.relkind
+    FROM   pg_catalog.pg_class c
+           INNER JOIN pg_catalog.pg_namespace n
+               ON n.oid = c.relnamespace
+    WHERE  c.oid = ANY(SELECT pg_catalog.to_regclass(name)::oid
+                       FROM   unnest(%s::text[]) name)
+           AND c.relkind = ANY(%s)"""
+
+COLUMNS_QUERY = """
+    SELECT  nsp.nspname schema_name,
+            cls.relname table_name,
+            att.attname column_name,
+            att.atttypid::regtype::text type_name,
+            att.atthasdef AS has_default,
+            pg_catalog.pg_get_expr(def.adbin, def.adrelid, true) as default
+    FROM    pg_catalog.pg_attribute att
+            INNER JOIN pg_catalog.pg_class cls
+                ON att.attrelid = cls.oid
+            INNER JOIN pg_catalog.pg_namespace nsp
+                ON cls.relnamespace = nsp.oid
+            LEFT OUTER JOIN pg_attrdef def
+                ON def.adrelid = att.attrelid
+                AND def.adnum = att.attnum
+    WHERE   cls.oid = ANY(%s::oid[])
+            AND NOT att.attisdropped
+            AND att.attnum  > 0
+    ORDER BY 1, 2, att.attnum"""
+
+FOREIGNKEYS_QUERY = """
+    SELECT s_p.nspname AS parentschema,
+           t_p.relname AS parenttable,
+           unnest((
+            select
+                array_agg(attname ORDER BY i)
+            from
+                (select unnest(confkey) as attnum, generate_subscripts(confkey, 1) as i) x
+                JOIN pg_catalog.pg_attribute c USING(attnum)
+                WHERE c.attrelid = fk.confrelid
+            )) AS parentcolumn,
+           s_c.nspname AS childschema,
+           t_c.relname AS childtable,
+           unnest((
+            select
+                array_agg(attname ORDER BY i)
+            from
+                (select unnest(conkey) as attnum, generate_subscripts(conkey, 1) as i) x
+                JOIN pg_catalog.pg_attribute c USING(attnum)
+                WHERE c.attrelid = fk.conrelid
+            )) AS childcolumn
+    FROM pg_catalog.pg_constraint fk
+    JOIN pg_catalog.pg_class      t_p ON t_p.oid = fk.confrelid
+    JOIN pg_catalog.pg_namespace  s_p ON s_p.oid = t_p.relnamespace
+    JOIN pg_catalog.pg_class      t_c ON t_c.oid = fk.conrelid
+    JOIN pg_catalog.pg_namespace  s_c ON s_c.oid = t_c.relnamespace
+    WHERE fk.contype = 'f'
+          AND (fk.conrelid = ANY(%s::oid[]) OR fk.confrelid = ANY(%s::oid[]))"""
+
+TABLE_KINDS = ('r', 'p', 'f')
+VIEW_KINDS = ('v', 'm')
+
+
+def fetch_changes(executor, metadata, changes):
+    """Re-query the objects in changes
+
+    Returns a patch for patch_metadata and patch_completer. Only the changed
+    relations are read again, while functions, types and databases are read
+    again as a whole if any of them changed.
+    """
+    from pgcli.packages.parseutils.meta import ForeignKey
+
+    patch = {
+        'removed': set(),  # (schema, relation) pairs to drop
+        'schemata': None,
+        'dropped_schemata': set(),
+        'tables': [],
+        'views': [],
+        'table_columns': [],
+        'view_columns': [],
+        'foreignkeys': [],
+    }
+    removed = patch['removed']
+
+    # Relations which are gone are resolved from the cached search_path
+    known = set(metadata['tables']) | set(metadata['views'])
+    for raw, schema, name in changes.relations:
+        if schema:
+            removed.add((schema, name))
+            continue
+        for schema in metadata['search_path']:
+            if (schema, name) in known:
+                removed.add((schema, name))
+                break
+
+    if changes.schemata:
+        patch['schemata'] = executor.schemata()
+        patch['search_path'] = executor.search_path()
+        patch['dropped_schemata'] = set(metadata['schemata']) - set(patch['schemata'])
+
+    with executor.conn.cursor() as cur:
+        if changes.relations:
+            cur.execute(RELATIONS_QUERY, ([raw for raw, _, _ in changes.relations],
+                                          list(TABLE_KINDS + VIEW_KINDS)))
+            oids = []
+            for oid, schema, relname, relkind in cur.fetchall():
+                oids.append(oid)
+                removed.add((schema, relname))
+                kind = 'tables' if relkind in TABLE_KINDS else 'views'
+                patch[kind].append((schema, relname))
+
+            cur.execute(COLUMNS_QUERY, (oids,))
+            tables = set(patch['tables'])
+            for row in cur.fetchall():
+                kind = 'table_columns' if tuple(row[:2]) in tables else 'view_columns'
+                patch[kind].append(row)
+
+            if executor.conn.server_version >= 90000:
+                cur.execute(FOREIGNKEYS_QUERY, (oids, oids))
+                patch['foreignkeys'] = [ForeignKey(*row) for row in cur.fetchall()]
+
+    for category in changes.categories:
+        patch[category] = list(getattr(executor, category)())
+
+    # Foreign keys of unchanged tables pointing at changed ones
+    patch['stale_foreignkeys'] = [
+        fk for fk in metadata['foreignkeys']
+        if not _keep(patch, fk.parentschema, fk.parenttable)
+        or not _keep(patch, fk.childschema, fk.childtable)]
+    return patch
+
+
+def _keep(patch, schema, relname):
+    return ((schema, relname) not in patch['removed']
+            and schema not in patch['dropped_schemata'])
+
+
+def patch_metadata(metadata, patch):
+    """Apply a patch from fetch_changes to the metadata dict"""
+    def keep(row):
+        return _keep(patch, row[0], row[1])
+
+    for kind in ('tables', 'views', 'table_columns', 'view_columns'):
+        metadata[kind] = [row for row in metadata[kind] if keep(row)] + patch[kind]
+    stale = set(patch['stale_foreignkeys'])
+    metadata['foreignkeys'] = [fk for fk in metadata['foreignkeys']
+                               if fk not in stale] + patch['foreignkeys']
+
+    dropped = patch['dropped_schemata']
+    if patch['schemata'] is not None:
+        metadata['schemata'] = patch['schemata']
+        metadata['search_path'] = patch['search_path']
+    for category in ('functions', 'datatypes', 'databases'):
+        if category in patch:
+            metadata[category] = patch[category]
+    if dropped:
+        metadata['functions'] = [f for f in metadata['functions']
+                                 if f.schema_name not in dropped]
+        metadata['datatypes'] = [t for t in metadata['datatypes']
+                                 if t[0] not in dropped]
+
+
+def patch_completer(completer, patch):
+    """Apply a patch from fetch_changes to a live PGCompleter"""
+    e = completer.escape_name
+    dbmetadata = completer.dbmetadata
+
+    removed = {(e(schema), e(relname)) for schema, relname in patch['removed']}
+    for kind in ('tables', 'views'):
+        for schema, relname in removed:
+            dbmetadata[kind].get(schema, {}).pop(relname, None)
+
+    # Forget foreign keys of unchanged tables pointing at changed ones
+    for fk in patch['stale_foreignkeys']:
+        for schema, relname in ((fk.parentschema, fk.parenttable),
+                                (fk.childschema, fk.childtable)):
+            columns = dbmetadata['tables'].get(e(schema), {}).get(e(relname), {})
+            for column in columns.values():
+                column.foreignkeys[:] = [
+                    f for f in column.foreignkeys
+                    if (f.parentschema, f.parenttable) not in removed
+                    and (f.childschema, f.childtable) not in removed]
+
+    for schema in patch['dropped_schemata']:
+        for kind_metadata in dbmetadata.values():
+            kind_metadata.pop(e(schema), None)
+    if patch['schemata'] is not None:
+        completer.extend_schemata([s for s in patch['schemata']
+                                   if e(s) not in dbmetadata['tables']])
+        completer.set_search_path(patch['search_path'])
+
+    completer.extend_relations(patch['tables'], kind='tables')
+    completer.extend_columns(patch['table_columns'], kind='tables')
+    completer.extend_relations(patch['views'], kind='views')
+    completer.extend_columns(patch['view_columns'], kind='views')
+    completer.extend_foreignkeys(patch['foreignkeys'])
+
+    if 'functions' in patch:
+        dbmetadata['functions'] = {schema: {} for schema in dbmetadata['tables']}
+        completer.extend_functions(patch['functions'])
+    if 'datatypes' in patch:
+        dbmetadata['datatypes'] = {schema: {} for schema in dbmetadata['tables']}
+        completer.extend_datatypes(patch['datatypes'])
+    if 'databases' in patch:
+        completer.databases = []
+        completer.extend_database_names(patch['databases'])
@@ -0,0 +1,168 @@
+import logging
+import time
+from threading import Condition
+
+logger = logging.getLogger('pgcli_sublime.pool')
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Pool of executor connections to a single url
+
+    Executors are handed out with ``checkout`` and given back with
+    ``checkin``; at most ``max_size`` connections are open at a time. Idle
+    connections are kept around until ``reap`` closes the ones which weren't
+    used for a while, leaving at least ``min_size`` open, and ``ping`` keeps
+    the others alive. ``on_checkin`` is called after every checkin, e.g. to
+    schedule those.
+
+    Executors which are ``pin``ned, held on to by a view e.g. for a
+    transaction or a result stream, don't count against ``max_size`` until
+    they are checked in or discarded, so they never starve the others.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, on_checkin=None):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.on_checkin = on_checkin
+        self.idle = []  # Executors ready for checkout, most recently used last
+        self.size = 0  # Number of open connections, idle or checked out
+        self.pinned = set()  # Checked out executors not counted against max_size
+        self.closed = False  # Set by close, executors checked in are closed
+        self.cond = Condition()
+
+    def checkout(self, timeout=None):
+        """Returns an idle executor, or connects a new one if there is room"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while True:
+                while self.idle:
+                    executor = self.idle.pop()
+                    if not executor.conn.closed:
+                        return executor
+                    self.size -= 1
+                if self.size - len(self.pinned) < self.max_size:
+                    self.size += 1
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout(
+                        'all {} connections are busy'.format(self.max_size))
+                self.cond.wait(remaining)
+
+        try:
+            return self.connect()
+        except BaseException:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    def checkin(self, executor):
+        """Give a checked out executor back to the pool"""
+        with self.cond:
+            self.pinned.discard(executor)
+            if self.closed and not executor.conn.closed:
+                executor.conn.close()
+            if executor.conn.closed:
+                self.size -= 1
+            else:
+                executor.last_use = time.time()
+                self.idle.append(executor)
+            self.cond.notify()
+        if self.on_checkin:
+            self.on_checkin()
+
+    def pin(self, executor):
+        """Stop counting a checked out executor against max_size"""
+        with self.cond:
+            if executor not in self.pinned:
+                self.pinned.add(executor)
+                self.cond.notify()
+
+    def discard(self, executor):
+        """Close a checked out executor instead of giving it back"""
+        with self.cond:
+            self.pinned.discard(executor)
+            self.size -= 1
+            self.cond.notify()
+        try:
+            executor.conn.close()
+        except Exception as e:
+            logger.debug('Error closing connection: %r', e)
+
+    def reap(self, idle_timeout):
+        """Close idle connections unused for idle_timeout seconds"""
+        expired = []
+        with self.cond:
+            deadline = time.time() - idle_timeout
+            # The least recently used executors are at the start of the list
+            while (self.idle and self.size > self.min_size
+                   and self.idle[0].last_use < deadline):
+                expired.append(self.idle.pop(0))
+                self.size -= 1
+        for executor in expired:
+            executor.conn.close()
+        return len(expired)
+
+    def ping(self, interval):
+        """Run a trivial query on idle connections unused for interval seconds
+
+        Connections which fail are closed. Pinged connections are taken out
+        of the idle list meanwhile, so they are never checked out mid-ping.
+        """
+        now = time.time()
+        with self.cond:
+            due = [e for e in self.idle if max(e.last_use, e.last_ping) + interval <= now]
+            if not due:
+                return 0
+            self.idle = [e for e in self.idle if e not in due]
+
+        for executor in due:
+            executor.last_ping = time.time()
+            try:
+                with executor.conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+            except Exception as e:
+                logger.debug('Closing dead connection: %r', e)
+                executor.conn.close()
+
+        with self.cond:
+            for executor in due:
+                if executor.conn.closed:
+                    self.size -= 1
+                else:
+                    self.idle.append(executor)
+            self.idle.sort(key=lambda e: e.last_use)
+            self.cond.notify_all()
+        return len(due)
+
+    def next_deadline(self, idle_timeout, ping_interval):
+        """When the next reap or ping is due, None if never"""
+        deadlines = []
+        with self.cond:
+            if idle_timeout >= 0 and self.idle and self.size > self.min_size:
+                deadlines.append(self.idle[0].last_use + idle_timeout)
+            if ping_interval:
+                deadlines.extend(max(e.last_use, e.last_ping) + ping_interval
+                                 for e in self.idle)
+        return min(deadlines) if deadlines else None
+
+    def close_idle(self):
+        """Close all idle connections"""
+        with self.cond:
+            expired, self.idle = self.idle, []
+            self.size -= len(expired)
+        for executor in expired:
+            executor.conn.close()
+        return len(expired)
+
+    def close(self):
+        """Close the idle connections, and the others once checked in"""
+        with self.cond:
+            self.closed = True
+        return self.close_idle()
@@ -0,0 +1,139 @@
+import logging
+import re
+from collections import OrderedDict
+
+logger = logging.getLogger('pgcli_sublime.prepared')
+
+# Statements PREPARE accepts
+PREPARABLE_SQL_RE = re.compile(r'\s*(select|insert|update|delete|values|with)\b', re.IGNORECASE)
+
+# Named psycopg2 placeholders. Like psycopg2, quotes aren't looked into.
+PLACEHOLDER_RE = re.compile(r'%\((?P<name>\w+)\)s|(?P<percent>%%)')
+
+
+def to_positional(sql):
+    """sql with %(name)s placeholders replaced by $1, $2, ...
+
+    Returns (sql, names in the order of their numbers). A placeholder used
+    twice gets the same number, %% becomes %.
+    """
+    names = []
+
+    def replace(m):
+        if m.group('percent'):
+            return '%'
+        name = m.group('name')
+        if name not in names:
+            names.append(name)
+        return '${}'.format(names.index(name) + 1)
+
+    return PLACEHOLDER_RE.sub(replace, sql), names
+
+
+def interpolate(sql, params):
+    """sql with the text of params put in for its %(name)s placeholders
+
+    For meta commands, which pgspecial runs by itself without binding
+    parameters. The values go in as they are, unquoted, and %% becomes %.
+    """
+    def replace(m):
+        if m.group('percent'):
+            return '%'
+        return str(params[m.group('name')])
+
+    return PLACEHOLDER_RE.sub(replace, sql)
+
+
+class PreparedStatements:
+    """PREPAREd statements of one connection, in least recently used order
+
+    A statement is prepared the threshold-th time it is run, from then on
+    only EXECUTE with its parameters is sent and the server skips parsing
+    and planning it. At most size statements are kept prepared, the least
+    recently used one is deallocated to make room.
+    """
+
+    def __init__(self, size=100, threshold=2):
+        self.size = size
+        self.threshold = threshold
+        self.prepared = OrderedDict()  # Dict mapping sql to (name, parameter names)
+        self.runs = OrderedDict()  # Dict mapping sql to times run, while not prepared
+        self.counter = 0  # Names are never reused, even after invalidate
+        self.generation = 0  # Of the schema the statements were prepared for
+
+    def execute(self, cur, sql, params=None, prepare=True):
+        """Run sql on cur, through its prepared statement where possible
+
+        params is a dict for the %(name)s placeholders in sql, or None for
+        sql without placeholders. Statements are only prepared outside of
+        transactions, where a statement failing to prepare doesn't abort
+        anything. Pass prepare=False for sql which can't be prepared, e.g.
+        several statements.
+        """
+        entry = self.prepared.get(sql)
+        if entry is not None:
+            self.prepared.move_to_end(sql)
+        elif (prepare and self.threshold and PREPARABLE_SQL_RE.match(sql)
+                and not cur.connection.get_transaction_status()):
+            runs = self.runs.pop(sql, 0) + 1
+            if runs >= self.threshold:
+                entry = self._prepare(cur, sql, params is not None)
+            else:
+                self.runs[sql] = runs
+                while len(self.runs) > self.size:
+                    self.runs.popitem(last=False)
+
+        if entry is None:
+            cur.execute(sql, params)
+            return
+        name, names = entry
+        args = [params[n] for n in names] if names else None
+        if args:
+            cur.execute('EXECUTE {} ({})'.format(name, ', '.join(['%s'] * len(args))), args)
+        else:
+            cur.execute('EXECUTE ' + name)
+
+    def due(self, sql):
+        """Whether running sql now goes through its prepared statement
+
+        Otherwise the run is counted, for statements run some other way
+        until they are due, e.g. selects streamed through a cursor.
+        """
+        if sql in self.prepared:
+            return True
+        if not self.threshold or not PREPARABLE_SQL_RE.match(sql):
+            return False
+        runs = self.runs.get(sql, 0) + 1
+        if runs >= self.threshold:
+            return True
+        self.runs[sql] = runs
+        self.runs.move_to_end(sql)
+        while len(self.runs) > self.size:
+            self.runs.popitem(last=False)
+        return False
+
+    def _prepare(self, cur, sql, has_params):
+        statement, names = to_positional(sql) if has_params else (sql, [])
+        self.counter += 1
+        name = 'pgcli_{}'.format(self.counter)
+        try:
+            cur.execute('PREPARE {} AS {}'.format(name, statement))
+        except Exception as e:
+            # E.g. parameter types the server can't infer, run it as it is
+            logger.debug('Error preparing %r: %r', sql, e)
+            return None
+        self.prepared[sql] = (name, names)
+        while len(self.prepared) > self.size:
+            _, (old, _) = self.prepared.popitem(last=False)
+            cur.execute('DEALLOCATE ' + old)
+        return name, names
+
+    def invalidate(self, cur=None):
+        """Forget the prepared statements, after ddl changed what they use
+
+        With cur, they are deallocated on the server as well.
+        """
+        if self.prepared and cur is not None:
+            cur.execute('DEALLOCATE ALL')
+        self.prepared.clear()
+        self.runs.clear()
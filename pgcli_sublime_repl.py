@@ -18,6 +18,9 @@ class SublimePgcliRepl(Repl):
         super(SublimePgcliRepl, self).__init__(encoding,
                                                additional_scopes=['sql'])
 
+        from .pgcli_sublime import load_modules
+        load_modules()
+
         global psycopg2, has_meta_cmd, has_change_db_cmd
         from .pgcli_sublime import (PGCli, psycopg2, has_meta_cmd,
                                     has_change_db_cmd)
@@ -0,0 +1,105 @@
+import logging
+import pickle
+import tempfile
+from threading import Lock
+
+logger = logging.getLogger('pgcli_sublime.results')
+
+
+def picklable(value):
+    """value, or the text the output would show for it"""
+    if isinstance(value, memoryview):
+        return '\\x' + value.hex()
+    try:
+        pickle.dumps(value)
+    except (TypeError, pickle.PicklingError):
+        return str(value)
+    return value
+
+
+class ResultStore:
+    """Rows of a result set, kept as pickled chunks
+
+    Rows are packed ``chunk_size`` at a time, which takes far less memory than
+    the tuples themselves. Once the packed chunks take more than
+    ``max_memory`` bytes, further chunks are spilled to a temporary file.
+    Rows may be appended by the thread running the query while another one
+    reads a window of them.
+    """
+
+    def __init__(self, headers, chunk_size=1000, max_memory=64 * 1024 * 1024):
+        self.headers = headers
+        self.chunk_size = chunk_size
+        self.max_memory = max_memory
+        self.rowcount = 0
+        self.complete = False  # Set once the last row was appended
+        self.chunks = []  # Pickled bytes, or (offset, length) in the spill file
+        self.pending = []  # Rows not packed into a chunk yet
+        self.memory = 0
+        self.spill = None
+        self.unpacked = (None, None)  # (chunk index, rows) of the last read
+        self.lock = Lock()
+
+    def append(self, rows):
+        with self.lock:
+            self.pending.extend(rows)
+            self.rowcount += len(rows)
+            while len(self.pending) >= self.chunk_size:
+                self._pack(self.pending[:self.chunk_size])
+                del self.pending[:self.chunk_size]
+
+    def _pack(self, rows):
+        try:
+            data = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+        except (TypeError, pickle.PicklingError):
+            rows = [tuple(map(picklable, row)) for row in rows]
+            data = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+
+        if self.memory + len(data) <= self.max_memory:
+            self.memory += len(data)
+            self.chunks.append(data)
+            return
+
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(prefix='pgcli_result_')
+            logger.debug('Spilling result rows to %r', self.spill.name)
+        self.spill.seek(0, 2)
+        self.chunks.append((self.spill.tell(), len(data)))
+        self.spill.write(data)
+
+    def _chunk(self, index):
+        if self.unpacked[0] == index:
+            return self.unpacked[1]
+        data = self.chunks[index]
+        if isinstance(data, tuple):
+            offset, length = data
+            self.spill.seek(offset)
+            data = self.spill.read(length)
+        rows = pickle.loads(data)
+        self.unpacked = (index, rows)
+        return rows
+
+    def rows(self, start, stop):
+        """Returns the rows from start up to stop"""
+        with self.lock:
+            stop = min(stop, self.rowcount)
+            rows = []
+            packed = len(self.chunks) * self.chunk_size
+            pos = start
+            while pos < min(stop, packed):
+                index, offset = divmod(pos, self.chunk_size)
+                chunk = self._chunk(index)
+                rows.extend(chunk[offset:offset + stop - pos])
+                pos = (index + 1) * self.chunk_size
+            if stop > packed:
+                rows.extend(self.pending[max(start - packed, 0):stop - packed])
+            return rows
+
+    def close(self):
+        with self.lock:
+            self.chunks = []
+            self.pending = []
+            self.unpacked = (None, None)
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
@@ -0,0 +1,86 @@
+import heapq
+import itertools
+import logging
+import time
+from threading import Condition, Thread
+
+logger = logging.getLogger('pgcli_sublime.scheduler')
+
+
+class Scheduler:
+    """Runs callbacks at their deadlines on a single thread
+
+    Every callback is registered under a key. Scheduling a key which is
+    already due earlier keeps the earlier deadline, so callbacks check their
+    own state when they run and schedule themselves again if woken too early.
+    The thread is started with the first callback and sleeps until the next
+    deadline, so it costs nothing while there is nothing to do.
+    """
+
+    def __init__(self, name='scheduler'):
+        self.name = name
+        self.heap = []  # (deadline, sequence number, key, callback)
+        self.deadlines = {}  # Dict mapping keys to their queued deadline
+        self.counter = itertools.count()
+        self.cond = Condition()
+        self.thread = None
+        self.stopped = False
+
+    def schedule(self, key, deadline, callback):
+        with self.cond:
+            if self.stopped:
+                return
+            current = self.deadlines.get(key)
+            if current is not None and current <= deadline:
+                return
+            self.deadlines[key] = deadline
+            heapq.heappush(self.heap, (deadline, next(self.counter), key, callback))
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name=self.name)
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.cond.notify()
+
+    def cancel(self, key):
+        with self.cond:
+            self.deadlines.pop(key, None)
+
+    def stop(self):
+        """Drop all callbacks and end the thread"""
+        with self.cond:
+            self.stopped = True
+            self.heap = []
+            self.deadlines = {}
+            self.cond.notify()
+
+    def _next(self):
+        """Wait for the next due callback and return it, None once stopped"""
+        with self.cond:
+            while True:
+                if self.stopped:
+                    return None
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                deadline, _, key, callback = self.heap[0]
+                if self.deadlines.get(key) != deadline:
+                    # Cancelled, or replaced by an earlier deadline
+                    heapq.heappop(self.heap)
+                    continue
+                delay = deadline - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+                del self.deadlines[key]
+                return callback
+
+    def _run(self):
+        while True:
+            callback = self._next()
+            if callback is None:
+                return
+            try:
+                callback()
+            except Exception:
+                logger.exception('Error in scheduled %r', callback)
@@ -0,0 +1,365 @@
+import logging
+import re
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
+logger = logging.getLogger('pgcli_sublime.statements')
+
+# Tokens iter_statements has to skip over or stop at. Strings without their
+# closing quote run to the end of the text.
+SCRIPT_TOKEN_RE = re.compile(r"""
+      (?P<semicolon>;)
+    | (?P<comment>--[^\n]*)
+    | (?P<block>/\*)
+    | (?P<estring>(?<![\w$])[eE]'[^'\\]*(?:(?:\\.|'')[^'\\]*)*(?:'|\Z))
+    | (?P<string>'[^']*(?:''[^']*)*(?:'|\Z))
+    | (?P<ident>"[^"]*(?:""[^"]*)*(?:"|\Z))
+    | (?P<dollar>(?<![\w$])\$(?:[^\W\d]\w*)?\$)
+    | (?P<meta>\\)
+""", re.VERBOSE | re.DOTALL)
+BLOCK_COMMENT_RE = re.compile(r'/\*|\*/')
+NON_SPACE_RE = re.compile(r'\S')
+COPY_FROM_STDIN_RE = re.compile(r'copy\b[^;]*\bfrom\s+stdin\b', re.IGNORECASE)
+COPY_DATA_END_RE = re.compile(r'^\\\.\r?$', re.MULTILINE)
+# Statements which may return rows, can't be sent along with others, or
+# mean something else in the PL/pgSQL of batch_block
+UNBATCHABLE_SQL_RE = re.compile(
+    r'\\|\b(select|show|explain|fetch|returning|copy|begin|start|commit|rollback'
+    r'|abort|savepoint|release|prepare|vacuum|concurrently|database|system)\b'
+    r'|(^|;)\s*(values|table|end|execute|move|close|open|call|declare|discard)\b',
+    re.IGNORECASE
+)
+BATCH_TAG = '$pgcli_batch$'
+BATCH_NOTICE_RE = re.compile(r'pgcli_batch \{([\d,]*)\}')
+FIRST_WORD_RE = re.compile(r'(?:\s+|--[^\n]*|/\*.*?\*/)*(\w+)', re.DOTALL)
+
+
+def split_statements(text):
+    """Yields (length, is_open) for the sql statements in text
+
+    Statements are split by sqlparse. The lengths add up to the length of the
+    text, except for trailing whitespace which sqlparse doesn't return as a
+    statement. A statement is open when it contains an unterminated quote or
+    comment, which text further down the buffer may still close, or a string
+    with a backslash before a quote: sqlparse reads that quote as escaped
+    only if there is another one further down, e.g. in e'\\'' or '\\'.
+    """
+    import sqlparse
+    from sqlparse import tokens
+
+    stack = sqlparse.engine.FilterStack()
+    stack.split_statements = True
+    for statement in stack.run(text):
+        is_open = False
+        prev = None
+        for token in statement.flatten():
+            if (token.ttype in tokens.Error
+                    or (prev == '/' and token.value.startswith('*'))
+                    or (token.ttype in tokens.String and "\\'" in token.value)):
+                is_open = True
+                break
+            prev = token.value
+        yield len(str(statement)), is_open
+
+
+def block_comment_end(text, pos):
+    """Offset after the block comment starting before pos, which may nest"""
+    depth = 1
+    while depth:
+        m = BLOCK_COMMENT_RE.search(text, pos)
+        if not m:
+            return len(text)
+        depth += 1 if m.group() == '/*' else -1
+        pos = m.end()
+    return pos
+
+
+def iter_statements(text):
+    """Yields (begin, end, data) for the statements of an sql script
+
+    The statement is text[begin:end], without leading whitespace and comments
+    and including its ';'. Statements starting with a backslash are meta
+    commands, which end at the end of their line. data is the (begin, end)
+    span of the rows following a COPY ... FROM stdin statement, otherwise
+    None.
+
+    Unlike split_statements, only quotes, comments and ';' are looked at, so
+    statements are found as fast as they can be run, even in huge scripts.
+    """
+    length = len(text)
+    pos = 0
+    begin = None
+    while True:
+        m = SCRIPT_TOKEN_RE.search(text, pos)
+        if begin is None:
+            content = NON_SPACE_RE.search(text, pos, m.start() if m else length)
+            if content:
+                begin = content.start()
+        if not m:
+            break
+
+        kind = m.lastgroup
+        pos = m.end()
+        if kind == 'comment':
+            continue
+        if kind == 'block':
+            pos = block_comment_end(text, pos)
+            continue
+        if kind == 'dollar':
+            close = text.find(m.group(), pos)
+            pos = length if close < 0 else close + len(m.group())
+        elif kind == 'meta' and begin is None:
+            end = text.find('\n', pos)
+            end = length if end < 0 else end
+            yield m.start(), end, None
+            pos = end
+            continue
+        elif kind == 'semicolon':
+            if begin is None:
+                continue  # Empty statement
+            data = None
+            if COPY_FROM_STDIN_RE.match(text, begin, pos):
+                # The rows start on the next line and end with a \. line
+                newline = text.find('\n', pos)
+                data_begin = length if newline < 0 else newline + 1
+                data_end = COPY_DATA_END_RE.search(text, data_begin)
+                if data_end:
+                    data = (data_begin, data_end.start())
+                else:
+                    data = (data_begin, length)
+                yield begin, pos, data
+                pos = data_end.end() if data_end else length
+            else:
+                yield begin, pos, data
+            begin = None
+            continue
+
+        if begin is None:
+            begin = m.start()
+
+    if begin is not None:
+        yield begin, length, None
+
+
+def single_statement(sql):
+    """The one plain sql statement of sql, without its ';'
+
+    Raises ValueError unless iter_statements finds exactly one statement
+    which is neither a meta command nor followed by COPY data, e.g. so that
+    a commit further down a selection can't escape a rollback.
+    """
+    statements = list(islice(iter_statements(sql), 2))
+    if len(statements) != 1:
+        raise ValueError('Expected a single statement, found {}'.format(
+            'several' if statements else 'none'))
+    begin, end, data = statements[0]
+    if data is not None or sql.startswith('\\', begin):
+        raise ValueError('Expected a single sql statement, found a meta command or COPY data')
+    return sql[begin:end].rstrip(';').strip()
+
+
+def batch_statements(sqls, size):
+    """Groups sqls into lists of at most size statements, to be sent at once
+
+    Only consecutive statements which return no rows and leave transactions
+    alone are grouped, every other statement is a list of its own.
+    """
+    batch = []
+    for sql in sqls:
+        if UNBATCHABLE_SQL_RE.search(sql):
+            if batch:
+                yield batch
+                batch = []
+            yield [sql]
+            continue
+        batch.append(sql)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def batch_block(sqls):
+    """A DO block running sqls, which reports the row count of each of them
+
+    The counts come back as a single notice, see batch_counts. Returns None
+    if a statement contains the dollar quote tag of the block.
+    """
+    if any(BATCH_TAG in sql for sql in sqls):
+        return None
+    # The ';' goes on a line of its own, after any trailing comment
+    body = ''.join(
+        '  {}\n  ;\n'
+        '  GET DIAGNOSTICS pgcli_rows = ROW_COUNT;\n'
+        '  pgcli_counts := pgcli_counts || pgcli_rows;\n'.format(sql.strip().rstrip(';'))
+        for sql in sqls)
+    return ('DO {tag}\nDECLARE\n'
+            '  pgcli_rows bigint;\n'
+            "  pgcli_counts bigint[] := '{{}}';\n"
+            'BEGIN\n{body}'
+            "  RAISE NOTICE 'pgcli_batch %', pgcli_counts;\n"
+            'END {tag}').format(tag=BATCH_TAG, body=body)
+
+
+def batch_counts(notices):
+    """Takes the notice of a batch_block out of notices, returns its counts
+
+    Returns None if there is none.
+    """
+    for i, notice in enumerate(notices):
+        m = BATCH_NOTICE_RE.search(notice)
+        if m:
+            del notices[i]
+            return [int(n) for n in m.group(1).split(',') if n]
+    return None
+
+
+def batch_status(sql, rows):
+    """The status of a statement run in a batch_block, like the server's"""
+    m = FIRST_WORD_RE.match(sql)
+    word = m.group(1).upper() if m else ''
+    if word == 'INSERT':
+        return 'INSERT 0 {}'.format(rows)
+    if word in ('UPDATE', 'DELETE', 'MERGE'):
+        return '{} {}'.format(word, rows)
+    return '{} {} rows'.format(word, rows) if rows else word
+
+
+class StatementIndex:
+    """Statement boundaries of a buffer, kept up to date incrementally
+
+    ``ends`` holds the end offset of every statement, so the statement at an
+    offset is found with a binary search. Edits only shift the offsets and
+    mark the edited span as dirty; the next lookup re-splits the dirty
+    statements and stops as soon as the new boundaries line up with the old
+    ones again.
+    """
+
+    def __init__(self, split=split_statements):
+        self.split = split
+        self.ends = None  # None until the first full build
+        self.open_ends = []  # Ends of the statements with unterminated tokens
+        self.dirty = None  # (begin, end) span which has to be re-split
+
+    def invalidate(self):
+        self.ends = None
+        self.open_ends = []
+        self.dirty = None
+
+    def apply_change(self, begin, end, length):
+        """Replace the text between begin and end with length characters"""
+        if self.ends is None:
+            return
+
+        delta = length - (end - begin)
+
+        def shift(pos):
+            if pos <= begin:
+                return pos
+            if pos >= end:
+                return pos + delta
+            return begin + length
+
+        def shift_all(offsets):
+            shifted = []
+            for pos in offsets:
+                if begin < pos < end:
+                    continue
+                pos = shift(pos)
+                # Statements which were deleted entirely collapse into one
+                if not shifted or shifted[-1] != pos:
+                    shifted.append(pos)
+            return shifted
+
+        self.ends = shift_all(self.ends)
+        self.open_ends = shift_all(self.open_ends)
+
+        if self.dirty:
+            lo, hi = self.dirty
+            self.dirty = (min(shift(lo), begin), max(shift(hi), begin + length))
+        else:
+            self.dirty = (begin, begin + length)
+
+    def statement_at(self, text, pos):
+        """Returns (begin, end) of the statement containing offset pos
+
+        A cursor right at the end of a statement belongs to that statement.
+        """
+        if self.ends is None:
+            self._split(text, 0, [], [], len(text), [], [])
+        elif self.dirty:
+            self._resplit(text)
+
+        i = min(bisect_left(self.ends, pos), len(self.ends) - 1)
+        begin = self.ends[i - 1] if i else 0
+        return begin, self.ends[i]
+
+    def _resplit(self, text):
+        lo, hi = self.dirty
+        self.dirty = None
+
+        # Start one statement early, edits at a boundary may join statements.
+        # An unterminated quote further up may be closed by the edit as well.
+        start = max(bisect_left(self.ends, lo) - 1, 0)
+        if self.open_ends:
+            start = min(start, bisect_left(self.ends, self.open_ends[0]))
+        begin = self.ends[start - 1] if start else 0
+
+        self._split(text, begin,
+                    self.ends[:start],
+                    self.open_ends[:bisect_right(self.open_ends, begin)],
+                    hi,
+                    self.ends[bisect_left(self.ends, hi):],
+                    self.open_ends[bisect_left(self.open_ends, hi):])
+
+    def _statements_from(self, text, begin):
+        if not begin or text[begin - 1].isspace():
+            return self.split(text[begin:])
+
+        # The lexer looks behind the current position in a few places (e.g.
+        # for dollar quotes), so keep the ';' ending the previous statement
+        statements = self.split(text[begin - 1:])
+        length, _ = next(statements)
+        if length != 1:
+            return None
+        return statements
+
+    def _split(self, text, begin, ends, open_ends, hi, old_ends, old_open_ends):
+        statements = self._statements_from(text, begin)
+        if statements is None:
+            logger.debug('Unexpected statement boundary at %d', begin)
+            begin, ends, open_ends = 0, [], []
+            statements = self._statements_from(text, begin)
+
+        pos = begin
+        for length, is_open in statements:
+            pos += length
+            ends.append(pos)
+            if is_open:
+                open_ends.append(pos)
+
+            if pos > hi:
+                # Past the edit, an unchanged boundary means the rest of the
+                # buffer splits exactly as before. The lexer looks one
+                # character behind, so that one has to be unchanged too.
+                i = bisect_left(old_ends, pos)
+                if i < len(old_ends) and old_ends[i] == pos:
+                    ends.extend(old_ends[i + 1:])
+                    open_ends.extend(old_open_ends[bisect_right(old_open_ends, pos):])
+                    break
+        else:
+            # Trailing whitespace isn't returned by sqlparse, but belongs to
+            # the last statement
+            if ends:
+                ends[-1] = len(text)
+            if open_ends and open_ends[-1] == pos:
+                open_ends[-1] = len(text)
+
+        # The edit may have left nothing but whitespace in the last statement
+        if len(ends) > 1 and text[ends[-2]:].isspace():
+            last = ends.pop(-2)
+            if open_ends and open_ends[-1] == last:
+                open_ends[-1] = len(text)
+        self.ends = ends or [len(text)]
+        self.open_ends = open_ends
@@ -0,0 +1,84 @@
+import datetime
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+logger = logging.getLogger('pgcli_sublime.timing')
+
+# The phases of running a query, in order
+PHASES = ('checkout', 'execute', 'fetch', 'format', 'render')
+
+
+class QueryTimer:
+    """Time spent in each phase of running a query, and its output size
+
+    ``execute`` is the time until the server returned a result. For results
+    which are fetched at once that includes sending the rows, ``fetch`` is
+    then just turning them into Python objects. For streamed results
+    ``fetch`` is every round trip for the next batch of rows.
+    """
+
+    def __init__(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.rows = 0
+        self.chars = 0  # Characters of output as rendered, not bytes received
+        self.started = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def add_output(self, rows, out):
+        self.rows += rows
+        self.chars += len(out)
+
+    def summary(self):
+        parts = ['{} {:.1f} ms'.format(name, self.phases[name] * 1000)
+                 for name in PHASES]
+        parts.append('{} rows, {} characters'.format(self.rows, self.chars))
+        return ' | '.join(parts)
+
+    def record(self, **fields):
+        """The timings as a dict for the JSON lines log, times in ms"""
+        record = {
+            'time': datetime.datetime.fromtimestamp(self.started).isoformat(),
+            'phases_ms': {name: round(self.phases[name] * 1000, 3) for name in PHASES},
+            'total_ms': round(sum(self.phases.values()) * 1000, 3),
+            'rows': self.rows,
+            'output_chars': self.chars,
+        }
+        record.update(fields)
+        return record
+
+
+class TimingLog:
+    """Appends one JSON object per query to a file
+
+    Once the file reaches max_size bytes it is renamed to path + '.1',
+    replacing the previous one, and a new file is started.
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.lock = Lock()
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        try:
+            with self.lock:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                if (self.max_size and os.path.exists(self.path)
+                        and os.path.getsize(self.path) >= self.max_size):
+                    os.replace(self.path, self.path + '.1')
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+        except OSError as e:
+            logger.warning('Error writing timing log %r: %r', self.path, e)
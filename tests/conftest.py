@@ -0,0 +1,10 @@
+import os
+import sys
+import types
+
+# The plugin's modules are imported as the package Sublime Text loads them
+# as, without Sublime Text itself
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+package = types.ModuleType('PgcliSublime')
+package.__path__ = [ROOT]
+sys.modules.setdefault('PgcliSublime', package)
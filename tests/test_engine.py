@@ -0,0 +1,28 @@
+from threading import Event
+
+from PgcliSublime.pgcli_sublime_engine import ExecutionEngine
+
+
+def test_stop_cancels_the_jobs_and_ends_the_loop():
+    engine = ExecutionEngine(max_workers=1)
+    started, release = Event(), Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+    running = engine.submit('view', block, cancel=release.set)
+    queued = engine.submit('view', lambda: 'never')
+    assert started.wait(1)
+    engine.stop()
+    assert engine.thread is None
+    assert queued.future.cancelled()
+    assert running.cancelled.is_set()
+    assert running.future.done()  # Finished, or cancelled with the loop
+
+
+def test_cancel_and_depth_dont_start_the_loop():
+    engine = ExecutionEngine(max_workers=1)
+    assert engine.cancel('view') == (None, 0)
+    assert engine.depth('view') == 0
+    assert not engine.is_cancelled('view')
+    assert engine.thread is None and engine.loop is None
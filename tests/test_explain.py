@@ -0,0 +1,95 @@
+import pytest
+
+from PgcliSublime.pgcli_sublime_explain import explain_analyze
+
+PLAN = [{'Plan': {'Node Type': 'Result'}}]
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, sql):
+        self.conn.executed.append(sql)
+        if sql.startswith('EXPLAIN') and self.conn.error:
+            raise self.conn.error
+
+    def fetchone(self):
+        return [PLAN]
+
+
+class FakeConnection:
+    """An autocommit connection, like pgcli's, in the given transaction status"""
+
+    def __init__(self, status, error=None):
+        self.autocommit = True
+        self.status = status
+        self.error = error
+        self.executed = []
+
+    def get_transaction_status(self):
+        return self.status
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        raise AssertionError('the whole transaction was rolled back')
+
+
+def test_explain_analyze_outside_of_a_transaction():
+    conn = FakeConnection(status=0)
+    assert explain_analyze(conn, 'delete from t') == PLAN[0]
+    assert conn.executed == [
+        'BEGIN',
+        'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) delete from t',
+        'ROLLBACK',
+    ]
+
+
+def test_explain_analyze_keeps_an_open_transaction():
+    conn = FakeConnection(status=2)
+    assert explain_analyze(conn, 'delete from t') == PLAN[0]
+    assert conn.executed == [
+        'SAVEPOINT pgcli_explain',
+        'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) delete from t',
+        'ROLLBACK TO SAVEPOINT pgcli_explain',
+        'RELEASE SAVEPOINT pgcli_explain',
+    ]
+    assert conn.autocommit
+
+
+def test_explain_analyze_error_in_an_open_transaction():
+    conn = FakeConnection(status=2, error=ValueError('syntax error'))
+    with pytest.raises(ValueError):
+        explain_analyze(conn, 'delete from')
+    assert conn.executed[-2:] == [
+        'ROLLBACK TO SAVEPOINT pgcli_explain',
+        'RELEASE SAVEPOINT pgcli_explain',
+    ]
+
+
+@pytest.mark.parametrize('sql', [
+    'delete from t; commit; select 1',
+    'delete from t; end',
+    '\\d t',
+    'copy t from stdin;\n1\n\\.\n',
+    '-- nothing but a comment',
+])
+def test_explain_analyze_rejects_anything_but_one_statement(sql):
+    conn = FakeConnection(status=0)
+    with pytest.raises(ValueError):
+        explain_analyze(conn, sql)
+    assert conn.executed == []
+
+
+def test_explain_analyze_strips_comments_and_semicolon():
+    conn = FakeConnection(status=0)
+    explain_analyze(conn, '-- why\ndelete from t; -- done\n')
+    assert conn.executed[1] == 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) delete from t'
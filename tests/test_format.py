@@ -0,0 +1,49 @@
+import datetime
+
+import pytest
+
+from PgcliSublime.pgcli_sublime_format import Table, format_table
+
+TabularOutputFormatter = pytest.importorskip('cli_helpers.tabular_output').TabularOutputFormatter
+
+HEADERS = ['id', 'name', 'a_long_header', 'x']
+ROWS = [
+    (1, 'short', None, 1.5),
+    (22, 'multi\nline text', True, datetime.date(2021, 1, 2)),
+    (333, '  padded  ', 'x' * 600, b'bytes'),
+    (4, '', [1, None], b'\xff\x00'),
+]
+
+
+def pgcli_output(rows, headers, status=None):
+    """What pgcli's format_output shows for a result"""
+    formatter = TabularOutputFormatter('psql')
+    lines = list(formatter.format_output(rows, headers, missing_value='NULL', disable_numparse=True,
+                                         preserve_whitespace=True, max_field_width=500))
+    if status:
+        lines.append(status)
+    return '\n'.join(lines) + '\n'
+
+
+@pytest.mark.parametrize('rows', [ROWS, ROWS[:1], ROWS[1:2], []])
+def test_format_table_matches_pgcli(rows):
+    out = ''.join(format_table(None, rows, HEADERS, 'SELECT 4', max_cell_width=500))
+    assert out == pgcli_output(rows, HEADERS, 'SELECT 4')
+
+
+def test_format_table_chunks():
+    rows = [(i, 'row {}'.format(i)) for i in range(25)]
+    chunks = list(format_table('title', rows, ['i', 's'], None, chunk_rows=10))
+    assert chunks[0] == 'title\n'
+    assert all(chunk.endswith('\n') for chunk in chunks)
+    # title, header, three chunks of rows, bottom border
+    assert len(chunks) == 6
+    assert ''.join(chunks[1:]) == pgcli_output(rows, ['i', 's'])
+
+
+def test_table_fit_keeps_widths():
+    table = Table(['id', 'name'])
+    first = table.lines(table.measure([(1, 'abc')]))
+    later = table.lines(table.fit([(2, 'abcdefgh'), (3, 'ab\nabcdef')]))
+    assert first == '| 1  | abc  |\n'
+    assert later == '| 2  | a... |\n| 3  | ab   |\n|    | a... |\n'
@@ -0,0 +1,30 @@
+from PgcliSublime.pgcli_sublime_history import QueryHistory, error_summary, normalize
+
+
+class Diagnostics:
+    message_primary = 'duplicate key value violates unique constraint "users_email_key"'
+
+
+class UniqueViolation(Exception):
+    pgcode = '23505'
+    diag = Diagnostics()
+
+
+def test_error_summary_leaves_out_the_detail():
+    error = UniqueViolation(Diagnostics.message_primary + '\n'
+                            'DETAIL:  Key (email)=(someone@example.com) already exists.\n')
+    assert error_summary(error) == '23505: ' + Diagnostics.message_primary
+    assert error_summary(ValueError('first line\nsecond line')) == 'first line'
+    assert error_summary(None) is None
+
+
+def test_history_keeps_no_literals(tmp_path):
+    history = QueryHistory(str(tmp_path / 'history.sqlite3'))
+    sql = "insert into users (email) values ('someone@example.com')"
+    error = UniqueViolation(Diagnostics.message_primary + '\n'
+                            'DETAIL:  Key (email)=(someone@example.com) already exists.\n')
+    history.add('db', sql, 1.5, error=error_summary(error))
+    (_, url, _, _, stored_error, statement), = history.slowest(0)
+    assert statement == normalize(sql) == 'insert into users (email) values (?)'
+    assert 'someone' not in stored_error
+    history.close()
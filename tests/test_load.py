@@ -0,0 +1,62 @@
+import pytest
+
+from PgcliSublime.pgcli_sublime_load import iter_lines, load
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def copy_expert(self, sql, file):
+        data = []
+        while True:
+            chunk = file.read(self.conn.read_size)
+            if not chunk:
+                break
+            data.append(chunk)
+        self.conn.copies.append((sql, ''.join(data)))
+
+
+class FakeConnection:
+    """Records the data of every COPY, read the way psycopg2 reads it"""
+
+    def __init__(self, read_size=8192):
+        self.read_size = read_size
+        self.copies = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+@pytest.mark.parametrize('read_size', [8192, 3])
+def test_load_keeps_quoted_newlines_in_their_row(read_size):
+    conn = FakeConnection(read_size)
+    text = 'id,note\n"1","a\nmultiline, ""quoted"" note"\n2,b\r\n\n3,"\n"'
+    rows, size, _ = load(conn, 't', iter_lines(text), 'csv', batch_size=1)
+    assert [data for _, data in conn.copies] == [
+        '"1","a\nmultiline, ""quoted"" note"\n', '2,b\r\n', '3,"\n"\n']
+    assert conn.copies[0][0] == 'COPY t FROM STDIN WITH (FORMAT csv)'
+    assert (rows, size) == (3, sum(len(data) for _, data in conn.copies))
+
+
+def test_load_splits_batches_at_the_batch_size():
+    progress = []
+    conn = FakeConnection()
+    lines = ['{}\tx\n'.format(i) for i in range(5)]
+    rows, _, _ = load(conn, 't', lines, 'tsv', batch_size=2, header=False,
+                      progress=lambda rows, size, seconds: progress.append(rows))
+    assert [data.count('\n') for _, data in conn.copies] == [2, 2, 1]
+    assert ''.join(data for _, data in conn.copies) == ''.join(lines)
+    assert rows == 5 and progress == [2, 4, 5]
+    assert conn.copies[0][0] == 'COPY t FROM STDIN'
+
+    # A last batch which is exactly full doesn't leave an empty COPY behind
+    conn = FakeConnection()
+    load(conn, 't', lines[:4], 'tsv', batch_size=2, header=False)
+    assert [data.count('\n') for _, data in conn.copies] == [2, 2]
@@ -0,0 +1,147 @@
+import time
+from threading import Timer
+
+import pytest
+
+from PgcliSublime.pgcli_sublime_pool import ConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, sql):
+        if self.conn.dead:
+            raise OSError('server closed the connection unexpectedly')
+        self.conn.queries.append(sql)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.dead = False
+        self.queries = []
+
+    def close(self):
+        self.closed = 1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeExecutor:
+    def __init__(self):
+        self.conn = FakeConnection()
+        self.last_use = 0
+        self.last_ping = 0
+
+
+def test_checkout_times_out_when_all_connections_are_busy():
+    pool = ConnectionPool(FakeExecutor, max_size=1)
+    pool.checkout(timeout=0.05)
+    with pytest.raises(PoolTimeout):
+        pool.checkout(timeout=0.05)
+
+
+def test_checkout_waits_for_a_checkin():
+    pool = ConnectionPool(FakeExecutor, max_size=1)
+    executor = pool.checkout()
+    Timer(0.02, pool.checkin, [executor]).start()
+    assert pool.checkout(timeout=1) is executor
+
+
+def test_checkout_reuses_the_most_recently_used_open_executor():
+    pool = ConnectionPool(FakeExecutor, max_size=3)
+    first, second, closed = [pool.checkout() for _ in range(3)]
+    for executor in (first, second, closed):
+        pool.checkin(executor)
+    closed.conn.close()
+    assert pool.checkout() is second
+    assert pool.checkout() is first
+    # The closed one was dropped, which makes room for a new connection
+    assert pool.size == 2
+    assert pool.checkout() not in (first, second, closed)
+
+
+def test_failed_connects_free_their_slot():
+    def connect():
+        raise OSError('could not connect to server')
+    pool = ConnectionPool(connect, max_size=1)
+    with pytest.raises(OSError):
+        pool.checkout(timeout=0.05)
+    assert pool.size == 0
+    pool.connect = FakeExecutor
+    assert pool.checkout(timeout=0.05)
+
+
+def test_pinned_executors_dont_count_against_max_size():
+    pool = ConnectionPool(FakeExecutor, max_size=2)
+    held = [pool.checkout(timeout=0.05) for _ in range(2)]
+    for executor in held:
+        pool.pin(executor)
+    # Views holding a transaction or stream leave room for the others
+    other = pool.checkout(timeout=0.05)
+    assert other not in held
+    assert pool.size == 3
+
+    pool.checkin(held[0])
+    pool.discard(held[1])
+    assert not pool.pinned
+    assert pool.size == 2
+    pool.checkin(other)
+    assert pool.checkout(timeout=0.05) in (held[0], other)
+
+
+def test_close_closes_checked_out_executors_on_checkin():
+    pool = ConnectionPool(FakeExecutor)
+    idle, busy = pool.checkout(), pool.checkout()
+    pool.checkin(idle)
+    assert pool.close() == 1
+    assert idle.conn.closed and not busy.conn.closed
+    pool.checkin(busy)
+    assert busy.conn.closed
+    assert pool.size == 0 and not pool.idle
+
+
+def idle_pool(last_uses, min_size=1):
+    """A pool with idle executors last used at the given times"""
+    pool = ConnectionPool(FakeExecutor, min_size=min_size)
+    executors = [pool.checkout() for _ in last_uses]
+    for executor, last_use in zip(executors, last_uses):
+        pool.checkin(executor)
+        executor.last_use = executor.last_ping = last_use
+    pool.idle.sort(key=lambda e: e.last_use)
+    return pool, executors
+
+
+def test_reap_closes_the_least_recently_used_down_to_min_size():
+    now = time.time()
+    pool, (old, older, recent) = idle_pool([now - 50, now - 100, now - 1], min_size=1)
+    assert pool.next_deadline(30, 0) == now - 100 + 30
+    assert pool.reap(30) == 2
+    assert older.conn.closed and old.conn.closed and not recent.conn.closed
+    assert pool.idle == [recent] and pool.size == 1
+    # min_size connections are kept however long they are idle
+    assert pool.reap(0) == 0
+    assert pool.next_deadline(30, 0) is None
+    assert pool.next_deadline(-1, 0) is None
+
+
+def test_ping_closes_dead_connections_and_keeps_the_others():
+    now = time.time()
+    pool, (alive, dead, fresh) = idle_pool([now - 100, now - 100, now])
+    dead.conn.dead = True
+    assert pool.next_deadline(-1, 60) == now - 100 + 60
+    assert pool.ping(60) == 2
+    assert alive.conn.queries == ['SELECT 1'] and not fresh.conn.queries
+    assert dead.conn.closed and not alive.conn.closed
+    assert set(pool.idle) == {alive, fresh} and pool.size == 2
+    # A ping postpones the next one
+    assert pool.next_deadline(-1, 60) == now + 60
+    assert pool.ping(60) == 0
@@ -0,0 +1,61 @@
+from PgcliSublime.pgcli_sublime_prepared import PreparedStatements, interpolate, to_positional
+
+
+def test_to_positional():
+    sql, names = to_positional('select %(a)s, %(b)s, %(a)s, 100%%')
+    assert sql == 'select $1, $2, $1, 100%'
+    assert names == ['a', 'b']
+
+
+def test_interpolate_puts_in_the_text_of_params():
+    assert interpolate('\\d %(selection)s', {'selection': 'public.t'}) == '\\d public.t'
+    assert interpolate('\\echo 100%% %(n)s', {'n': 5}) == '\\echo 100% 5'
+
+
+class FakeConnection:
+    def __init__(self):
+        self.status = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+
+class FakeCursor:
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+
+
+def test_statements_are_prepared_at_the_threshold():
+    prepared = PreparedStatements(threshold=2)
+    cur = FakeCursor()
+    prepared.execute(cur, 'select 1')
+    prepared.execute(cur, 'select 1')
+    prepared.execute(cur, 'select 1')
+    assert cur.executed == ['select 1', 'PREPARE pgcli_1 AS select 1',
+                            'EXECUTE pgcli_1', 'EXECUTE pgcli_1']
+
+
+def test_due_counts_runs_made_some_other_way():
+    prepared = PreparedStatements(threshold=3)
+    # E.g. streamed through a cursor
+    assert not prepared.due('select * from t')
+    assert not prepared.due('select * from t')
+    assert prepared.due('select * from t')
+    cur = FakeCursor()
+    prepared.execute(cur, 'select * from t')
+    assert cur.executed[0] == 'PREPARE pgcli_1 AS select * from t'
+    assert prepared.due('select * from t')
+    assert not PreparedStatements(threshold=0).due('select 1')
+    assert not PreparedStatements(threshold=1).due('vacuum t')
+
+
+def test_nothing_is_prepared_inside_a_transaction():
+    prepared = PreparedStatements(threshold=1)
+    cur = FakeCursor()
+    cur.connection.status = 2
+    prepared.execute(cur, 'select 1')
+    assert cur.executed == ['select 1']
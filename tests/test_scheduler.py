@@ -0,0 +1,79 @@
+import time
+from threading import Event
+
+from PgcliSublime.pgcli_sublime_scheduler import Scheduler
+
+
+def test_stop_drops_the_callbacks_and_ends_the_thread():
+    scheduler = Scheduler()
+    called = Event()
+    scheduler.schedule('due', 0, called.set)
+    assert called.wait(1)
+    late = Event()
+    scheduler.schedule('late', float('inf'), late.set)
+    scheduler.stop()
+    scheduler.thread.join(1)
+    assert not scheduler.thread.is_alive()
+    scheduler.schedule('other', 0, late.set)
+    assert not scheduler.heap and not late.is_set()
+
+
+def recorder(count):
+    """A callback factory recording keys, and an event set after count calls"""
+    done = []
+    finished = Event()
+
+    def callback(key):
+        def call():
+            done.append(key)
+            if len(done) == count:
+                finished.set()
+        return call
+    return done, finished, callback
+
+
+def test_callbacks_run_in_deadline_order():
+    scheduler = Scheduler()
+    done, finished, callback = recorder(3)
+    now = time.time()
+    scheduler.schedule('c', now + 0.06, callback('c'))
+    scheduler.schedule('a', now + 0.02, callback('a'))
+    scheduler.schedule('b', now + 0.04, callback('b'))
+    assert finished.wait(1)
+    assert done == ['a', 'b', 'c']
+    scheduler.stop()
+
+
+def test_the_earliest_deadline_of_a_key_wins():
+    scheduler = Scheduler()
+    done, finished, callback = recorder(2)
+    now = time.time()
+    scheduler.schedule('later', now + 0.05, callback('later'))
+    scheduler.schedule('key', now + 0.03, callback('first'))
+    scheduler.schedule('key', now + 10, callback('ignored'))
+    scheduler.schedule('key', now + 0.01, callback('earlier'))
+    assert finished.wait(1)
+    assert done == ['earlier', 'later']
+    assert not scheduler.deadlines
+    scheduler.stop()
+
+
+def test_cancelled_callbacks_dont_run():
+    scheduler = Scheduler()
+    done, finished, callback = recorder(1)
+    now = time.time()
+    scheduler.schedule('cancelled', now + 0.01, callback('cancelled'))
+    scheduler.schedule('kept', now + 0.03, callback('kept'))
+    scheduler.cancel('cancelled')
+    assert finished.wait(1)
+    assert done == ['kept']
+    scheduler.stop()
+
+
+def test_failing_callbacks_dont_stop_the_thread():
+    scheduler = Scheduler()
+    done, finished, callback = recorder(1)
+    scheduler.schedule('failing', 0, lambda: 1 / 0)
+    scheduler.schedule('next', time.time() + 0.01, callback('next'))
+    assert finished.wait(1)
+    scheduler.stop()
@@ -0,0 +1,122 @@
+import random
+
+import pytest
+
+from PgcliSublime.pgcli_sublime_statements import (
+    StatementIndex, batch_block, batch_counts, batch_status, batch_statements,
+    iter_statements
+)
+
+# Bits of sql the random edits are made of, mostly quotes and comments
+PIECES = ['select 1', ';', ' ', '\n', 'x', 'e', 'E', "'", "''", '"', '\\',
+          "e'\\''", '$$', '$f$', '--', '/*', '*/', '/', '*', '-']
+
+
+def statements(text):
+    """The statements iter_statements finds, with their COPY data"""
+    return [(text[begin:end], data and text[data[0]:data[1]])
+            for begin, end, data in iter_statements(text)]
+
+
+def test_iter_statements_skips_semicolons_in_dollar_quotes():
+    text = 'select $$a;b$$; select $f$ $x$;$ $f$;'
+    assert statements(text) == [('select $$a;b$$;', None),
+                                ('select $f$ $x$;$ $f$;', None)]
+
+
+def test_iter_statements_skips_nested_block_comments():
+    text = '/* a /* nested; */ still; */ select 1; select 2'
+    assert statements(text) == [('select 1;', None), ('select 2', None)]
+
+
+def test_iter_statements_skips_semicolons_in_strings():
+    text = "select e'it\\'s;', 'a''b;', \"a;b\"; select 2;"
+    assert statements(text) == [("select e'it\\'s;', 'a''b;', \"a;b\";", None),
+                                ('select 2;', None)]
+
+
+def test_iter_statements_returns_copy_data():
+    text = 'copy t from stdin;\n1\ta;b\n\\.\nselect 1;'
+    assert statements(text) == [('copy t from stdin;', '1\ta;b\n'), ('select 1;', None)]
+    # Data without its end marker runs to the end of the script
+    assert statements('copy t from stdin;\n1\t2\n') == [('copy t from stdin;', '1\t2\n')]
+
+
+def test_iter_statements_ends_meta_commands_at_the_end_of_their_line():
+    text = '\\d t\nselect 1;\n  \\x\n'
+    assert statements(text) == [('\\d t', None), ('select 1;', None), ('\\x', None)]
+
+
+def test_iter_statements_runs_unterminated_tokens_to_the_end():
+    for text in ["select 'open; string", 'select $$ open; body',
+                 'select 1 /* open; comment', 'select "open; ident']:
+        assert statements(text) == [(text, None)]
+
+
+def test_iter_statements_skips_empty_statements_and_comments():
+    assert statements(';; -- only a comment;\n/* ; */') == []
+    assert statements('select 1 -- c;\n; -- trailing') == [('select 1 -- c;\n;', None)]
+
+
+def test_batch_statements_groups_statements_without_results():
+    sqls = ['insert into t values (1)', 'update t set a = 2', 'select 1',
+            'delete from t', 'execute p', 'drop table t']
+    assert list(batch_statements(sqls, 10)) == [
+        sqls[:2], ['select 1'], ['delete from t'], ['execute p'], ['drop table t']]
+    assert list(batch_statements(sqls[:2], 1)) == [sqls[:1], sqls[1:2]]
+
+
+def test_batch_block_ends_statements_after_their_comments():
+    block = batch_block(['insert into t values (1) -- one', 'update t set a = 2;'])
+    assert block.startswith('DO $pgcli_batch$\n')
+    assert 'insert into t values (1) -- one\n  ;\n' in block
+    assert 'update t set a = 2\n  ;\n' in block
+    assert block.count('GET DIAGNOSTICS') == 2
+    assert batch_block(['create function f() as $pgcli_batch$ $pgcli_batch$']) is None
+
+
+def test_batch_counts_takes_out_its_notice():
+    notices = ['NOTICE:  from a trigger\n', 'NOTICE:  pgcli_batch {3,0,12}\n']
+    assert batch_counts(notices) == [3, 0, 12]
+    assert notices == ['NOTICE:  from a trigger\n']
+    assert batch_counts(notices) is None
+
+
+def test_batch_status():
+    assert batch_status('insert into t values (1)', 1) == 'INSERT 0 1'
+    assert batch_status('-- why\nUpdate t set a = 1', 3) == 'UPDATE 3'
+    assert batch_status('delete from t', 0) == 'DELETE 0'
+    assert batch_status('create table t (a int)', 0) == 'CREATE'
+
+
+def test_statement_index_resplits_strings_with_escaped_quotes():
+    pytest.importorskip('sqlparse')
+    # Whether sqlparse reads \\' as an escaped quote depends on the quotes
+    # further down, so an edit at the end can change the first statement
+    text = "select '\\'; select 1; select 2;"
+    index = StatementIndex()
+    assert index.statement_at(text, 0) == (0, 12)
+    index.apply_change(len(text), len(text), 8)
+    text += " select '"
+    assert index.statement_at(text, 0) == (0, len(text))
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_statement_index_matches_a_full_split_after_random_edits(seed):
+    pytest.importorskip('sqlparse')
+    rnd = random.Random(seed)
+    text = ''.join(rnd.choice(PIECES) for _ in range(30))
+    index = StatementIndex()
+    index.statement_at(text, 0)
+    for _ in range(40):
+        begin = rnd.randrange(len(text) + 1)
+        end = min(len(text), begin + rnd.randrange(4))
+        new = ''.join(rnd.choice(PIECES) for _ in range(rnd.randrange(3)))
+        text = text[:begin] + new + text[end:]
+        index.apply_change(begin, end, len(new))
+        if rnd.random() < 0.5:
+            continue  # Several edits between lookups
+        pos = rnd.randrange(len(text) + 1)
+        full = StatementIndex()
+        assert index.statement_at(text, pos) == full.statement_at(text, pos), text
+        assert index.ends == full.ends, text